@@ -0,0 +1,361 @@
+#!/usr/bin/python
+# vi: ts=4 expandtab syntax=python
+##############################################################################
+# Copyright (c) 2008 IBM Corporation
+# All rights reserved. This program and the accompanying materials
+# are made available under the terms of the Eclipse Public License v1.0
+# which accompanies this distribution, and is available at
+# http://www.eclipse.org/legal/epl-v10.html
+#
+##############################################################################
+"""
+Micro benchmarks for the open-ovf library.  Run them from the top of the
+source tree:
+
+  $ PYTHONPATH=py python extras/ovfbench.py serialize --items 10000
+  $ PYTHONPATH=py python extras/ovfbench.py startup --repeat 10
+
+Each benchmark prints the best wall clock time out of --repeat runs.
+"""
+
+import imp
+import os
+import sys
+import sha
+import shutil
+import subprocess
+import time
+import tempfile
+from optparse import OptionParser
+from xml.dom.minidom import Document, parseString
+
+from ovf import Ovf
+from ovf import OvfLibvirt
+from ovf import OvfProvision
+
+# the fake libvirt binding lives with the tests
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', 'py', 'tests'))
+import fakelibvirt
+
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           '..', 'py', 'scripts')
+
+#: modules the scripts should only load when a command needs them
+HEAVY_MODULES = ('libxml2', 'libvirt', 'ovf.OvfLibvirt', 'ovf.OvfTransport',
+                 'ovf.OvfIso', 'ovf.OvfCertificate')
+
+def makeEnvelope(items, systems=1):
+    """
+    Build an envelope DOM with the given number of systems, each with a
+    VirtualHardwareSection holding the given number of rasd Items.
+
+    @param items: Items per VirtualHardwareSection
+    @type items: int
+
+    @param systems: number of VirtualSystems
+    @type systems: int
+
+    @return: envelope document
+    @rtype: DOM Document
+    """
+    document = Document()
+    envelope = document.createElement('Envelope')
+    envelope.setAttribute('xmlns', 'http://schemas.dmtf.org/ovf/envelope/1')
+    envelope.setAttribute('xmlns:ovf', 'http://schemas.dmtf.org/ovf/envelope/1')
+    document.appendChild(envelope)
+
+    for system in range(systems):
+        virtualSystem = document.createElement('VirtualSystem')
+        virtualSystem.setAttribute('ovf:id', 'vs%d' % system)
+        envelope.appendChild(virtualSystem)
+        hardware = document.createElement('VirtualHardwareSection')
+        virtualSystem.appendChild(hardware)
+        for index in range(items):
+            item = document.createElement('Item')
+            for (tag, value) in (('rasd:ElementName', 'Item <%d>' % index),
+                                 ('rasd:InstanceID', str(index + 1)),
+                                 ('rasd:ResourceType', str(index % 20 + 1)),
+                                 ('rasd:VirtualQuantity', '1')):
+                child = document.createElement(tag)
+                child.appendChild(document.createTextNode(value))
+                item.appendChild(child)
+            hardware.appendChild(item)
+
+    return document
+
+def makeCollection(systems):
+    """
+    Build an envelope with a VirtualSystemCollection of the given number of
+    kvm systems, each with memory, cpus, a disk and a network card.
+
+    @param systems: number of VirtualSystems
+    @type systems: int
+
+    @return: envelope document
+    @rtype: DOM Document
+    """
+    item = ('<Item><rasd:InstanceID>%s</rasd:InstanceID>'
+            '<rasd:ResourceType>%s</rasd:ResourceType>%s</Item>')
+    files = []
+    disks = []
+    vss = []
+    for index in range(systems):
+        files.append('<File ovf:id="f%d" ovf:href="vm%d.img"/>' %
+                     (index, index))
+        disks.append('<Disk ovf:diskId="d%d" ovf:fileRef="f%d" '
+                     'ovf:capacity="1073741824"/>' % (index, index))
+        hardware = ''.join([
+            item % (1, 4, '<rasd:AllocationUnits>byte * 2^20'
+                          '</rasd:AllocationUnits>'
+                          '<rasd:VirtualQuantity>512</rasd:VirtualQuantity>'),
+            item % (2, 3, '<rasd:VirtualQuantity>2</rasd:VirtualQuantity>'),
+            item % (3, 6, ''),
+            item % (4, 17, '<rasd:Parent>3</rasd:Parent><rasd:HostResource>'
+                           'ovf:/disk/d%d</rasd:HostResource>' % index),
+            item % (5, 10, '<rasd:Connection>default</rasd:Connection>')])
+        vss.append('<VirtualSystem ovf:id="vm%d"><VirtualHardwareSection>'
+                   '<Info>hw</Info>%s</VirtualHardwareSection>'
+                   '</VirtualSystem>' % (index, hardware))
+    return parseString(
+        '<Envelope xmlns="http://schemas.dmtf.org/ovf/envelope/1" '
+        'xmlns:ovf="http://schemas.dmtf.org/ovf/envelope/1" '
+        'xmlns:rasd="http://schemas.dmtf.org/wbem/wscim/1/cim-schema/2/'
+        'CIM_ResourceAllocationSettingData"><References>%s</References>'
+        '<DiskSection><Info>disks</Info>%s</DiskSection>'
+        '<VirtualSystemCollection ovf:id="collection">%s'
+        '</VirtualSystemCollection></Envelope>' %
+        (''.join(files), ''.join(disks), ''.join(vss)))
+
+def bestOf(repeat, func, *args):
+    """
+    Run func repeat times and return the best wall clock time.
+
+    @return: seconds
+    @rtype: float
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        func(*args)
+        elapsed = time.time() - start
+        if best == None or elapsed < best:
+            best = elapsed
+    return best
+
+def report(name, seconds, count=None, unit='item'):
+    """Print one benchmark line."""
+    line = "%-40s %10.4fs" % (name, seconds)
+    if count:
+        line += "  %10.1f us/%s" % (seconds * 1e6 / count, unit)
+    print line
+
+def benchSerialize(options):
+    """Serialize a large envelope to a string and to a file."""
+    document = makeEnvelope(options.items)
+
+    report('minidom toxml (reference)',
+           bestOf(options.repeat, document.toxml), options.items)
+    report('Ovf.xmlString',
+           bestOf(options.repeat, Ovf.xmlString, document), options.items)
+
+    (fd, path) = tempfile.mkstemp()
+    os.close(fd)
+    def toFile():
+        fileObj = open(path, 'w')
+        Ovf.xwritexml(document, fileObj, '', '\t', '\n', 'UTF-8')
+        fileObj.close()
+    try:
+        report('Ovf.xwritexml pretty to file',
+               bestOf(options.repeat, toFile), options.items)
+    finally:
+        os.unlink(path)
+
+def _evalMemoryUnits(units):
+    """The eval() based PUnit conversion OvfLibvirt used to do, to kB."""
+    units = units.replace('^', '**').split(' ', 1)
+    units[0] = '2**-10'
+    return int(eval(' '.join(units)))
+
+def benchUnits(options):
+    """Convert --items memory quantities with mixed units to kB."""
+    quantities = [str(index % 4096 + 1) for index in range(options.items)]
+    units = ['byte * 2^20', 'byte * 2^30', 'MegaBytes', 'byte * 2^10']
+    units = [units[index % len(units)] for index in range(options.items)]
+
+    def legacy():
+        for (quantity, unit) in zip(quantities, units):
+            if unit.startswith('byte'):
+                int(quantity) * _evalMemoryUnits(unit)
+            else:
+                int(quantity) * 1024
+    def oneByOne():
+        for (quantity, unit) in zip(quantities, units):
+            Ovf.convertQuantity(quantity, unit, 'byte * 2^10')
+
+    report('eval per item (reference)',
+           bestOf(options.repeat, legacy), options.items)
+    report('Ovf.convertQuantity per item',
+           bestOf(options.repeat, oneByOne), options.items)
+    report('Ovf.convertQuantities',
+           bestOf(options.repeat, Ovf.convertQuantities, quantities, units,
+                  'byte * 2^10'), options.items)
+
+def benchProvision(options):
+    """Provision a per-Disk image from a --items MB shared image."""
+    directory = tempfile.mkdtemp()
+    image = os.path.join(directory, 'golden.img')
+    fileObj = open(image, 'wb')
+    chunk = '\x55' * (1024 * 1024)
+    for _ in range(options.items):
+        fileObj.write(chunk)
+    fileObj.close()
+
+    try:
+        for strategy in OvfProvision.STRATEGIES:
+            target = os.path.join(directory, 'golden-' + strategy + '.img')
+            try:
+                OvfProvision.provisionDisk(image, target, (strategy,))
+            except (IOError, OSError), e:
+                print "%-40s unavailable: %s" % (strategy, e)
+                continue
+            report(strategy, bestOf(options.repeat, OvfProvision.provisionDisk,
+                                    image, target, (strategy,)))
+    finally:
+        shutil.rmtree(directory)
+
+def benchConnections(options):
+    """Start --items domains through the fake libvirt binding."""
+    fakelibvirt.OPEN_DELAY = options.openDelay
+    xml = Ovf.xmlString(OvfLibvirt.domainElement('kvm'))
+    plain = [xml] * options.items
+    tagged = [OvfLibvirt.DomainXml(xml, 'kvm')] * options.items
+
+    def legacy():
+        # parse for the type and open a connection per domain
+        for domainXml in plain:
+            domainType = OvfLibvirt.getDomainType(domainXml)
+            uri = OvfLibvirt.getConnectionStringForVirtType(domainType)
+            fakelibvirt.open(uri).createLinux(domainXml, 0)
+    def pooled():
+        pool = OvfLibvirt.ConnectionPool(fakelibvirt.open)
+        for domainXml in tagged:
+            OvfLibvirt.startDomain(domainXml, pool)
+
+    report('connection per domain (reference)',
+           bestOf(options.repeat, legacy), options.items, 'domain')
+    report('ConnectionPool + DomainXml',
+           bestOf(options.repeat, pooled), options.items, 'domain')
+
+def benchDomains(options):
+    """Generate the libvirt domains of a --systems VM collection."""
+    document = makeCollection(options.systems)
+    directory = tempfile.mkdtemp()
+    try:
+        report('getOvfDomains DOM',
+               bestOf(options.repeat, OvfLibvirt.getOvfDomains, document,
+                      directory, 'kvm', None, None, False),
+               options.systems, 'domain')
+        report('getOvfDomains template',
+               bestOf(options.repeat, OvfLibvirt.getOvfDomains, document,
+                      directory, 'kvm'), options.systems, 'domain')
+        cache = OvfLibvirt.DomainSpecCache()
+        digest = sha.new(document.toxml('UTF-8')).hexdigest()
+        cache.getSpecs(document, 'kvm', None, digest)
+        report('getOvfDomains cached',
+               bestOf(options.repeat, OvfLibvirt.getOvfDomains, document,
+                      directory, 'kvm', None, None, True, cache, digest),
+               options.systems, 'domain')
+    finally:
+        shutil.rmtree(directory)
+
+def getScriptCommands(path):
+    """
+    Returns the subcommands of a script, from its commands table.
+
+    @rtype: list of Strings
+    """
+    name = 'ovfbench_' + os.path.basename(path)
+    module = imp.load_source(name, path)
+    commands = getattr(module, 'COMMANDS', None) or getattr(module, 'commands')
+    names = commands.keys()
+    names.sort()
+    return names
+
+def getLoadedModules(path):
+    """
+    Returns the L{HEAVY_MODULES} a script loads before it runs a command.
+
+    @rtype: list of Strings
+    """
+    code = ('import imp, sys; imp.load_source("script", sys.argv[1]); '
+            'print " ".join([name for name in %r if name in sys.modules])' %
+            (HEAVY_MODULES,))
+    process = subprocess.Popen([sys.executable, '-c', code, path],
+                               stdout=subprocess.PIPE)
+    return process.communicate()[0].split()
+
+def benchStartup(options):
+    """Start each subcommand of each script, up to parsing its options."""
+    devnull = open(os.devnull, 'w')
+    def start(command):
+        subprocess.call(command, stdout=devnull, stderr=devnull)
+
+    try:
+        scripts = os.listdir(SCRIPTS_DIR)
+        scripts.sort()
+        for script in scripts:
+            path = os.path.join(SCRIPTS_DIR, script)
+            loaded = getLoadedModules(path)
+            print "%s loads %s" % (script, ', '.join(loaded) or 'none of ' +
+                                   ', '.join(HEAVY_MODULES))
+            for command in getScriptCommands(path):
+                report('%s --%s --help' % (script, command),
+                       bestOf(options.repeat, start,
+                              [sys.executable, path, '--' + command,
+                               '--help']))
+    finally:
+        devnull.close()
+
+BENCHMARKS = {
+    'domains' : (benchDomains,
+                 "libvirt XML for a collection of --systems VMs"),
+    'connections' : (benchConnections,
+                     "startDomain of --items domains on a fake libvirt"),
+    'provision' : (benchProvision,
+                   "overlay/reflink/copy of an --items MB disk image"),
+    'startup' : (benchStartup,
+                 "start every subcommand of the scripts with --help"),
+    'serialize' : (benchSerialize,
+                   "Ovf.xmlString/xwritexml on an envelope with --items Items"),
+    'units' : (benchUnits,
+               "DSP0004 unit conversion of --items quantities"),
+}
+
+def main():
+    """Parse the command line and run the selected benchmarks."""
+    usage = "usage: %prog [options] benchmark...\n\nbenchmarks:\n"
+    for name in sorted(BENCHMARKS.keys()):
+        usage += "  %-12s %s\n" % (name, BENCHMARKS[name][1])
+    parser = OptionParser(usage)
+    parser.add_option('-n', '--items', dest='items', type='int',
+                      default=10000, help="Items per envelope (10000)")
+    parser.add_option('-r', '--repeat', dest='repeat', type='int',
+                      default=3, help="runs per measurement, best is kept")
+    parser.add_option('-s', '--systems', dest='systems', type='int',
+                      default=1000, help="VirtualSystems per collection (1000)")
+    parser.add_option('--open-delay', dest='openDelay', type='float',
+                      default=0.002,
+                      help="seconds a fake libvirt open takes (0.002)")
+    (options, args) = parser.parse_args()
+
+    if not args:
+        args = sorted(BENCHMARKS.keys())
+    for name in args:
+        if not BENCHMARKS.has_key(name):
+            parser.error("unknown benchmark " + name)
+        print "== " + name
+        BENCHMARKS[name][0](options)
+
+if __name__ == "__main__":
+    main()
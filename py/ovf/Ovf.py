@@ -16,9 +16,44 @@ Module for interfacing to an OVF and XML
 """
 
 import os
+import Queue
+import re
 import sha
+import sys
+import threading
+import warnings
 from xml.dom import Node
 
+#: number of output pieces L{xwritexml} buffers before each write
+XML_BUFFER_SIZE = 4096
+
+_XML_SPECIAL = re.compile('[&<>"]')
+_XML_ENTITIES = {'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;'}
+
+#: one step of a path expression: separator, tag name and predicates
+_PATH_STEP = re.compile(r"""(//|/)?(\*|[\w:.-]+)"""
+                        r"""((?:\[(?:'[^']*'|"[^"]*"|[^\]'"])*\])*)""")
+_PATH_PREDICATE = re.compile(r"""\[\s*(?:(\d+)|(@?)([\w:.-]+)\s*"""
+                             r"""(?:=\s*(?:'([^']*)'|"([^"]*)"|([^\]]*?)))?)\s*\]""")
+#: compiled path expressions, see L{compilePath}
+_PATH_CACHE = {}
+
+#: one term of a DSP0004 programmatic unit: operator, number^exponent or unit
+_PUNIT_TERM = re.compile(r"\s*([*/])?\s*(?:([+-]?\d+)(?:\s*\^\s*([+-]?\d+))?"
+                         r"|([A-Za-z]+))\s*")
+#: deprecated DSP0004 unit qualifiers, as in "MegaBytes"
+_UNIT_QUALIFIER = re.compile(r"^(Kilo|Mega|Giga|Tera|Peta)?(Bytes|Bits|Hertz)$")
+#: unit qualifier prefix -> (binary factor, decimal factor)
+_UNIT_PREFIXES = {None: (1, 1), 'Kilo': (2**10, 10**3), 'Mega': (2**20, 10**6),
+                  'Giga': (2**30, 10**9), 'Tera': (2**40, 10**12),
+                  'Peta': (2**50, 10**15)}
+#: units that are converted to another base unit: unit -> (base, num, den)
+_UNIT_ALIASES = {'bit': ('byte', 1, 8), 'bits': ('byte', 1, 8),
+                 'bytes': ('byte', 1, 1), 'octet': ('byte', 1, 1),
+                 'octets': ('byte', 1, 1)}
+#: compiled unit factors, see L{getUnitFactor}
+_UNIT_CACHE = {}
+
 def createTextDescriptionOfNodeList(nodeList):
     """
     This function will get information from a list of nodes and return a list
@@ -89,10 +124,26 @@ def rmNodeAttributes(node, attributeList=[], strict=False):
         for attribute in attributeList:
             node.removeAttribute(attribute)
 
-def getDefaultConfiguration(ovfDoc):
+def getDefaultConfiguration(ovfDoc, index=None):
     """
     Returns identifier for the default configuration
+
+    @param ovfDoc: OVF document
+    @type ovfDoc: DOM Document
+
+    @param index: L{element index<indexElements>} of ovfDoc, to avoid
+                  walking the document
+    @type index: dict
     """
+    if index != None:
+        configurations = index.get('Configuration', [])
+        for configuration in configurations:
+            if hasAttribute(configuration, 'ovf:default', "true"):
+                return configuration.attributes['ovf:id'].value
+        if configurations:
+            return configurations[0].attributes['ovf:id'].value
+        return None
+
     # first check if ovf specifies a default configuration
     defaultConfigurationNode = getNodes(ovfDoc, (hasTagName, 'Configuration'),
                                         (hasAttribute, 'ovf:default', "true"))
@@ -343,6 +394,228 @@ def getElementsById(ovfNode, tagName, identValue):
     return getElementsByTagName(ovfNode, tagName,
                                 (hasAttribute, attrName, identValue))
 
+def compilePath(expr):
+    """
+    Compiles a path expression for L{selectNodes}.  The expression is a
+    list of steps separated by '/' (children) or '//' (descendants).  The
+    first step matches descendants of the node the expression is run on,
+    unless the expression starts with '/' or '//'.  Each step is a tag
+    name, or '*' for any element, followed by any number of predicates::
+
+        [@attr=value]   the element has the attribute with the value
+        [@attr]         the element has the attribute
+        [child=value]   the element has a child with the text value
+        [child]         the element has a child with the tag name
+        [n]             the n'th match (1 based) within each parent
+
+    Values may be quoted with ' or ".  For example::
+
+        VirtualSystem[@ovf:id=web]/VirtualHardwareSection/Item[rasd:ResourceType=17]
+
+    Compiled expressions are cached, so callers do not need to keep them.
+
+    @raise ValueError: expr is not a valid path expression
+
+    @param expr: path expression
+    @type expr: String
+
+    @return: list of (descendant, tagName, predicates) steps
+    @rtype: list of tuples
+    """
+    steps = _PATH_CACHE.get(expr)
+    if steps != None:
+        return steps
+
+    steps = []
+    pos = 0
+    while pos < len(expr):
+        match = _PATH_STEP.match(expr, pos)
+        if match == None or match.end() == pos:
+            raise ValueError("Invalid path expression at offset %d: %s" %
+                             (pos, expr))
+        (separator, tagName, predicateText) = match.groups()
+        if steps and separator == None:
+            raise ValueError("Missing '/' at offset %d: %s" % (pos, expr))
+        descendant = (separator != '/')
+
+        predicates = []
+        predPos = 0
+        while predPos < len(predicateText):
+            predMatch = _PATH_PREDICATE.match(predicateText, predPos)
+            if predMatch == None:
+                raise ValueError("Invalid predicate %s in: %s" %
+                                 (predicateText[predPos:], expr))
+            (position, attr, name, single, double, bare) = predMatch.groups()
+            if position != None:
+                predicates.append(('position', int(position), None))
+            else:
+                value = single
+                if value == None:
+                    value = double
+                if value == None:
+                    value = bare
+                if attr:
+                    predicates.append(('attribute', name, value))
+                else:
+                    predicates.append(('child', name, value))
+            predPos = predMatch.end()
+
+        steps.append((descendant, tagName, tuple(predicates)))
+        pos = match.end()
+
+    if not steps:
+        raise ValueError("Empty path expression")
+
+    _PATH_CACHE[expr] = steps
+    return steps
+
+def indexElements(ovfNode):
+    """
+    Returns a dictionary of tag name to the elements below ovfNode with
+    that tag name, in document order.  The index can be given to
+    L{selectNodes} to avoid walking the tree for each descendant step.
+
+    @param ovfNode: OVF document or element
+    @type ovfNode: DOM Node
+
+    @return: tag name -> list of elements
+    @rtype: dict
+    """
+    index = {}
+    stack = [ovfNode]
+    while stack:
+        node = stack.pop()
+        children = node.childNodes
+        for i in range(len(children) - 1, -1, -1):
+            child = children[i]
+            if child.nodeType == Node.ELEMENT_NODE:
+                stack.append(child)
+        if node is not ovfNode and node.nodeType == Node.ELEMENT_NODE:
+            if index.has_key(node.tagName):
+                index[node.tagName].append(node)
+            else:
+                index[node.tagName] = [node]
+    return index
+
+def selectNodes(ovfNode, expr, index=None):
+    """
+    Returns the elements matched by the path expression expr, run against
+    ovfNode.  See L{compilePath} for the syntax.
+
+    @raise ValueError: expr is not a valid path expression
+
+    @param ovfNode: OVF document or element
+    @type ovfNode: DOM Node
+
+    @param expr: path expression
+    @type expr: String
+
+    @param index: index from L{indexElements} for the document ovfNode is
+                  part of.  Descendant steps are looked up in it instead of
+                  walking the tree.
+    @type index: dict
+
+    @return: matching elements, in document order within each step
+    @rtype: list of DOM Nodes
+    """
+    context = [ovfNode]
+    for (descendant, tagName, predicates) in compilePath(expr):
+        matched = []
+        seen = {}
+        for node in context:
+            if descendant:
+                candidates = _filterPerParent(
+                    _getDescendants(node, tagName, index), predicates)
+            else:
+                candidates = [child for child in node.childNodes
+                              if child.nodeType == Node.ELEMENT_NODE and
+                              (tagName == '*' or child.tagName == tagName)]
+                for predicate in predicates:
+                    candidates = _filterPredicate(candidates, predicate)
+            for candidate in candidates:
+                if not seen.has_key(id(candidate)):
+                    seen[id(candidate)] = True
+                    matched.append(candidate)
+        context = matched
+    return context
+
+def _getDescendants(node, tagName, index):
+    """
+    Returns the elements below node with the given tag name ('*' for all),
+    from index when one is given.
+    """
+    if index == None or tagName == '*':
+        return node.getElementsByTagName(tagName)
+
+    candidates = index.get(tagName, [])
+    if node.nodeType == Node.DOCUMENT_NODE:
+        return candidates
+    ret = []
+    for candidate in candidates:
+        parent = candidate.parentNode
+        while parent != None and parent is not node:
+            parent = parent.parentNode
+        if parent is node:
+            ret.append(candidate)
+    return ret
+
+def _filterPerParent(candidates, predicates):
+    """
+    Returns the candidates that pass the compiled predicates, applied to
+    the candidates of each parent separately, so that positions count
+    within each parent as they do on a child step.
+    """
+    if not predicates:
+        return candidates
+
+    groups = {}
+    for candidate in candidates:
+        key = id(candidate.parentNode)
+        if groups.has_key(key):
+            groups[key].append(candidate)
+        else:
+            groups[key] = [candidate]
+
+    kept = {}
+    for group in groups.values():
+        for predicate in predicates:
+            group = _filterPredicate(group, predicate)
+        for candidate in group:
+            kept[id(candidate)] = True
+    return [candidate for candidate in candidates
+            if kept.has_key(id(candidate))]
+
+def _filterPredicate(candidates, predicate):
+    """
+    Returns the candidates that pass one compiled predicate.
+    """
+    (kind, name, value) = predicate
+    if kind == 'position':
+        return candidates[name - 1:name]
+
+    ret = []
+    for candidate in candidates:
+        if kind == 'attribute':
+            if candidate.hasAttribute(name) and (value == None or
+                                candidate.getAttribute(name) == value):
+                ret.append(candidate)
+        else:
+            for child in candidate.childNodes:
+                if(child.nodeType == Node.ELEMENT_NODE and
+                   child.tagName == name and
+                   (value == None or _getText(child).strip() == value)):
+                    ret.append(candidate)
+                    break
+    return ret
+
+def _getText(node):
+    """
+    Returns the text directly inside node.
+    """
+    return ''.join([child.data for child in node.childNodes
+                    if child.nodeType in (Node.TEXT_NODE,
+                                          Node.CDATA_SECTION_NODE)])
+
 def getContentEntities(ovfNode, ovfId=None, vs=True, vsc=True):
     """
     Returns a list of OVF Entities, optionally restricted by id and
@@ -542,7 +815,7 @@ def isVirtualSystemCollection(ovfDoc, ovfId):
                     (hasTagName, 'VirtualSystemCollection'),
                     (hasAttribute, 'ovf:id', ovfId)) != [])
 
-def isConfiguration(ovfDoc, configId):
+def isConfiguration(ovfDoc, configId, index=None):
     """
     Verifies whether a configuration is defined in the ovf.
 
@@ -552,13 +825,20 @@ def isConfiguration(ovfDoc, configId):
     @param configId: configuration name
     @type configId: String
 
+    @param index: L{element index<indexElements>} of ovfDoc, to avoid
+                  walking the document
+    @type index: dict
+
     @return: tests if configuration exists
     @rtype: boolean
 
     @raise ValueError: ConfigId doesn't match any in DeploymentOptions
     @raise NotImplementedError: DeploymentOptions not defined
     """
-    deploy = getNodes(ovfDoc, (hasTagName, 'DeploymentOptionSection'))
+    if index != None:
+        deploy = index.get('DeploymentOptionSection', [])
+    else:
+        deploy = getNodes(ovfDoc, (hasTagName, 'DeploymentOptionSection'))
     if deploy != []:
         configList = getDict(deploy[0])['children']
         while configList != []:
@@ -571,6 +851,202 @@ def isConfiguration(ovfDoc, configId):
         # may want to throw different error if doesn't exist
         raise NotImplementedError("Ovf.isConfiguration: No configurations found.")
 
+def getUnitFactor(units):
+    """
+    Parses a DSP0004 programmatic unit, as used by rasd:AllocationUnits and
+    ovf:capacityAllocationUnits, and returns its base unit and factor.  A
+    quantity in units is quantity * numerator / denominator base units.
+    Bits are counted as 1/8 byte, so that both share the base unit 'byte'.
+    The following forms are accepted::
+
+        byte * 2^20             programmatic unit
+        bit / second * 10^3     programmatic unit of a rate
+        percent                 plain unit
+        MegaBytes               deprecated unit qualifier
+
+    Results are cached, so the string is parsed once per process.
+
+    @raise ValueError: units is not a valid unit
+
+    @param units: unit string
+    @type units: String
+
+    @return: (base unit, numerator, denominator)
+    @rtype: tuple
+    """
+    factor = _UNIT_CACHE.get(units)
+    if factor != None:
+        return factor
+
+    qualifier = _UNIT_QUALIFIER.match(units.strip())
+    if qualifier != None:
+        (prefix, unit) = qualifier.groups()
+        if unit == 'Hertz':
+            factor = _reduceFactor('hertz', _UNIT_PREFIXES[prefix][1], 1)
+        elif unit == 'Bits':
+            factor = _reduceFactor('byte', _UNIT_PREFIXES[prefix][0], 8)
+        else:
+            factor = _reduceFactor('byte', _UNIT_PREFIXES[prefix][0], 1)
+        warnings.warn("DSP0004 v2.5.0: use PUnit Qualifiers",
+                      DeprecationWarning)
+    else:
+        factor = _parseProgrammaticUnit(units)
+
+    _UNIT_CACHE[units] = factor
+    return factor
+
+def _parseProgrammaticUnit(units):
+    """
+    Parses the programmatic unit form for L{getUnitFactor}.
+    """
+    numerator = 1
+    denominator = 1
+    upper = []
+    lower = []
+    pos = 0
+    while pos < len(units):
+        match = _PUNIT_TERM.match(units, pos)
+        if match == None or match.end() == pos:
+            raise ValueError("Invalid programmatic unit: " + units)
+        (operator, number, exponent, unit) = match.groups()
+        if (operator == None) != (pos == 0):
+            raise ValueError("Invalid programmatic unit: " + units)
+        pos = match.end()
+
+        divide = (operator == '/')
+        if unit != None:
+            (unit, num, den) = _UNIT_ALIASES.get(unit, (unit, 1, 1))
+            if divide:
+                (num, den) = (den, num)
+                lower.append(unit)
+            else:
+                upper.append(unit)
+        else:
+            (num, den) = (int(number), 1)
+            if exponent != None:
+                exponent = int(exponent)
+                (num, den) = (num ** abs(exponent), 1)
+                if exponent < 0:
+                    (num, den) = (den, num)
+            if num == 0:
+                raise ValueError("Invalid programmatic unit: " + units)
+            if divide:
+                (num, den) = (den, num)
+        numerator *= num
+        denominator *= den
+
+    if not upper:
+        raise ValueError("Programmatic unit without a base unit: " + units)
+
+    base = ' * '.join(upper)
+    for unit in lower:
+        base += ' / ' + unit
+    return _reduceFactor(base, numerator, denominator)
+
+def _reduceFactor(base, numerator, denominator):
+    """
+    Returns (base, numerator, denominator) with the fraction reduced.
+    """
+    (a, b) = (numerator, denominator)
+    while b:
+        (a, b) = (b, a % b)
+    return (base, numerator / a, denominator / a)
+
+def convertQuantity(quantity, units, toUnits='byte'):
+    """
+    Converts a quantity between two compatible units, see L{getUnitFactor}.
+    For example, convertQuantity('256', 'MegaBytes', 'byte * 2^10') is
+    262144.
+
+    @raise ValueError: quantity is not a number, a unit is invalid or the
+                       units have different base units
+
+    @param quantity: amount in units
+    @type quantity: String or number
+
+    @param units: unit of quantity
+    @type units: String
+
+    @param toUnits: unit of the result
+    @type toUnits: String
+
+    @return: amount in toUnits, an integer when the conversion is exact
+    @rtype: long or float
+    """
+    return convertQuantities([quantity], units, toUnits)[0]
+
+def convertQuantities(quantities, units, toUnits='byte'):
+    """
+    Converts a list of quantities to toUnits.  The conversion factor is
+    worked out once per distinct unit, which makes this the fast way to sum
+    up many Items.
+
+    @raise ValueError: a quantity is not a number, or is negative, infinite
+                       or NaN, a unit is invalid or the units have different
+                       base units
+
+    @param quantities: amounts
+    @type quantities: list of Strings or numbers
+
+    @param units: unit of all quantities, or a list with the unit of each
+    @type units: String or list of Strings
+
+    @param toUnits: unit of the results
+    @type toUnits: String
+
+    @return: amounts in toUnits, integers when the conversion is exact
+    @rtype: list
+    """
+    (toBase, toNum, toDen) = getUnitFactor(toUnits)
+    factors = {}
+    if isinstance(units, basestring):
+        units = [units] * len(quantities)
+    elif len(units) != len(quantities):
+        raise ValueError("Need one unit per quantity.")
+
+    ret = []
+    for (quantity, unit) in zip(quantities, units):
+        factor = factors.get(unit)
+        if factor == None:
+            (base, num, den) = getUnitFactor(unit)
+            if base != toBase:
+                raise ValueError("Cannot convert " + unit + " to " + toUnits)
+            factor = (num * toDen, den * toNum)
+            factors[unit] = factor
+        (num, den) = factor
+
+        if isinstance(quantity, basestring):
+            try:
+                quantity = long(quantity)
+            except ValueError:
+                quantity = float(quantity)
+        # NaN and infinity are the numbers that do not give 0 this way
+        if quantity < 0 or quantity - quantity != 0:
+            raise ValueError("Not a quantity: " + str(quantity))
+        value = quantity * num
+        if isinstance(value, float) or value % den:
+            ret.append(value / float(den))
+        else:
+            ret.append(value / den)
+    return ret
+
+def getDiskCapacity(disk):
+    """
+    Returns the capacity of a Disk element in bytes, using its
+    ovf:capacityAllocationUnits (byte if not given).
+
+    @raise ValueError: the capacity is not a number, for example a
+                       ${property} reference, or the units are not valid
+
+    @param disk: Disk element
+    @type disk: DOM Element
+
+    @return: capacity in bytes
+    @rtype: long
+    """
+    units = disk.getAttribute('ovf:capacityAllocationUnits') or 'byte'
+    return convertQuantity(disk.getAttribute('ovf:capacity'), units)
+
 def sha1sumFile(path):
     """
     This will give the sha1sum of a given file in hex.
@@ -640,6 +1116,57 @@ def href2abspath(href, base=None):
         filePath = None
     return(filePath)
 
+def runPool(function, jobs, workers=1):
+    """
+    Calls function with each (key, argument) of jobs on up to workers
+    threads, taking the jobs in order.  After the first error no more jobs
+    are taken, and the running ones are waited for.
+
+    @param function: called with key and argument, returns the result
+    @type function: function
+
+    @param jobs: (key, argument) of each job
+    @type jobs: list of tuples
+
+    @param workers: number of threads, 1 runs the jobs in this thread
+    @type workers: int
+
+    @return: (key to the result of each job that finished, sys.exc_info()
+             of the first error or None)
+    @rtype: tuple
+    """
+    queue = Queue.Queue()
+    for job in jobs:
+        queue.put(job)
+    results = {}
+    errors = []
+
+    def worker():
+        while not errors:
+            try:
+                (key, argument) = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[key] = function(key, argument)
+            except:
+                errors.append(sys.exc_info())
+
+    if workers <= 1 or len(jobs) <= 1:
+        worker()
+    else:
+        threads = []
+        for i in range(min(workers, len(jobs))):
+            thread = threading.Thread(target=worker)
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+    if errors:
+        return (results, errors[0])
+    return (results, None)
+
 def xmlString(obj, indent="", newline="", encoding='UTF-8'):
     """
     Wrapper function: Returns a String representing the
@@ -660,25 +1187,60 @@ def xmlString(obj, indent="", newline="", encoding='UTF-8'):
     @return: XML document
     @rtype: String
     """
-    from StringIO import StringIO
+    chunks = []
+    _serialize(obj, chunks.append, indent, indent, newline, encoding)
+    return ''.join(chunks)
 
-    buf = StringIO()
-    xwritexml(obj, buf, indent, indent, newline, encoding)
-    return buf.getvalue()
+def xwritexml(obj, writer, indent="", addindent="", newl="", encoding=None,
+              bufferSize=XML_BUFFER_SIZE, skipWhitespace=False):
+    """
+    Write the DOM object to writer.  The output is collected in memory and
+    handed to the writer in blocks of about bufferSize pieces, so a small
+    document costs a single write call and a large one is streamed.
+
+    @param obj: any DOM Node
+    @type obj: DOM Object
+
+    @param writer: destination, a file-like object with write() or a
+                   socket-like object with sendall()
+    @type writer: file or socket
+
+    @param indent: current indentation
+    @type indent: String
 
-def xwritexml(obj, writer, indent="", addindent="", newl="", encoding=None):
-    func = None
-    if   obj.nodeType == Node.DOCUMENT_NODE:
-        func = document_writexml
-    elif obj.nodeType == Node.ELEMENT_NODE :
-        func = element_writexml
-    elif obj.nodeType == Node.TEXT_NODE    :
-        func = text_writexml
+    @param addindent: indentation to add to higher levels
+    @type addindent: String
 
-    if func != None:
-        func(obj, writer, indent, addindent, newl, encoding)
+    @param newl: newline string
+    @type newl: String
+
+    @param encoding: character encoding declared in the XML header
+    @type encoding: String
+
+    @param bufferSize: number of pieces buffered before each write
+    @type bufferSize: int
+
+    @param skipWhitespace: leave out whitespace-only text nodes, giving the
+                           output of L{remove_whitespace_nodes} without
+                           modifying the tree
+    @type skipWhitespace: boolean
+    """
+    if hasattr(writer, 'write'):
+        write = writer.write
     else:
-        obj.writexml(writer, indent, addindent, newl)
+        write = writer.sendall
+
+    chunks = []
+    def collect(data):
+        chunks.append(data)
+        if len(chunks) >= bufferSize:
+            write(''.join(chunks))
+            del chunks[:]
+
+    _serialize(obj, collect, indent, addindent, newl, encoding,
+               skipWhitespace)
+    if chunks:
+        write(''.join(chunks))
 
 def remove_whitespace_nodes(node):
     """
@@ -699,68 +1261,103 @@ def remove_whitespace_nodes(node):
         node.parentNode.removeChild(node)
         node.unlink( )
 
+def xmlEscape(data):
+    """
+    Returns data with the XML special characters (&, <, >, ") replaced by
+    entity references.  Text without special characters is returned as is.
+
+    @param data: character data
+    @type data: String
 
-## the following is taken and modified /usr/lib/python2.5/xml/dom/minidom.py
-## the xwritexml is just a copied writexml function that calls
-## the versions copied 'writexml' functions here rather than the
-## ones provided by the library.  For nodes other than those needed
-## it will call the functions provided by the library
-##
-## BEGIN COPY / MODIFY from /usr/lib/python2.5/xml/dom/minidom.py
-
-## def _write_data
-def _xwrite_data(writer, data):
-    "Writes datachars to writer."
-    data = data.replace("&", "&amp;").replace("<", "&lt;")
-    data = data.replace("\"", "&quot;").replace(">", "&gt;")
-    writer.write(data)
-
-## class Element(Node):
-## def writexml(self, writer, indent="", addindent="", newl=""):
-def element_writexml(self, writer, indent="", addindent="", newl="",
-                     encoding=None):
-    # indent = current indentation
-    # addindent = indentation to add to higher levels
-    # newl = newline string
-    writer.write(indent + "<" + self.tagName)
-
-    attrs = self._get_attributes()
-    a_names = attrs.keys()
-    a_names.sort()
-
-    for a_name in a_names:
-        writer.write(" %s=\"" % a_name)
-        _xwrite_data(writer, attrs[a_name].value)
-        writer.write("\"")
-    if self.childNodes:
-        if(self.childNodes[0].nodeType == Node.TEXT_NODE):
-            writer.write(">")
-        else:
-            writer.write(">%s"%(newl))
-        for node in self.childNodes:
-            xwritexml(node, writer, indent + addindent, addindent, newl, encoding)
-        if(self.childNodes[0].nodeType == Node.TEXT_NODE):
-            writer.write("</%s>%s" %(self.tagName, newl))
-        else:
-            writer.write("%s</%s>%s" % (indent, self.tagName, newl))
-    else:
-        writer.write("/>%s"%(newl))
-
-## class Document(Node, DocumentLS):
-## def writexml(self, writer, indent="", addindent="", newl="",
-def document_writexml(self, writer, indent="", addindent="", newl="",
-                      encoding=None):
-    if encoding is None:
-        writer.write('<?xml version="1.0" ?>'+newl)
-    else:
-        writer.write('<?xml version="1.0" encoding="%s"?>%s' % (encoding, newl))
-    for node in self.childNodes:
-        xwritexml(node, writer, indent, addindent, newl)
+    @return: escaped data
+    @rtype: String
+    """
+    if _XML_SPECIAL.search(data) is None:
+        return data
+    return _XML_SPECIAL.sub(_xmlEscapeMatch, data)
 
+def _xmlEscapeMatch(match):
+    """Returns the entity reference for a special character match."""
+    return _XML_ENTITIES[match.group()]
 
-## class Text(CharacterData):
-## def writexml(self, writer, indent="", addindent="", newl=""):
-def text_writexml(self, writer, indent="", addindent="", newl="", encoding=None):
-    _xwrite_data(writer, self.data)
+class _CallWriter:
+    """Adapts a write callable to the writer interface of minidom."""
 
-## END COPY / MODIFY from /usr/lib/python2.5/xml/dom/minidom.py
+    def __init__(self, write):
+        self.write = write
+
+def _serialize(obj, write, indent, addindent, newl, encoding,
+               skipWhitespace=False):
+    """
+    Serialize a DOM node, handing each piece of output to write.
+
+    The format matches the pretty format of minidom's writexml, except
+    that attributes are sorted and text children are not indented.  The
+    tree is walked with an explicit stack, so deep documents do not
+    recurse.
+
+    @param obj: any DOM Node
+    @type obj: DOM Object
+
+    @param write: called with each piece of output
+    @type write: callable
+
+    @param skipWhitespace: leave out whitespace-only text nodes
+    @type skipWhitespace: boolean
+    """
+    elementNode = Node.ELEMENT_NODE
+    textNode = Node.TEXT_NODE
+
+    # stack of (node, indentation) pairs, node None means the indentation
+    # slot holds a closing tag that is written as is
+    stack = [(obj, indent)]
+    pop = stack.pop
+    push = stack.append
+    while stack:
+        node, curIndent = pop()
+        if node is None:
+            write(curIndent)
+            continue
+
+        nodeType = node.nodeType
+        if nodeType == textNode:
+            write(xmlEscape(node.data))
+        elif nodeType == elementNode:
+            tagName = node.tagName
+            attrs = node._attrs
+            if attrs:
+                names = attrs.keys()
+                names.sort()
+                write(curIndent + "<" + tagName +
+                      ''.join([' %s="%s"' % (name, xmlEscape(attrs[name].value))
+                               for name in names]))
+            else:
+                write(curIndent + "<" + tagName)
+
+            children = node.childNodes
+            if skipWhitespace and children:
+                children = [child for child in children
+                            if child.nodeType != textNode or
+                               child.data.strip()]
+            if children:
+                if children[0].nodeType == textNode:
+                    write(">")
+                    push((None, "</%s>%s" % (tagName, newl)))
+                else:
+                    write(">" + newl)
+                    push((None, "%s</%s>%s" % (curIndent, tagName, newl)))
+                childIndent = curIndent + addindent
+                for child in reversed(children):
+                    push((child, childIndent))
+            else:
+                write("/>" + newl)
+        elif nodeType == Node.DOCUMENT_NODE:
+            if encoding is None:
+                write('<?xml version="1.0" ?>' + newl)
+            else:
+                write('<?xml version="1.0" encoding="%s"?>%s' %
+                      (encoding, newl))
+            for child in reversed(node.childNodes):
+                push((child, curIndent))
+        else:
+            node.writexml(_CallWriter(write), curIndent, addindent, newl)
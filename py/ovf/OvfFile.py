@@ -11,6 +11,7 @@
 ##############################################################################
 from xml.dom.minidom import parse, Document
 import os.path
+import sha
 
 import OvfReferencedFile
 import Ovf
@@ -46,6 +47,153 @@ class OvfFile:
             self.setFilesFromOvfFileReferences()
             self.version = OVF_VERSION
 
+        #: (pretty, encoding) -> [data, digest] of the last serialization
+        self._serialized = {}
+        #: absolute path -> (size, mtime, [data, digest]) of the last
+        #: writeFile to that path
+        self._written = {}
+
+    def _serialize(self, pretty, encoding):
+        """
+        Serializes the current document.  The previous serialization with
+        the same settings is kept along with its sha1, so that the digest
+        of an unchanged document is not computed again (see L{getDigest}).
+
+        @return: [data, digest], the digest is None until it is needed
+        @rtype: list
+        """
+        if pretty:
+            chunks = []
+            Ovf.xwritexml(self.document, _ChunkWriter(chunks), '', '\t',
+                          '\n', encoding, skipWhitespace=True)
+            data = ''.join(chunks)
+        else:
+            data = self.document.toxml()
+        if isinstance(data, unicode):
+            data = data.encode(encoding or 'UTF-8')
+
+        key = (pretty, encoding)
+        entry = self._serialized.get(key)
+        if entry == None or entry[0] != data:
+            entry = [data, None]
+            self._serialized[key] = entry
+        return entry
+
+    def _getEntryDigest(self, entry):
+        """Returns the sha1 of a L{_serialize} entry, computed once."""
+        if entry[1] == None:
+            entry[1] = sha.new(entry[0]).hexdigest()
+        return entry[1]
+
+    def serialize(self, pretty=True, encoding=None):
+        """
+        Returns the current document as written by L{writeFile}.
+
+        @param pretty: if True format/indent (writexml) False = toxml()
+        @type  pretty: Boolean
+
+        @param encoding: The encoding used for the XML.
+        @type encoding: String
+
+        @return: serialized document
+        @rtype: String
+        """
+        return self._serialize(pretty, encoding)[0]
+
+    def getDigest(self, pretty=True, encoding=None):
+        """
+        Returns the sha1 of L{serialize}, in hex.  The document is always
+        serialized; the hash is only computed again if the result differs
+        from the previous one.
+
+        @param pretty: if True format/indent (writexml) False = toxml()
+        @type  pretty: Boolean
+
+        @param encoding: The encoding used for the XML.
+        @type encoding: String
+
+        @return: sha1sum of the serialized document in hex
+        @rtype: String
+        """
+        return self._getEntryDigest(self._serialize(pretty, encoding))
+
+    def validate(self, schema, handler=None):
+        """
+        Validates the current document against a schema as it is in
+        memory, serializing it (see L{serialize}) without writing it.
+
+        @param schema: path to the schema
+        @type  schema: String
+
+        @param handler: collects the error and warning messages
+        @type  handler: L{ErrorHandler<ovf.validation.ErrorHandler>}
+
+        @return: Error Code. 0 (zero) is OK.
+        @rtype: int
+        """
+        # libxml2 is only needed to validate
+        import validation
+        return validation.validateDocument(schema, self.serialize(), handler,
+                                           self.path)
+
+    def getChecksum(self, path=None):
+        """
+        Returns the sha1 of the .ovf file at path, as needed for a manifest.
+        If the file was last written by L{writeFile} and its size and
+        modification time are unchanged on disk, the digest of the bytes
+        written is used and the file is not read.
+
+        @param path: the .ovf file.  Default is self.path
+        @type path: String
+
+        @return: sha1sum of the file in hex
+        @rtype: String
+        """
+        if path == None:
+            path = self.path
+        path = os.path.abspath(path)
+
+        written = self._written.get(path)
+        if written != None:
+            (size, mtime, entry) = written
+            stat = os.stat(path)
+            if stat.st_size == size and stat.st_mtime == mtime:
+                return self._getEntryDigest(entry)
+
+        return Ovf.sha1sumFile(path)
+
+    def getIndex(self):
+        """
+        Returns the tag name index of the current document, see
+        L{Ovf.indexElements}.  The index is made on each call, and is only
+        valid until the document is changed.
+
+        @return: tag name -> list of elements
+        @rtype: dict
+        """
+        return Ovf.indexElements(self.document)
+
+    def selectNodes(self, expr, index=None):
+        """
+        Returns the elements of the document matched by the path expression
+        expr.  See L{Ovf.compilePath} for the syntax.
+
+        @raise ValueError: expr is not a valid path expression
+
+        @param expr: path expression
+        @type expr: String
+
+        @param index: index of the current document from L{getIndex}, made
+                      if not given
+        @type index: dict
+
+        @return: matching elements
+        @rtype: list of DOM Nodes
+        """
+        if index == None:
+            index = self.getIndex()
+        return Ovf.selectNodes(self.document, expr, index)
+
     def addReferencedFile(self, refFileObj):
         """
         This method will add a OvfReferencedFile
@@ -106,14 +254,27 @@ class OvfFile:
             fileObj = open(self.path, "w")
             needClose = True
 
-        if pretty:
-            Ovf.remove_whitespace_nodes(self.document)
-            Ovf.xwritexml(self.document, fileObj, '', '\t', '\n', encoding)
-        else:
-            fileObj.write(self.document.toxml())
+        # only a write to the start of a named file can be matched with the
+        # file later on, see getChecksum
+        name = getattr(fileObj, 'name', None)
+        try:
+            if fileObj.tell() != 0:
+                name = None
+        except (AttributeError, IOError):
+            name = None
+
+        entry = self._serialize(pretty, encoding)
+        fileObj.write(entry[0])
 
         if needClose:
             fileObj.close()
+        else:
+            fileObj.flush()
+
+        if isinstance(name, basestring) and os.path.isfile(name):
+            stat = os.stat(name)
+            self._written[os.path.abspath(name)] = (stat.st_size,
+                                                   stat.st_mtime, entry)
 
 
     def syncReferencedFilesToDom(self):
@@ -224,8 +385,13 @@ class OvfFile:
                 - I{B{Case 3:}} The format is not passed in as part
                 of the diskDictList.
 
-        @raise ValueError: If a disk with a parentRef is added but the parent
-                            disk with the given id does not exist.
+        @raise ValueError: The possible cases are as follow
+                - I{B{Case 1:}} A disk with a parentRef is added but the
+                parent disk with the given id does not exist.
+                - I{B{Case 2:}} capacityAllocUnits is not a byte based
+                programmatic unit (see L{Ovf.getUnitFactor}).
+                - I{B{Case 3:}} The capacity or populatedSize is not a
+                number.  A ${property} reference is accepted for capacity.
 
         @param diskList: Is a list of dictionaries that contains the
                             information of the individual disks.
@@ -292,8 +458,13 @@ class OvfFile:
                 - I{B{Case 3:}} The format is not passed in as part
                 of the diskDictList.
 
-        @raise ValueError: If a disk with a parentRef is added but the parent
-                            disk with the given id does not exist.
+        @raise ValueError: The possible cases are as follow
+                - I{B{Case 1:}} A disk with a parentRef is added but the
+                parent disk with the given id does not exist.
+                - I{B{Case 2:}} capacityAllocUnits is not a byte based
+                programmatic unit (see L{Ovf.getUnitFactor}).
+                - I{B{Case 3:}} The capacity or populatedSize is not a
+                number.  A ${property} reference is accepted for capacity.
 
         @type diskDictList: List of dictionaries of disks.
             - The dictionaries MUST contain:
@@ -337,6 +508,7 @@ class OvfFile:
                     fileAdded.append(child.getAttribute(ovfDiskId))
 
             for disk in diskDictList:
+                _checkDiskSizes(disk)
                 for child in node.childNodes:
                     if child.nodeName == 'Disk':
                         if child.getAttribute(ovfDiskId) == disk['diskId']:
@@ -1676,6 +1848,28 @@ class OvfFile:
 
         node.appendChild(captionElement)
 
+def _checkDiskSizes(disk):
+    """
+    Checks the capacity, capacityAllocUnits and populatedSize of a disk
+    dictionary passed to L{OvfFile.addDisk}.
+
+    @raise ValueError: a value is not valid
+    """
+    units = disk['capacityAllocUnits'] or 'byte'
+    if Ovf.getUnitFactor(units)[0] != 'byte':
+        raise ValueError("capacityAllocationUnits must be in bytes: " + units)
+    capacity = disk['capacity']
+    if capacity != None and not capacity.startswith('${'):
+        Ovf.convertQuantity(capacity, units)
+    if disk['populatedSize'] != None:
+        Ovf.convertQuantity(disk['populatedSize'], 'byte')
+
+class _ChunkWriter:
+    """Writer that collects everything written into a list."""
+
+    def __init__(self, chunks):
+        self.write = chunks.append
+
 def getReferencedFilesFromOvf(envelope, path=None):
     """
     Return a list of OvfReferencedFile objects that are referenced
@@ -0,0 +1,366 @@
+# vi: ts=4 expandtab syntax=python
+##############################################################################
+# Copyright (c) 2008 IBM Corporation
+# All rights reserved. This program and the accompanying materials
+# are made available under the terms of the Eclipse Public License v1.0
+# which accompanies this distribution, and is available at
+# http://www.eclipse.org/legal/epl-v10.html
+#
+##############################################################################
+"""
+ISO 9660 images with Joliet and Rock Ridge extensions, made without an
+external program, for the few small files of the OVF environment
+transport (see L{OvfTransport.makeISOTransport}).
+
+All files are put in the root directory.  ISO 9660 itself only allows
+short upper case names, so each file gets an 8.3 name made from its own;
+the Joliet tree, read by Windows, and the Rock Ridge entries, read by
+Linux and most unices, keep the name as given.  The image is laid out as:
+
+    - sectors 0-15: system area, zeros
+    - 16, 17, 18: primary, Joliet and terminating volume descriptors
+    - 19-22: little and big endian path tables of both trees
+    - the primary root directory, then the Rock Ridge continuation area
+      with the ER entry, which readers expect after the directory that
+      refers to it
+    - the Joliet root directory
+    - the files, each starting on a sector, shared by both trees
+"""
+
+import struct
+import time
+
+SECTOR_SIZE = 2048
+
+#: first sector after the system area
+SYSTEM_AREA_SECTORS = 16
+
+#: escape sequence of a Joliet supplementary volume descriptor, UCS-2
+#: level 3
+JOLIET_ESCAPE = '%/E'
+
+#: longest Joliet file name, in characters
+JOLIET_NAME_LENGTH = 64
+
+#: Rock Ridge extension, as recorded in the ER entry
+RRIP_ID = 'RRIP_1991A'
+RRIP_DESCRIPTION = ('THE ROCK RIDGE INTERCHANGE PROTOCOL PROVIDES SUPPORT '
+                    'FOR POSIX FILE SYSTEM SEMANTICS')
+RRIP_SOURCE = ('PLEASE CONTACT DISC PUBLISHER FOR SPECIFICATION SOURCE.  '
+               'SEE PUBLISHER IDENTIFIER IN PRIMARY VOLUME DESCRIPTOR FOR '
+               'CONTACT INFORMATION.')
+
+#: Rock Ridge modes: read-only files and directories
+FILE_MODE = 0100444
+DIRECTORY_MODE = 040555
+
+# sectors of the fixed part of the layout
+_PRIMARY = SYSTEM_AREA_SECTORS
+_JOLIET = _PRIMARY + 1
+_TERMINATOR = _PRIMARY + 2
+_PATH_TABLES = _PRIMARY + 3
+_DIRECTORIES = _PRIMARY + 7
+
+_D_CHARACTERS = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_'
+
+def _both16(number):
+    """Returns number as both-byte order 16 bit integer."""
+    return struct.pack('<H', number) + struct.pack('>H', number)
+
+def _both32(number):
+    """Returns number as both-byte order 32 bit integer."""
+    return struct.pack('<I', number) + struct.pack('>I', number)
+
+def _recordDate(date):
+    """Returns the 7 byte date of a directory record."""
+    stamp = time.gmtime(date)
+    return struct.pack('7B', stamp[0] - 1900, stamp[1], stamp[2], stamp[3],
+                       stamp[4], stamp[5], 0)
+
+def _volumeDate(date):
+    """Returns the 17 byte date of a volume descriptor."""
+    return time.strftime('%Y%m%d%H%M%S00', time.gmtime(date)) + '\0'
+
+def _text(value, length, fill=' '):
+    """Returns value padded with fill, or cut, to length bytes."""
+    return (value + fill * length)[:length]
+
+def _ucs2(value, length):
+    """Returns value as big endian UCS-2, padded with spaces to length."""
+    data = value.encode('utf_16_be')
+    return (data + '\0 ' * length)[:length]
+
+def getIsoName(name, used=None):
+    """
+    Returns the ISO 9660 level 1 name of a file: at most 8 d-characters, a
+    dot, at most 3 d-characters and the version, as in OVF_ENV.XML;1.
+
+    @param name: file name
+    @type name: String
+
+    @param used: ISO names already taken, the name returned is added.  A
+                 name that is taken gets a number in its last characters.
+    @type used: dictionary
+
+    @return: ISO 9660 file identifier
+    @rtype: String
+    """
+    def clean(part, length):
+        chars = []
+        for char in part.upper():
+            if char not in _D_CHARACTERS:
+                char = '_'
+            chars.append(char)
+        return str(''.join(chars)[:length])
+
+    if '.' in name:
+        (base, ext) = name.rsplit('.', 1)
+    else:
+        (base, ext) = (name, '')
+    base = clean(base, 8) or '_'
+    ext = clean(ext, 3)
+
+    isoName = base + '.' + ext + ';1'
+    count = 1
+    while used != None and used.has_key(isoName):
+        suffix = str(count)
+        isoName = base[:8 - len(suffix)] + suffix + '.' + ext + ';1'
+        count += 1
+    if used != None:
+        used[isoName] = True
+    return isoName
+
+def _directoryRecord(extent, size, isDirectory, identifier, date,
+                     systemUse=''):
+    """Returns an ISO 9660 directory record."""
+    length = 33 + len(identifier)
+    padding = ''
+    if length % 2:
+        padding = '\0'
+    length += len(padding) + len(systemUse)
+    if len(systemUse) % 2:
+        systemUse += '\0'
+        length += 1
+    if length > 255:
+        raise ValueError("Directory record too long for " + repr(identifier))
+
+    flags = 0
+    if isDirectory:
+        flags = 2
+    return (struct.pack('BB', length, 0) + _both32(extent) + _both32(size) +
+            _recordDate(date) + struct.pack('BBB', flags, 0, 0) +
+            _both16(1) + struct.pack('B', len(identifier)) + identifier +
+            padding + systemUse)
+
+def _rockRidge(mode, links, date, name=None):
+    """Returns the RR, PX, TF and, with name, NM entries of a record."""
+    flags = 0x81
+    entries = ('PX' + struct.pack('BB', 36, 1) + _both32(mode) +
+               _both32(links) + _both32(0) + _both32(0))
+    entries += 'TF' + struct.pack('BBB', 12, 1, 0x02) + _recordDate(date)
+    if name != None:
+        flags |= 0x08
+        entries += 'NM' + struct.pack('BBB', 5 + len(name), 1, 0) + name
+    return 'RR' + struct.pack('BBB', 5, 1, flags) + entries
+
+def _packDirectory(records):
+    """
+    Returns the records of a directory packed into sectors, so that none
+    crosses a sector boundary.
+    """
+    data = ''
+    for record in records:
+        used = len(data) % SECTOR_SIZE
+        if used + len(record) > SECTOR_SIZE:
+            data += '\0' * (SECTOR_SIZE - used)
+        data += record
+    return data + '\0' * (-len(data) % SECTOR_SIZE)
+
+def _pathTable(rootExtent, bigEndian):
+    """Returns the path table of a tree that only has its root."""
+    if bigEndian:
+        extent = struct.pack('>IH', rootExtent, 1)
+    else:
+        extent = struct.pack('<IH', rootExtent, 1)
+    return struct.pack('BB', 1, 0) + extent + '\0\0'
+
+def _volumeDescriptor(kind, volumeId, volumeSize, rootRecord, pathTables,
+                      date, joliet=False):
+    """Returns a primary (kind 1) or supplementary (kind 2) descriptor."""
+    if joliet:
+        text = _ucs2
+        escapes = _text(JOLIET_ESCAPE, 32, '\0')
+    else:
+        text = _text
+        escapes = '\0' * 32
+    pathTableSize = len(_pathTable(0, False))
+    stamp = _volumeDate(date)
+
+    descriptor = (struct.pack('B', kind) + 'CD001' + struct.pack('BB', 1, 0) +
+                  text('', 32) +                    # system
+                  text(volumeId, 32) +
+                  '\0' * 8 +
+                  _both32(volumeSize) +
+                  escapes +
+                  _both16(1) +                      # volume set size
+                  _both16(1) +                      # volume sequence number
+                  _both16(SECTOR_SIZE) +
+                  _both32(pathTableSize) +
+                  struct.pack('<I', pathTables) + '\0' * 4 +
+                  struct.pack('>I', pathTables + 1) + '\0' * 4 +
+                  rootRecord +
+                  text('', 128) +                   # volume set
+                  text('', 128) +                   # publisher
+                  text('', 128) +                   # data preparer
+                  text('', 128) +                   # application
+                  text('', 37) + text('', 37) + text('', 37) +
+                  stamp + stamp + '0' * 16 + '\0' + stamp +
+                  struct.pack('BB', 1, 0))
+    return descriptor + '\0' * (SECTOR_SIZE - len(descriptor))
+
+def makeIso(files, volumeId='CDROM', date=None):
+    """
+    Returns an ISO 9660 image, with Joliet and Rock Ridge extensions, of
+    the given files.
+
+    @raise ValueError: a name has a '/', is used twice or is too long
+
+    @param files: (name, contents) of each file, names are Strings and
+                  contents byte Strings
+    @type files: list of tuples
+
+    @param volumeId: volume identifier, d-characters
+    @type volumeId: String
+
+    @param date: time of the files and of the volume, seconds since the
+                 epoch.  Default is now.
+    @type date: number
+
+    @return: image
+    @rtype: String
+    """
+    if date == None:
+        date = time.time()
+
+    entries = []
+    isoNames = {}
+    jolietNames = {}
+    for (name, contents) in files:
+        if '/' in name or name in ('', '.', '..'):
+            raise ValueError("Not a file name: " + repr(name))
+        if isinstance(name, str):
+            name = name.decode('UTF-8')
+        if len(name) > JOLIET_NAME_LENGTH - 2:
+            raise ValueError("File name too long: " + name.encode('UTF-8'))
+        jolietName = (name + ';1').encode('utf_16_be')
+        if jolietNames.has_key(jolietName):
+            raise ValueError("File name used twice: " + name.encode('UTF-8'))
+        jolietNames[jolietName] = True
+        entries.append(dict(name=name.encode('UTF-8'),
+                            isoName=getIsoName(name, isoNames),
+                            jolietName=jolietName,
+                            contents=contents))
+
+    # the records have a fixed size, so directory sizes are known before
+    # the extents are
+    def directories(primaryRoot, continuationSector, jolietRoot):
+        continuation = ('CE' + struct.pack('BB', 28, 1) +
+                        _both32(continuationSector) + _both32(0) +
+                        _both32(len(extension)))
+        primary = [_directoryRecord(primaryRoot[0], primaryRoot[1], True,
+                                    '\0', date,
+                                    'SP' + struct.pack('BBBBB', 7, 1, 0xBE,
+                                                       0xEF, 0) +
+                                    _rockRidge(DIRECTORY_MODE, 2, date) +
+                                    continuation),
+                   _directoryRecord(primaryRoot[0], primaryRoot[1], True,
+                                    '\1', date,
+                                    _rockRidge(DIRECTORY_MODE, 2, date))]
+        joliet = [_directoryRecord(jolietRoot[0], jolietRoot[1], True,
+                                   '\0', date),
+                  _directoryRecord(jolietRoot[0], jolietRoot[1], True,
+                                   '\1', date)]
+        byIsoName = [(entry['isoName'], entry) for entry in entries]
+        byIsoName.sort()
+        for (isoName, entry) in byIsoName:
+            primary.append(_directoryRecord(entry['extent'],
+                                            len(entry['contents']), False,
+                                            isoName, date,
+                                            _rockRidge(FILE_MODE, 1, date,
+                                                       entry['name'])))
+        byJolietName = [(entry['jolietName'], entry) for entry in entries]
+        byJolietName.sort()
+        for (jolietName, entry) in byJolietName:
+            joliet.append(_directoryRecord(entry['extent'],
+                                           len(entry['contents']), False,
+                                           jolietName, date))
+        return (_packDirectory(primary), _packDirectory(joliet))
+
+    extension = ('ER' + struct.pack('BBBBBB', 8 + len(RRIP_ID) +
+                                    len(RRIP_DESCRIPTION) + len(RRIP_SOURCE),
+                                    1, len(RRIP_ID), len(RRIP_DESCRIPTION),
+                                    len(RRIP_SOURCE), 1) +
+                 RRIP_ID + RRIP_DESCRIPTION + RRIP_SOURCE)
+
+    for entry in entries:
+        entry['extent'] = 0
+    (primary, joliet) = directories((0, 0), 0, (0, 0))
+
+    # lay out the directories, then the files
+    primaryRoot = (_DIRECTORIES, len(primary))
+    continuationSector = _DIRECTORIES + len(primary) / SECTOR_SIZE
+    jolietRoot = (continuationSector + 1, len(joliet))
+    sector = jolietRoot[0] + len(joliet) / SECTOR_SIZE
+    for entry in entries:
+        entry['extent'] = sector
+        sector += (len(entry['contents']) + SECTOR_SIZE - 1) / SECTOR_SIZE
+    (primary, joliet) = directories(primaryRoot, continuationSector,
+                                    jolietRoot)
+
+    primaryRecord = _directoryRecord(primaryRoot[0], primaryRoot[1], True,
+                                     '\0', date)
+    jolietRecord = _directoryRecord(jolietRoot[0], jolietRoot[1], True,
+                                    '\0', date)
+    terminator = struct.pack('B', 255) + 'CD001' + struct.pack('B', 1)
+
+    image = ['\0' * (SYSTEM_AREA_SECTORS * SECTOR_SIZE),
+             _volumeDescriptor(1, volumeId, sector, primaryRecord,
+                               _PATH_TABLES, date),
+             _volumeDescriptor(2, volumeId, sector, jolietRecord,
+                               _PATH_TABLES + 2, date, joliet=True),
+             terminator + '\0' * (SECTOR_SIZE - len(terminator))]
+    for (root, bigEndian) in ((primaryRoot[0], False), (primaryRoot[0], True),
+                              (jolietRoot[0], False), (jolietRoot[0], True)):
+        table = _pathTable(root, bigEndian)
+        image.append(table + '\0' * (SECTOR_SIZE - len(table)))
+    image.append(primary)
+    image.append(extension + '\0' * (SECTOR_SIZE - len(extension)))
+    image.append(joliet)
+    for entry in entries:
+        image.append(entry['contents'])
+        image.append('\0' * (-len(entry['contents']) % SECTOR_SIZE))
+
+    return ''.join(image)
+
+def writeIso(path, files, volumeId='CDROM', date=None):
+    """
+    Writes an ISO 9660 image of the given files to path, see L{makeIso}.
+
+    @param path: image file, replaced if it exists
+    @type path: String
+
+    @param files: (name, contents) of each file
+    @type files: list of tuples
+
+    @param volumeId: volume identifier, d-characters
+    @type volumeId: String
+
+    @param date: time of the files and of the volume, default is now
+    @type date: number
+    """
+    image = makeIso(files, volumeId, date)
+    fileObj = open(path, 'wb')
+    try:
+        fileObj.write(image)
+    finally:
+        fileObj.close()
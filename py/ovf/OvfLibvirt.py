@@ -13,16 +13,25 @@
 """OvfLibvirt"""
 
 from xml.dom.minidom import Document, parseString
-from xml.dom import NotFoundErr
-import warnings
+from xml.dom import NotFoundErr, Node
 import os
 import os.path
 import sched
+import sha
+import tempfile
+import threading
 import time
-import shutil
+try:
+    import json
+except ImportError:
+    try:
+        import simplejson as json
+    except ImportError:
+        json = None
 
 import Ovf
 import OvfPlatform
+import OvfProvision
 
 def libvirtDocument(domain, *sections):
     """
@@ -321,32 +330,41 @@ def bootElement(bootDict):
 
     return bootList
 
-def bootElements(domain, domainType):
+def getBootDict(domainType):
     """
-    Create the elements necessary to boot the OS based on the domain type.
+    Returns the L{boot dictionary<bootElement>} for a domain type.
 
-    @type domain: DOM Element
-    @param domain: domain element
     @type domainType: String
     @param domainType: String indicating type of domain being created
 
-    @rtype: list
-    @return: list of boot related elements
+    @rtype: dictionary
+    @return: boot arguments
     """
     if not domainType:
         raise RuntimeError, "domainType can not be empty"
 
-    bootDict = {}
     if domainType == 'qemu' or domainType == 'kqemu' or \
         domainType == 'kvm' or domainType == 'xenfv':
-        bootDict = dict(type = 'hvm', devices=['hd', 'cdrom'])
+        return dict(type = 'hvm', devices=['hd', 'cdrom'])
     elif domainType == 'xenpv':
-        bootDict = dict(bootloader = '/usr/bin/pygrub',
-                         type = 'linux')
+        return dict(bootloader = '/usr/bin/pygrub',
+                    type = 'linux')
     else:
         raise RuntimeError, "Invalid domain type"
 
-    retElements = bootElement(bootDict)
+def bootElements(domain, domainType):
+    """
+    Create the elements necessary to boot the OS based on the domain type.
+
+    @type domain: DOM Element
+    @param domain: domain element
+    @type domainType: String
+    @param domainType: String indicating type of domain being created
+
+    @rtype: list
+    @return: list of boot related elements
+    """
+    retElements = bootElement(getBootDict(domainType))
 
     addSectionsToDomain(domain, retElements)
 
@@ -858,6 +876,268 @@ def getOvfSystemType(virtualSys):
 
     return systemTypes
 
+class HardwareProfile:
+    """
+    The Items of a VirtualHardwareSection that apply to one configuration,
+    read in a single pass.  Items are kept in document order, bucketed by
+    rasd:ResourceType and indexed by rasd:InstanceID, so the domain builders
+    below do not rescan the section.
+
+    An Item without ovf:configuration applies to every configuration.  An
+    Item with it applies to each configuration in its space separated list.
+
+    Each Item is a dictionary of the same form as the children of
+    L{Ovf.getDict}: name, node, its attributes and the text of each rasd
+    element.
+    """
+
+    def __init__(self, virtualHardware, configId=None):
+        """
+        @param virtualHardware: Ovf VirtualHardwareSection Node
+        @type virtualHardware: DOM Element
+
+        @param configId: configuration name
+        @type configId: String
+        """
+        self.node = virtualHardware
+        self.configId = configId
+        self.items = []         #: Items in document order
+        self.types = {}         #: ResourceType -> list of Items
+        self.instances = {}     #: InstanceID -> Item
+
+        for child in virtualHardware.childNodes:
+            if child.nodeType != Node.ELEMENT_NODE or child.tagName != 'Item':
+                continue
+            if configId != None and child.hasAttribute('ovf:configuration'):
+                configs = child.getAttribute('ovf:configuration').split()
+                if configId not in configs:
+                    continue
+
+            item = dict(node=child, name=child.tagName)
+            Ovf.getAttributes(child, item)
+            for element in child.childNodes:
+                if element.nodeType == Node.ELEMENT_NODE:
+                    if element.firstChild != None:
+                        item[element.tagName] = element.firstChild.data
+                    else:
+                        item[element.tagName] = ''
+            self.items.append(item)
+
+            resourceType = item.get('rasd:ResourceType')
+            if self.types.has_key(resourceType):
+                self.types[resourceType].append(item)
+            else:
+                self.types[resourceType] = [item]
+            if item.has_key('rasd:InstanceID'):
+                self.instances[_instanceKey(item['rasd:InstanceID'])] = item
+
+    def getItems(self, *resourceTypes):
+        """
+        Returns the Items of the given resource types, in document order.
+
+        @param resourceTypes: rasd:ResourceType values, as in '17'
+        @type resourceTypes: Strings
+
+        @return: Items
+        @rtype: list of dictionaries
+        """
+        if len(resourceTypes) == 1:
+            return self.types.get(resourceTypes[0], [])
+        return [item for item in self.items
+                if item.get('rasd:ResourceType') in resourceTypes]
+
+    def getItem(self, instanceId):
+        """
+        Returns the Item with the given rasd:InstanceID, or None.
+
+        @param instanceId: rasd:InstanceID, as in a rasd:Parent value
+        @type instanceId: String
+
+        @return: Item
+        @rtype: dictionary
+        """
+        return self.instances.get(_instanceKey(instanceId))
+
+    def getValue(self, resourceType, element='rasd:VirtualQuantity'):
+        """
+        Returns the value of element in the last Item of a resource type,
+        or '' if there is no such Item.
+
+        @param resourceType: rasd:ResourceType value
+        @type resourceType: String
+
+        @param element: rasd element name
+        @type element: String
+
+        @rtype: String
+        """
+        items = self.getItems(resourceType)
+        if items == []:
+            return ''
+        return items[-1][element]
+
+def _instanceKey(instanceId):
+    """
+    Returns the key of an InstanceID in L{HardwareProfile.instances}, so
+    that "01" and "1" are the same instance.
+    """
+    try:
+        return str(int(instanceId))
+    except ValueError:
+        return instanceId.strip()
+
+def getHardwareProfile(virtualHardware, configId=None):
+    """
+    Returns virtualHardware as a L{HardwareProfile}.  A HardwareProfile
+    passed in is returned as is, so the getOvf* functions below accept
+    either.
+
+    @param virtualHardware: Ovf VirtualHardwareSection Node or profile
+    @type virtualHardware: DOM Element or L{HardwareProfile}
+
+    @param configId: configuration name, used if a Node is given
+    @type configId: String
+
+    @rtype: L{HardwareProfile}
+    """
+    if isinstance(virtualHardware, HardwareProfile):
+        return virtualHardware
+    return HardwareProfile(virtualHardware, configId)
+
+class DiskIndex:
+    """
+    Disk and file lookups for one envelope, built in a single pass over
+    its References and DiskSection.  It maps diskId to Disk, file id to
+    href and file id to the disks using it, so that resolving the disks of
+    every VirtualSystem takes linear time.
+    """
+
+    def __init__(self, references, diskSection):
+        """
+        @param references: Ovf References Node
+        @type references: DOM Element
+
+        @param diskSection: Ovf DiskSection Node
+        @type diskSection: DOM Element
+        """
+        self.fileIds = []       #: file ids in document order
+        self.files = {}         #: file id -> href
+        self.disks = {}         #: diskId -> Disk attributes
+        self.users = {}         #: file id -> diskIds with that ovf:fileRef
+        self.children = {}      #: ovf:parentRef -> diskIds referring to it
+
+        for node in references.childNodes:
+            if node.nodeType == Node.ELEMENT_NODE and node.tagName == 'File':
+                fileId = node.getAttribute('ovf:id')
+                self.fileIds.append(fileId)
+                self.files[fileId] = node.getAttribute('ovf:href')
+
+        for node in diskSection.childNodes:
+            if node.nodeType == Node.ELEMENT_NODE and node.tagName == 'Disk':
+                disk = Ovf.getAttributes(node, dict(node=node))
+                diskId = disk.get('ovf:diskId')
+                self.disks[diskId] = disk
+                if disk.has_key('ovf:fileRef'):
+                    self.users.setdefault(disk['ovf:fileRef'],
+                                          []).append(diskId)
+                if disk.has_key('ovf:parentRef'):
+                    self.children.setdefault(disk['ovf:parentRef'],
+                                             []).append(diskId)
+
+    def getDisk(self, diskId):
+        """
+        Returns the attributes of the Disk with the given diskId, or None.
+
+        @rtype: dictionary
+        """
+        return self.disks.get(diskId)
+
+    def getHref(self, fileId):
+        """
+        Returns the href of the File with the given id, or None.
+
+        @rtype: String
+        """
+        return self.files.get(fileId)
+
+    def getUsers(self, fileId):
+        """
+        Returns the diskIds of the disks backed by the given file.
+
+        @rtype: list of Strings
+        """
+        return self.users.get(fileId, [])
+
+    def isShared(self, fileId):
+        """
+        Returns True if more than one disk is backed by the given file.
+
+        @rtype: boolean
+        """
+        return len(self.getUsers(fileId)) > 1
+
+    def getSharedFiles(self):
+        """
+        Returns the ids of the files that back more than one disk, or that
+        more than one disk names as ovf:parentRef, in document order.
+
+        @rtype: list of Strings
+        """
+        return [fileId for fileId in self.fileIds
+                if(self.isShared(fileId) or
+                   len(self.children.get(fileId, [])) > 1)]
+
+    def getHostResources(self, hostResource):
+        """
+        Resolves the rasd:HostResource of a disk Item, as in ovf:/disk/1,
+        to the files making up the disk: the file of the parent disk (if
+        ovf:parentRef is set) followed by the disk's own file.
+
+        @param hostResource: rasd:HostResource
+        @type hostResource: String
+
+        @return: list of (file id, diskId, shared), where shared is True if
+                 the file is used by more than one disk.  Empty if
+                 hostResource does not name a known disk.
+        @rtype: list of tuples
+        """
+        if not(hostResource.startswith('ovf:/disk/') or
+               hostResource.startswith('ovf://disk/')):
+            return []
+        diskId = hostResource.rsplit('/', 1).pop()
+        disk = self.getDisk(diskId)
+        if disk == None:
+            return []
+
+        resources = []
+        #Add parentRef disk first, as it could be the
+        # operating system disk image
+        if disk.has_key('ovf:parentRef'):
+            parent = self.getDisk(disk['ovf:parentRef'])
+            if parent != None and parent.has_key('ovf:fileRef'):
+                resources.append((parent['ovf:fileRef'], diskId, True))
+        if disk.has_key('ovf:fileRef'):
+            fileRef = disk['ovf:fileRef']
+            resources.append((fileRef, diskId, self.isShared(fileRef)))
+        return resources
+
+def getDiskIndex(references, diskSection):
+    """
+    Returns a L{DiskIndex} for references and diskSection.  A DiskIndex
+    passed as diskSection is returned as is.
+
+    @param references: Ovf References Node
+    @type references: DOM Element
+
+    @param diskSection: Ovf DiskSection Node or index
+    @type diskSection: DOM Element or L{DiskIndex}
+
+    @rtype: L{DiskIndex}
+    """
+    if isinstance(diskSection, DiskIndex):
+        return diskSection
+    return DiskIndex(references, diskSection)
+
 def getOvfMemory(virtualHardware, configId=None):
     """
     Retrieves the maximum amount of memory (kB) to be allocated for the
@@ -869,9 +1149,10 @@ def getOvfMemory(virtualHardware, configId=None):
     use Unit Qualifiers as this form is deprecated.
         - PUnit form, as in "byte * 2^20"
         - PUnit form w/ Units Qualifier(deprecated), as in "MegaBytes"
+    Both are parsed by L{Ovf.getUnitFactor}.
 
-    @param virtualHardware: Ovf VirtualSystem Node
-    @type virtualHardware: DOM Element
+    @param virtualHardware: Ovf VirtualHardwareSection Node or profile
+    @type virtualHardware: DOM Element or L{HardwareProfile}
 
     @param configId: configuration name
     @type configId: String
@@ -882,52 +1163,12 @@ def getOvfMemory(virtualHardware, configId=None):
     memory = ''
 
     # TODO: needs to use bound:max, if it exists
-    rasd = Ovf.getDict(virtualHardware, configId)['children']
-    for resource in rasd:
-        if(resource.has_key('rasd:ResourceType') and
-           resource['rasd:ResourceType'] == '4'):
-            memoryQuantity = resource['rasd:VirtualQuantity']
-            memoryUnits = resource['rasd:AllocationUnits']
-
-            if(memoryUnits.startswith('byte') or
-                 memoryUnits.startswith('bit')):
-                # Calculate PUnit numerical factor
-                memoryUnits = memoryUnits.replace('^','**')
-
-                # Determine PUnit Quantifier DMTF DSP0004, {byte, bit}
-                # Convert to kilobytes
-                memoryUnits = memoryUnits.split(' ', 1)
-                quantifier = memoryUnits[0]
-                if quantifier == 'byte':
-                    memoryUnits[0] = '2**-10'
-                elif quantifier == 'bit':
-                    memoryUnits[0] = '2**-13'
-                else:
-                    raise ValueError("Incompatible PUnit quantifier for memory.")
-
-                memoryUnits = ' '.join(memoryUnits)
-                memoryFactor = int(eval(memoryUnits))
-
-            else:
-                if memoryUnits.startswith('Kilo'):
-                    memoryFactor = 1024**0
-                elif memoryUnits.startswith('Mega'):
-                    memoryFactor = 1024**1
-                elif memoryUnits.startswith('Giga'):
-                    memoryFactor = 1024**2
-                else:
-                    raise ValueError("Incompatible PUnit quantifier for memory.")
-
-                if memoryUnits.endswith('Bytes'):
-                    memoryFactor *= 1
-                elif memoryUnits.endswith('Bits'):
-                    memoryFactor *= 0.125
-                else:
-                    raise ValueError("Incompatible PUnit quantifier for memory.")
-                warnings.warn("DSP0004 v2.5.0: use PUnit Qualifiers",
-                              DeprecationWarning)
-
-            memory = str(int(memoryQuantity) * memoryFactor)
+    profile = getHardwareProfile(virtualHardware, configId)
+    for resource in profile.getItems('4')[-1:]:
+        memory = Ovf.convertQuantity(resource['rasd:VirtualQuantity'],
+                                     resource['rasd:AllocationUnits'],
+                                     'byte * 2^10')
+        memory = str(int(memory))
 
     return memory
 
@@ -942,9 +1183,10 @@ def getOvfCurrentMemory(virtualHardware, configId=None):
     use Unit Qualifiers as this form is deprecated.
         - PUnit form, as in "byte * 2^20"
         - PUnit form w/ Units Qualifier(deprecated), as in "MegaBytes"
+    Both are parsed by L{Ovf.getUnitFactor}.
 
-    @param virtualHardware: Ovf VirtualSystem Node
-    @type virtualHardware: DOM Element
+    @param virtualHardware: Ovf VirtualHardwareSection Node or profile
+    @type virtualHardware: DOM Element or L{HardwareProfile}
 
     @param configId: configuration name
     @type configId: String
@@ -955,50 +1197,12 @@ def getOvfCurrentMemory(virtualHardware, configId=None):
     memory = ''
 
     # TODO: needs to use bound:normal, if it is present
-    rasd = Ovf.getDict(virtualHardware, configId)['children']
-    for resource in rasd:
-        if(resource.has_key('rasd:ResourceType') and
-           resource['rasd:ResourceType'] == '4'):
-            memoryQuantity = resource['rasd:VirtualQuantity']
-            memoryUnits = resource['rasd:AllocationUnits']
-
-            if(memoryUnits.startswith('byte') or
-                 memoryUnits.startswith('bit')):
-                # Calculate PUnit numerical factor
-                memoryUnits = memoryUnits.replace('^','**')
-
-                # Determine PUnit Quantifier DMTF DSP0004, {byte, bit}
-                # Convert to kilobytes
-                memoryUnits = memoryUnits.split(' ', 1)
-                quantifier = memoryUnits[0]
-                if quantifier == 'byte':
-                    memoryUnits[0] = '2**-10'
-                elif quantifier == 'bit':
-                    memoryUnits[0] = '2**-13'
-                else:
-                    raise ValueError("Incompatible PUnit quantifier for memory.")
-
-                memoryUnits = ' '.join(memoryUnits)
-                memoryFactor = int(eval(memoryUnits))
-
-            else:
-                if memoryUnits.startswith('Kilo'):
-                    memoryFactor = 1
-                elif memoryUnits.startswith('Mega'):
-                    memoryFactor = 1024
-                elif memoryUnits.startswith('Giga'):
-                    memoryFactor = 2048
-                else:
-                    raise ValueError("Incompatible PUnit quantifier for memory.")
-
-                if memoryUnits.endswith('Bytes'):
-                    memoryFactor *= 1
-                elif memoryUnits.endswith('Bits'):
-                    memoryFactor *= 0.125
-                else:
-                    raise ValueError("Incompatible PUnit quantifier for memory.")
-
-            memory = str(int(memoryQuantity) * memoryFactor)
+    profile = getHardwareProfile(virtualHardware, configId)
+    for resource in profile.getItems('4')[-1:]:
+        memory = Ovf.convertQuantity(resource['rasd:VirtualQuantity'],
+                                     resource['rasd:AllocationUnits'],
+                                     'byte * 2^10')
+        memory = str(int(memory))
 
     return memory
 
@@ -1007,8 +1211,8 @@ def getOvfVcpu(virtualHardware, configId=None):
     Retrieves the number of virtual CPUs to be allocated for the virtual
     machine from the Ovf file.
 
-    @param virtualHardware: Ovf VirtualSystem Node
-    @type virtualHardware: DOM Element
+    @param virtualHardware: Ovf VirtualHardwareSection Node or profile
+    @type virtualHardware: DOM Element or L{HardwareProfile}
 
     @param configId: configuration name
     @type configId: String
@@ -1016,129 +1220,108 @@ def getOvfVcpu(virtualHardware, configId=None):
     @return: quantity of virtual cpu's
     @rtype: String
     """
-    vcpu = ''
-    rasd = Ovf.getDict(virtualHardware, configId)['children']
-    for resource in rasd:
-        if(resource.has_key('rasd:ResourceType') and
-           resource['rasd:ResourceType'] == '3'):
-            vcpu = resource['rasd:VirtualQuantity']
-
-    return vcpu
+    profile = getHardwareProfile(virtualHardware, configId)
+    return profile.getValue('3')
 
 def getOvfDisks(virtualHardware, dir, references, diskSection=None,
-                configId=None, envFile=None):
+                configId=None, envFile=None, strategies=None):
     """
     Retrieves disk device information for the virtual machine
     from the Ovf file.
 
+    A Disk whose file is shared with other Disks gets its own image,
+    made by L{OvfProvision.provisionDisk}; the shared file is left as it is.
+
     @param ovf: Ovf file
     @type ovf: DOM Document
 
-    @param virtualHardware: Ovf VirtualSystem Node
-    @type virtualHardware: DOM Element
+    @param virtualHardware: Ovf VirtualHardwareSection Node or profile
+    @type virtualHardware: DOM Element or L{HardwareProfile}
+
+    @param dir: directory of the disk image files
+    @type dir: String
+
+    @param references: Ovf References Node
+    @type references: DOM Element
+
+    @param diskSection: Ovf DiskSection Node or L{DiskIndex} for the envelope
+    @type diskSection: DOM Element or L{DiskIndex}
 
     @param configId: configuration name
     @type configId: String
 
+    @param envFile: environment iso to attach, if any
+    @type envFile: String
+
+    @param strategies: provisioning strategies for shared files, in order of
+                       preference.  Default is ('reflink', 'copy'), which
+                       suits every hypervisor.  An empty sequence uses the
+                       shared files as they are.
+    @type strategies: sequence of Strings
+
     @return: list of dictionaries, see L{Disk Element<diskElement>}
     @rtype: list
     """
-    disks = ()
+    diskMap = getOvfDiskMap(virtualHardware, references, diskSection,
+                            configId)
+    return provisionOvfDisks(diskMap, dir, envFile, strategies)
+
+def getOvfDiskMap(virtualHardware, references, diskSection=None,
+                  configId=None):
+    """
+    Returns the disks of the virtual machine as L{getOvfDisks} does, before
+    any image is provisioned: each disk names its file by href, relative to
+    the package, and depends on nothing but the envelope.
+
+    @param virtualHardware: Ovf VirtualHardwareSection Node or profile
+    @type virtualHardware: DOM Element or L{HardwareProfile}
+
+    @param references: Ovf References Node
+    @type references: DOM Element
+
+    @param diskSection: Ovf DiskSection Node or L{DiskIndex} for the envelope
+    @type diskSection: DOM Element or L{DiskIndex}
+
+    @param configId: configuration name
+    @type configId: String
+
+    @return: list of L{disk dictionaries<diskElement>} without sourceFile,
+             with the href of the image as file, its diskId and whether
+             the file is shared
+    @rtype: list
+    """
+    disks = []
     logicalNames = ['hda', 'hdb', 'hdd', 'hde', 'hdf']
 
-    rasd = Ovf.getDict(virtualHardware, configId)['children']
+    profile = getHardwareProfile(virtualHardware, configId)
+    devices = {'14' : 'fd', '15' : 'cdrom', '17' : 'disk'}
 
     ovfDiskList = []
-    for resource in rasd:
-        if resource['name'] == 'Item':
-            if resource['rasd:ResourceType'] == '14':
-                ovfDiskList.append(('fd', resource))
-            elif resource['rasd:ResourceType'] == '15':
-                ovfDiskList.append(('cdrom', resource))
-            elif resource['rasd:ResourceType'] == '17':
-                ovfDiskList.append(('disk', resource))
+    for resource in profile.getItems('14', '15', '17'):
+        ovfDiskList.append((devices[resource['rasd:ResourceType']], resource))
 
+    index = getDiskIndex(references, diskSection)
     for each in ovfDiskList:
-        hostResources = []
-
         #resource dictionary
         ovfDisk = each[1]
 
         #disk device: hd, fd, or cdrom
         device = each[0]
 
-        #source file
-        source = None
         hostResource = ovfDisk['rasd:HostResource']
-        resourceId = hostResource.rsplit('/', 1).pop()
-        if hostResource.startswith('ovf:/disk/'):
-            diskList = Ovf.getDict(diskSection)['children']
-
-            for child in diskList:
-                #Create a tuple (file hostResource, diskId, referred?)
-                #flag to check if the disk is referred
-                referedDisk = 0
-                if child['ovf:diskId'] == resourceId:
-                    #Check for disks referred as parentRef.
-                    #Add parentRef disk first, as it could be the
-                    # operating system disk image
-                    if child.has_key('ovf:parentRef'):
-                        parentref = child['ovf:parentRef']
-                        for pref in diskList:
-                            if pref['ovf:diskId'] == parentref:
-                                referedDisk = 1
-                                hostResource = 'ovf://file/' + pref['ovf:fileRef']
-                                diskResource = (hostResource, resourceId, referedDisk)
-                                hostResources.append(diskResource)
-                                break
-
-                    # and the disk referred by the VMs HostResource
-                    #Check to see if the fileRef is referred by more than one disk
-                    referedDisk = 0
-                    hostResource = 'ovf://file/' + child['ovf:fileRef']
-                    refcnt = 0
-                    myFileRef = child['ovf:fileRef']
-                    for disk in diskList:
-                        if disk['ovf:fileRef'] == myFileRef:
-                            refcnt = refcnt + 1
-                    if refcnt > 1:
-                        referedDisk = 1
-                    diskResource = (hostResource, resourceId, referedDisk)
-                    hostResources.append(diskResource)
-        for resource in hostResources:
-            (hostResource, diskId, referedDisk) = resource
-            resourceId = hostResource.rsplit('/', 1).pop()
-            refList = Ovf.getDict(references)['children']
-
-            for child in refList:
-                if child['ovf:id'] == resourceId:
-                    source = os.path.join(dir, child['ovf:href'])
-                    if referedDisk == 1:
-                        simage = source
-                        diskpath = source.rsplit('/', 1)[0]
-                        diskimage = source.rsplit('/', 1)[1]
-                        diskname = diskimage.split('.')[0]
-                        disknameext = diskimage.split('.')[1]
-                        newdiskname = diskname + '-' + diskId
-                        if disknameext != None:
-                            source = os.path.join(diskpath, newdiskname + '.' + disknameext)
-                        else:
-                            source = os.path.join(diskpath, newdiskname)
-                        dimage = source
-                        shutil.copy(simage, dimage)
+        for resource in index.getHostResources(hostResource):
+            (resourceId, diskId, referedDisk) = resource
 
-            if source == None:
+            #source file
+            href = index.getHref(resourceId)
+            if href == None:
                 raise ValueError(hostResource)
 
             #target bus
             parentType = None
-            parentId = int(ovfDisk['rasd:Parent'])
-            for presource in rasd:
-                if presource['name'] == 'Item':
-                    instId = int(presource['rasd:InstanceID'])
-                    if instId == parentId:
-                        parentType = presource['rasd:ResourceType']
-                        break
+            parent = profile.getItem(ovfDisk['rasd:Parent'])
+            if parent != None:
+                parentType = parent['rasd:ResourceType']
 
             if(parentType == '5'):
                 bus = 'ide'
@@ -1157,13 +1340,71 @@ def getOvfDisks(virtualHardware, dir, references, diskSection=None,
             else:
                 dev = logicalNames.pop(0)
 
-            libvirtDisk = dict(diskType='file',
-                               diskDevice=device,
-                               sourceFile=source,
-                               targetBus=bus,
-                               targetDev=dev,
-                               readonly=ro)
-            disks += (libvirtDisk,)
+            disks.append(dict(diskType='file',
+                              diskDevice=device,
+                              file=href,
+                              diskId=diskId,
+                              shared=referedDisk,
+                              targetBus=bus,
+                              targetDev=dev,
+                              readonly=ro))
+
+    return disks
+
+def provisionOvfDisks(diskMap, dir, envFile=None, strategies=None):
+    """
+    Returns the disks of a L{disk map<getOvfDiskMap>} with their image
+    files in dir, provisioning an image of its own for each disk whose
+    file is shared.
+
+    @param diskMap: disks, see L{getOvfDiskMap}
+    @type diskMap: list
+
+    @param dir: directory of the disk image files
+    @type dir: String
+
+    @param envFile: environment iso to attach, if any
+    @type envFile: String
+
+    @param strategies: provisioning strategies for shared files, see
+                       L{getOvfDisks}
+    @type strategies: sequence of Strings
+
+    @return: list of dictionaries, see L{Disk Element<diskElement>}
+    @rtype: tuple
+    """
+    disks = ()
+    if strategies == None:
+        strategies = OvfProvision.getStrategies(None)
+
+    images = []
+    for disk in diskMap:
+        source = os.path.join(dir, disk['file'])
+        driverType = None
+        if disk['shared'] and strategies:
+            (root, ext) = os.path.splitext(source)
+            try:
+                (source, strategy) = OvfProvision.provisionDisk(source,
+                                         root + '-' + disk['diskId'] + ext,
+                                         strategies)
+            except:
+                # leave no images of a domain that cannot be built
+                _removeImages(images)
+                raise
+            images.append(source)
+            if strategy == 'overlay':
+                driverType = 'qcow2'
+
+        libvirtDisk = dict(diskType=disk['diskType'],
+                           diskDevice=disk['diskDevice'],
+                           sourceFile=source,
+                           targetBus=disk['targetBus'],
+                           targetDev=disk['targetDev'],
+                           readonly=disk['readonly'])
+        if driverType != None:
+            libvirtDisk['driverName'] = 'qemu'
+            libvirtDisk['driverType'] = driverType
+        disks += (libvirtDisk,)
 
     # add the environment iso
     if envFile:
@@ -1176,12 +1417,41 @@ def getOvfDisks(virtualHardware, dir, references, diskSection=None,
 
     return disks
 
+def _removeImages(images):
+    """Removes the provisioned images that exist."""
+    for image in images:
+        if os.path.exists(image):
+            os.remove(image)
+
+def getProvisionedImages(compiled, spec, dir):
+    """
+    Returns the images that L{provisionDomainSpec} made for a domain.
+
+    @param compiled: compiled domain description
+    @type compiled: dictionary
+
+    @param spec: domain description made from compiled
+    @type spec: dictionary
+
+    @param dir: directory of the disk image files
+    @type dir: String
+
+    @return: paths of the images
+    @rtype: list of Strings
+    """
+    images = []
+    for (mapped, disk) in zip(compiled['disks'], spec['disks']):
+        if(mapped['shared'] and
+           disk['sourceFile'] != os.path.join(dir, mapped['file'])):
+            images.append(disk['sourceFile'])
+    return images
+
 def getOvfNetworks(virtualHardware, configId=None):
     """
     Retrieves network interface information for the virtual machine from the Ovf file.
 
-    @param virtualHardware: Ovf VirtualSystem Node
-    @type virtualHardware: DOM Element
+    @param virtualHardware: Ovf VirtualHardwareSection Node or profile
+    @type virtualHardware: DOM Element or L{HardwareProfile}
 
     @param configId: configuration name
     @type configId: String
@@ -1192,57 +1462,417 @@ def getOvfNetworks(virtualHardware, configId=None):
     @todo: stubbed function, needs work
     """
     netList = []
-    rasd = Ovf.getDict(virtualHardware, configId)['children']
-
-    ovfNetDeviceList = []
-    for resource in rasd:
-        if resource['name'] == 'Item':
-            if resource['rasd:ResourceType'] == '10':
-                ovfNetDeviceList.append(resource)
+    profile = getHardwareProfile(virtualHardware, configId)
 
     # create a dict for each device
     # We currently only support the libvirt virtual network interface.  We
     # also assume that the network currently exists.  The default network
     # is "default".
-    for netDevice in ovfNetDeviceList:
-        netAttach = 'default'
+    for netDevice in profile.getItems('10'):
+        netConnect = 'default'
         if netDevice.has_key('rasd:Connection'):
             netConnect = netDevice['rasd:Connection']
         netList.append(dict(interfaceType = 'network', sourceName = netConnect))
 
     return netList
 
-def getOvfDomains(ovf, path, hypervisor=None, configId=None, envDirectory=None):
+def _getSystemTypes(system, hypervisor=None):
+    """Returns (virtual system type, libvirt domain type) of a VirtualSystem."""
+    if hypervisor:
+        vsType = hypervisor.lower()
+    else:
+        vsType = OvfPlatform.getVsSystemType(system)
+    return (vsType, getDomainTypeForVsType(vsType))
+
+def getDomainSpec(system, virtualHardware, dir, references, diskSection,
+                  hypervisor=None, envFile=None, strategies=None):
+    """
+    Returns the description of the libvirt domain for a VirtualSystem, as
+    rendered by L{renderDomain} and L{renderDomainDocument}.  Provisions
+    the disk images the domain needs, see L{getOvfDisks}.
+
+    The description has these keys:
+        - name: domain name, the ovf:id of the VirtualSystem
+        - uuid(optional): domain uuid, not set by this function
+        - domainType: libvirt domain type
+        - boot: L{boot dictionary<bootElement>}
+        - memory, vcpu: quantities as Strings
+        - clock: clock sync
+        - features: L{featuresElement} keyword arguments
+        - onPowerOff, onReboot, onCrash: life cycle actions
+        - graphics: L{graphicsElement} keyword arguments
+        - console: L{consoleElement} keyword arguments
+        - disks: list of L{disk dictionaries<diskElement>}
+        - networks: list of L{network dictionaries<networkElement>}
+
+    @param system: Ovf VirtualSystem Node
+    @type system: DOM Element
+
+    @param virtualHardware: Ovf VirtualHardwareSection Node or profile
+    @type virtualHardware: DOM Element or L{HardwareProfile}
+
+    @param dir: directory of the disk image files
+    @type dir: String
+
+    @param references: Ovf References Node
+    @type references: DOM Element
+
+    @param diskSection: Ovf DiskSection Node or L{DiskIndex} for the envelope
+    @type diskSection: DOM Element or L{DiskIndex}
+
+    @param hypervisor: virtual system type, default is the type the
+                       VirtualSystem asks for
+    @type hypervisor: String
+
+    @param envFile: environment iso to attach, if any
+    @type envFile: String
+
+    @param strategies: provisioning strategies for shared disk files,
+                       default is what suits the domain type, see
+                       L{OvfProvision.getStrategies}
+    @type strategies: sequence of Strings
+
+    @return: domain description
+    @rtype: dictionary
     """
-    Returns a dictionary with all of the VirtualSystems in an ovf
-    listed as keys with the libvirt domain, for the specified configuration,
-    stored as the value.
+    compiled = compileDomainSpec(system, virtualHardware, references,
+                                 diskSection, hypervisor)
+    return provisionDomainSpec(compiled, dir, envFile, strategies)
 
-    @param ovf: Ovf file
-    @type ovf: DOM Document
+def compileDomainSpec(system, virtualHardware, references, diskSection,
+                      hypervisor=None):
+    """
+    Returns the part of the L{domain description<getDomainSpec>} of a
+    VirtualSystem that only depends on the envelope: its disks are a
+    L{disk map<getOvfDiskMap>}.  Nothing is written, and the description
+    only holds Strings, booleans, lists and dictionaries, so that it can
+    be kept, see L{DomainSpecCache}.
 
-    @param path: path to Ovf file
-    @type path: String
+    @param system: Ovf VirtualSystem Node
+    @type system: DOM Element
 
-    @param configId: configuration name
-    @type configId: String
+    @param virtualHardware: Ovf VirtualHardwareSection Node or profile
+    @type virtualHardware: DOM Element or L{HardwareProfile}
 
-    @todo: needs work, very basic, assumes hypervisor type
+    @param references: Ovf References Node
+    @type references: DOM Element
+
+    @param diskSection: Ovf DiskSection Node or L{DiskIndex} for the envelope
+    @type diskSection: DOM Element or L{DiskIndex}
+
+    @param hypervisor: virtual system type, default is the type the
+                       VirtualSystem asks for
+    @type hypervisor: String
+
+    @return: compiled domain description
+    @rtype: dictionary
     """
-    domains = dict()
-    #directory = os.path.abspath(path.rsplit("/", 1)[0])
-    directory = path
+    (vsType, domainType) = _getSystemTypes(system, hypervisor)
+
+    return dict(name=system.getAttribute('ovf:id'),
+                domainType=domainType,
+                boot=getBootDict(vsType),
+                memory=getOvfMemory(virtualHardware),
+                vcpu=getOvfVcpu(virtualHardware),
+                clock='utc',
+                features=dict(acpi=True),
+                onPowerOff='destroy',
+                onReboot='restart',
+                onCrash='destroy',
+                graphics=dict(graphicsType='vnc', listen='localhost',
+                              port='-1'),
+                console=dict(deviceType='pty', port='0'),
+                disks=getOvfDiskMap(virtualHardware, references,
+                                    diskSection),
+                networks=getOvfNetworks(virtualHardware))
+
+def provisionDomainSpec(compiled, dir, envFile=None, strategies=None):
+    """
+    Returns the L{domain description<getDomainSpec>} for a compiled one,
+    provisioning the disk images it needs, see L{provisionOvfDisks}.  The
+    compiled description is not changed.
+
+    @param compiled: description from L{compileDomainSpec}
+    @type compiled: dictionary
+
+    @param dir: directory of the disk image files
+    @type dir: String
+
+    @param envFile: environment iso to attach, if any
+    @type envFile: String
+
+    @param strategies: provisioning strategies for shared disk files, see
+                       L{getDomainSpec}
+    @type strategies: sequence of Strings
+
+    @return: domain description
+    @rtype: dictionary
+    """
+    if strategies == None:
+        strategies = OvfProvision.getStrategies(compiled['domainType'])
+
+    spec = compiled.copy()
+    spec['disks'] = list(provisionOvfDisks(compiled['disks'], dir, envFile,
+                                           strategies))
+    spec['networks'] = [network.copy() for network in compiled['networks']]
+    return spec
+
+def renderDomainDocument(spec):
+    """
+    Builds the libvirt domain for a L{domain description<getDomainSpec>}
+    from the element functions of this module.
+
+    @param spec: domain description
+    @type spec: dictionary
+
+    @return: XML DOM Document
+    @rtype: DOM Document
+    """
+    domain = domainElement(spec['domainType'])
+    addSectionsToDomain(domain, bootElement(spec['boot']))
+
+    devices = devicesElement(graphicsElement(**spec['graphics']),
+                             consoleElement(**spec['console']))
+    for diskDict in spec['disks']:
+        addDevice(devices, diskElement(diskDict))
+    for netDict in spec['networks']:
+        addDevice(devices, networkElement(netDict))
+
+    sections = [nameElement(spec['name'])]
+    if spec.get('uuid'):
+        sections.append(uuidElement(spec['uuid']))
+    sections.extend([memoryElement(spec['memory']),
+                     vcpuElement(spec['vcpu']),
+                     clockElement(spec['clock']),
+                     featuresElement(**spec['features']),
+                     onPowerOffElement(spec['onPowerOff']),
+                     onRebootElement(spec['onReboot']),
+                     onCrashElement(spec['onCrash']),
+                     devices])
+    return libvirtDocument(domain, *sections)
+
+def _renderElement(tagName, attributes=None, content=None):
+    """
+    Returns an element as XML, with attributes sorted like L{Ovf.xmlString}
+    does.  content is escaped XML, None for an empty element.
+    """
+    xml = '<' + tagName
+    if attributes:
+        names = attributes.keys()
+        names.sort()
+        for name in names:
+            xml += ' %s="%s"' % (name, Ovf.xmlEscape(attributes[name]))
+    if content is None:
+        return xml + '/>'
+    return xml + '>' + content + '</' + tagName + '>'
+
+def _renderText(tagName, text):
+    """Returns an element holding text as XML."""
+    return '<%s>%s</%s>' % (tagName, Ovf.xmlEscape(text), tagName)
+
+def _renderUuid(uuid):
+    """Returns the XML of L{uuidElement}, nothing without a uuid."""
+    if not uuid:
+        return ''
+    return _renderText('uuid', uuid)
+
+def _renderBoot(bootDict):
+    """Returns the XML of L{bootElement}."""
+    if bootDict.has_key('bootloader'):
+        if(bootDict.has_key('devices') | bootDict.has_key('kernel')):
+            raise TypeError
+        xml = _renderText('bootloader', bootDict['bootloader'])
+        if bootDict.has_key('bootloader_args'):
+            xml += _renderText('bootloader_args', bootDict['bootloader_args'])
+        return xml + '<os><type>linux</type></os>'
+
+    if not(bootDict.has_key('devices') ^ bootDict.has_key('kernel')):
+        raise TypeError
+
+    typeAttributes = {}
+    for key in ('arch', 'machine'):
+        if bootDict.has_key(key):
+            typeAttributes[key] = bootDict[key]
+    content = _renderElement('type', typeAttributes,
+                             Ovf.xmlEscape(bootDict['type']))
+    if bootDict.has_key('loader'):
+        content += _renderText('loader', bootDict['loader'])
+    if bootDict.has_key('devices'):
+        for device in bootDict['devices']:
+            content += '<boot dev="%s"/>' % Ovf.xmlEscape(device)
+    else:
+        for key in ('kernel', 'initrd', 'cmdline'):
+            if bootDict.has_key(key):
+                content += _renderText(key, bootDict[key])
+    return '<os>' + content + '</os>'
+
+def _renderDisk(diskDict):
+    """Returns the XML of L{diskElement}."""
+    content = _renderElement('source', {'file' : diskDict['sourceFile']})
+
+    target = {}
+    if diskDict.has_key('targetDev'):
+        target['dev'] = diskDict['targetDev']
+    if diskDict.has_key('targetBus'):
+        target['bus'] = diskDict['targetBus']
+    if target:
+        content += _renderElement('target', target)
+
+    driver = {}
+    if diskDict.has_key('driverName'):
+        driver['name'] = diskDict['driverName']
+    if diskDict.has_key('driverType'):
+        driver['type'] = diskDict['driverType']
+    if driver:
+        content += _renderElement('driver', driver)
+
+    if diskDict.get('readonly'):
+        content += '<readonly/>'
+
+    return _renderElement('disk', {'type' : diskDict['diskType'],
+                                   'device' : diskDict['diskDevice']},
+                          content)
+
+def _renderNetwork(netDict):
+    """Returns the XML of L{networkElement}."""
+    interfaceType = netDict['interfaceType']
+    content = ''
+    if interfaceType == 'user':
+        if netDict.has_key('macAddress'):
+            content += _renderElement('mac',
+                                      {'address' : netDict['macAddress']})
+    elif interfaceType == 'ethernet':
+        if netDict.has_key('target'):
+            content += _renderElement('target', {'dev' : netDict['target']})
+        if netDict.has_key('script'):
+            content += _renderElement('script', {'path' : netDict['script']})
+    elif interfaceType == 'network' or interfaceType == 'bridge':
+        content += _renderElement('source',
+                                  {interfaceType : netDict['sourceName']})
+        if netDict.has_key('target'):
+            content += _renderElement('target', {'dev' : netDict['target']})
+        if netDict.has_key('macAddress'):
+            content += _renderElement('mac',
+                                      {'address' : netDict['macAddress']})
+    elif(interfaceType == 'server' or interfaceType == 'client' or
+         interfaceType == 'mcast'):
+        content += _renderElement('source',
+                                  {'address' : netDict['sourceAddress'],
+                                   'port' : netDict['sourcePort']})
+    else:
+        raise ValueError
+
+    return _renderElement('interface', {'type' : interfaceType},
+                          content or None)
+
+def renderDomain(spec):
+    """
+    Renders the libvirt domain for a L{domain description<getDomainSpec>}
+    straight to XML, without building a DOM.  The result is the same as
+    L{Ovf.xmlString} of L{renderDomainDocument}.
+
+    @param spec: domain description
+    @type spec: dictionary
+
+    @return: domain XML document
+    @rtype: String
+    """
+    graphics = spec['graphics']
+    graphicsAttributes = {'type' : graphics['graphicsType']}
+    if graphics.get('listen') != None:
+        graphicsAttributes['listen'] = graphics['listen']
+    if graphics.get('port') != None:
+        graphicsAttributes['port'] = graphics['port']
+    console = spec['console']
+
+    devices = [_renderElement('graphics', graphicsAttributes),
+               _renderElement('console', {'type' : console['deviceType']},
+                              _renderElement('target',
+                                             {'port' : console['port']}))]
+    for diskDict in spec['disks']:
+        devices.append(_renderDisk(diskDict))
+    for netDict in spec['networks']:
+        devices.append(_renderNetwork(netDict))
+
+    features = spec['features']
+    featureXml = ''.join(['<%s/>' % name
+                          for name in ('pae', 'nonpae', 'acpi', 'apic')
+                          if features.get(name)])
+
+    return ''.join(['<?xml version="1.0" encoding="UTF-8"?>',
+                    _renderElement('domain', {'type' : spec['domainType']},
+                        ''.join([_renderBoot(spec['boot']),
+                                 _renderText('name', spec['name']),
+                                 _renderUuid(spec.get('uuid')),
+                                 _renderText('memory', spec['memory']),
+                                 _renderText('vcpu', spec['vcpu']),
+                                 _renderElement('clock',
+                                                {'sync' : spec['clock']}),
+                                 _renderElement('features', None,
+                                                featureXml or None),
+                                 _renderText('on_poweroff',
+                                             spec['onPowerOff']),
+                                 _renderText('on_reboot', spec['onReboot']),
+                                 _renderText('on_crash', spec['onCrash']),
+                                 _renderElement('devices', None,
+                                                ''.join(devices))]))])
+
+def makeUuid():
+    """
+    Returns a random (version 4) RFC 4122 uuid.
+
+    @return: uuid, as in 3e3fce45-4f53-4fa7-bb32-11f34168b82b
+    @rtype: String
+    """
+    data = [ord(byte) for byte in os.urandom(16)]
+    data[6] = (data[6] & 0x0f) | 0x40
+    data[8] = (data[8] & 0x3f) | 0x80
+    hexData = ''.join(['%02x' % byte for byte in data])
+    return '-'.join([hexData[0:8], hexData[8:12], hexData[12:16],
+                     hexData[16:20], hexData[20:32]])
+
+def makeMacAddress(used=None):
+    """
+    Returns a random MAC address in the range libvirt uses for its
+    guests, 52:54:00:xx:xx:xx.
+
+    @param used: addresses not to return; the new address is added
+    @type used: set
+
+    @return: MAC address
+    @rtype: String
+    """
+    while True:
+        data = [ord(byte) for byte in os.urandom(3)]
+        address = '52:54:00:%02x:%02x:%02x' % tuple(data)
+        if used == None:
+            return address
+        if address not in used:
+            used.add(address)
+            return address
+
+def _getVirtualSystems(ovf, configId=None):
+    """
+    Finds what L{getOvfDomainSpecs} and L{getOvfPlan} need in an envelope,
+    walking it once.
+
+    @return: (configId, References Node, L{DiskIndex}, list of
+             (VirtualSystem, VirtualHardwareSection) pairs in document
+             order)
+    @rtype: tuple
+    """
+    index = Ovf.indexElements(ovf)
 
     if configId == None:
-        configId = Ovf.getDefaultConfiguration(ovf)
+        configId = Ovf.getDefaultConfiguration(ovf, index)
     else:
-        if not Ovf.isConfiguration(ovf, configId):
-            raise RuntimeError("OvfLibvirt.getOvfDomains: configuration " +
+        if not Ovf.isConfiguration(ovf, configId, index):
+            raise RuntimeError("OvfLibvirt.getOvfDomainSpecs: configuration " +
                                 configId + " not found.")
 
     # Get Nodes
-    references = Ovf.getElementsByTagName(ovf, 'References')
-    diskSection = Ovf.getElementsByTagName(ovf, 'DiskSection')
+    references = index.get('References', [])
+    diskSection = index.get('DiskSection', [])
 
     if len(references) is not 1:
         raise NotImplementedError("OvfLibvirt.getOvfDomain: Unable to locate" +
@@ -1252,92 +1882,494 @@ def getOvfDomains(ovf, path, hypervisor=None, configId=None, envDirectory=None):
                                   " a single DiskSection node.")
     else:
         refs = references[0]
-        disks = diskSection[0]
-
-    # For each system, create libvirt domain description
-    for system in Ovf.getNodes(ovf, (Ovf.hasTagName, 'VirtualSystem')):
-        ovfId = system.getAttribute('ovf:id')
-
-        # Get VirtualHardwareSection
-        virtualHardwareSection = Ovf.getElementsByTagName(system,
-                                                          'VirtualHardwareSection')
-
+        disks = DiskIndex(refs, diskSection[0])
+
+    # VirtualHardwareSections by the VirtualSystem they are in
+    hardwareSections = {}
+    for section in index.get('VirtualHardwareSection', []):
+        parent = section.parentNode
+        while(parent != None and parent.nodeType == Node.ELEMENT_NODE and
+              parent.tagName != 'VirtualSystem'):
+            parent = parent.parentNode
+        hardwareSections.setdefault(parent, []).append(section)
+
+    systems = []
+    for system in index.get('VirtualSystem', []):
+        virtualHardwareSection = hardwareSections.get(system, [])
         if len(virtualHardwareSection) is not 1:
             raise NotImplementedError("OvfLibvirt.getOvfDomain: Unable to locate" +
                                       " a single VirtualHardwareSection node.")
+        systems.append((system, virtualHardwareSection[0]))
+
+    return (configId, refs, disks, systems)
+
+def _isConfigurable(virtualHardware):
+    """Tests if an Item of a VirtualHardwareSection has ovf:configuration."""
+    for child in virtualHardware.childNodes:
+        if(child.nodeType == Node.ELEMENT_NODE and child.tagName == 'Item' and
+           child.hasAttribute('ovf:configuration')):
+            return True
+    return False
+
+def compileOvfDomainSpecs(ovf, hypervisor=None, configId=None, previous=None):
+    """
+    Compiles the domain of each VirtualSystem in an ovf for a
+    configuration, see L{compileDomainSpec}.
+
+    @param ovf: Ovf file
+    @type ovf: DOM Document
+
+    @param hypervisor: virtual system type, default is what each
+                       VirtualSystem asks for
+    @type hypervisor: String
+
+    @param configId: configuration name
+    @type configId: String
+
+    @param previous: result of this function for the same ovf and
+                     hypervisor, and another configuration.  The
+                     VirtualSystems whose hardware does not depend on the
+                     configuration are taken from it, not compiled again.
+    @type previous: dictionary
+
+    @return: dictionary with
+        - configuration: configuration name, None without
+          DeploymentOptionSection
+        - specs: ovf:id to compiled domain description
+        - configurable: ovf:ids of the VirtualSystems with Items that
+          depend on the configuration
+    @rtype: dictionary
+    """
+    (configId, refs, disks, systems) = _getVirtualSystems(ovf, configId)
+
+    compiled = dict(configuration=configId, specs={}, configurable=[])
+    for (system, hardwareSection) in systems:
+        ovfId = system.getAttribute('ovf:id')
+        configurable = _isConfigurable(hardwareSection)
+        if configurable:
+            compiled['configurable'].append(ovfId)
+        elif previous != None and previous['specs'].has_key(ovfId):
+            compiled['specs'][ovfId] = previous['specs'][ovfId]
+            continue
+
+        virtualHardware = HardwareProfile(hardwareSection, configId)
+        compiled['specs'][ovfId] = compileDomainSpec(system, virtualHardware,
+                                                     refs, disks, hypervisor)
+
+    return compiled
+
+class DomainSpecCache:
+    """
+    Compiled domain descriptions, see L{compileOvfDomainSpecs}, by digest
+    of the envelope, configuration and hypervisor.  Booting the same
+    appliance again then skips interpreting the envelope, and switching
+    configurations only compiles the VirtualSystems that depend on one.
+
+    Entries are kept in memory and, given a directory, as one JSON file
+    each in it, so later processes find them too.  The digest names the
+    document, so an entry never goes stale.  Only the maxEntries used last
+    are kept in memory; nothing is removed from the directory.
+
+    @ivar hits: entries found in memory or in the directory
+    @type hits: int
+
+    @ivar misses: entries compiled
+    @type misses: int
+    """
+    def __init__(self, directory=None, maxEntries=64):
+        """
+        @param directory: directory for the JSON files, created if needed.
+                          Not used if no json module is available.
+        @type directory: String
+
+        @param maxEntries: number of entries kept in memory
+        @type maxEntries: int
+        """
+        if json == None:
+            directory = None
+        self.directory = directory
+        self.maxEntries = maxEntries
+        self.entries = {}
+        self._used = []
+        self.hits = 0
+        self.misses = 0
+
+    def getSpecs(self, ovf, hypervisor=None, configId=None, digest=None):
+        """
+        Returns the compiled domain descriptions of ovf for a
+        configuration, compiling them if they are not cached.  The result
+        must not be changed, see L{provisionDomainSpec}.
+
+        @param ovf: Ovf file
+        @type ovf: DOM Document
+
+        @param hypervisor: virtual system type, default is what each
+                           VirtualSystem asks for
+        @type hypervisor: String
+
+        @param configId: configuration name
+        @type configId: String
+
+        @param digest: sha1 of the document, as in L{OvfFile.getDigest}.
+                       Computed from ovf if not given.
+        @type digest: String
+
+        @return: see L{compileOvfDomainSpecs}
+        @rtype: dictionary
+        """
+        if digest == None:
+            digest = sha.new(ovf.toxml('UTF-8')).hexdigest()
+        if hypervisor:
+            hypervisor = hypervisor.lower()
+        key = (digest, configId, hypervisor)
+
+        entry = self.entries.get(key)
+        if entry == None:
+            entry = self._load(key)
+        if entry != None:
+            self.hits += 1
         else:
-            virtualHardware = virtualHardwareSection[0]
+            self.misses += 1
+            previous = None
+            for (other, otherEntry) in self.entries.items():
+                if other[0] == digest and other[2] == hypervisor:
+                    previous = otherEntry
+                    break
+            entry = compileOvfDomainSpecs(ovf, hypervisor, configId, previous)
+            self._store(key, entry)
+            if configId == None and entry['configuration'] != None:
+                # the default configuration is the same entry
+                named = (digest, entry['configuration'], hypervisor)
+                self._keep(named, entry)
+                self._store(named, entry)
+
+        self._keep(key, entry)
+        return entry
+
+    def _keep(self, key, entry):
+        """Keeps an entry in memory, dropping the one used longest ago."""
+        if self.entries.has_key(key):
+            self._used.remove(key)
+        self.entries[key] = entry
+        self._used.append(key)
+        while len(self._used) > self.maxEntries:
+            del self.entries[self._used.pop(0)]
+
+    def getPath(self, key):
+        """
+        Returns the JSON file of an entry.
+
+        @param key: (digest, configId, hypervisor)
+        @type key: tuple
+
+        @rtype: String
+        """
+        name = sha.new(json.dumps(list(key[1:]))).hexdigest()[:16]
+        return os.path.join(self.directory, key[0] + '-' + name + '.json')
+
+    def _load(self, key):
+        """Reads an entry from the directory, None if it is not there."""
+        if self.directory == None:
+            return None
+        try:
+            fileObj = open(self.getPath(key))
+            try:
+                stored = json.load(fileObj)
+            finally:
+                fileObj.close()
+        except (IOError, ValueError):
+            return None
+        if stored.get('key') != list(key):
+            return None
+        return stored['entry']
+
+    def _store(self, key, entry):
+        """Writes an entry to the directory, replacing it atomically."""
+        if self.directory == None:
+            return
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        (fd, tmpPath) = tempfile.mkstemp(dir=self.directory)
+        fileObj = os.fdopen(fd, 'w')
+        try:
+            json.dump(dict(key=list(key), entry=entry), fileObj)
+        finally:
+            fileObj.close()
+        os.rename(tmpPath, self.getPath(key))
+
+def getOvfDomainSpecs(ovf, path, hypervisor=None, configId=None,
+                      envDirectory=None, strategies=None, cache=None,
+                      digest=None, workers=1, envFiles=None):
+    """
+    Returns a dictionary with all of the VirtualSystems in an ovf listed as
+    keys with their L{domain description<getDomainSpec>}, for the specified
+    configuration, stored as the value.
 
-            #metadata
-            name = nameElement(ovfId)
+    @param ovf: Ovf file
+    @type ovf: DOM Document
 
-            #resources
-            memory = memoryElement(getOvfMemory(virtualHardware, configId))
-            vcpu = vcpuElement(getOvfVcpu(virtualHardware, configId))
+    @param path: directory of the disk image files
+    @type path: String
 
-            #domain
-            if not hypervisor:
-                hypervisor = OvfPlatform.getVsSystemType(system)
-            else:
-                hypervisor = hypervisor.lower()
-            domainType = getDomainTypeForVsType(hypervisor)
-            domain = domainElement(domainType)
+    @param hypervisor: virtual system type, default is what each
+                       VirtualSystem asks for
+    @type hypervisor: String
+
+    @param configId: configuration name
+    @type configId: String
+
+    @param envDirectory: directory holding an environment iso for each
+                         VirtualSystem, named after its ovf:id
+    @type envDirectory: String
+
+    @param strategies: provisioning strategies for shared disk files, see
+                       L{getDomainSpec}
+    @type strategies: sequence of Strings
+
+    @param cache: cache of compiled descriptions to use
+    @type cache: L{DomainSpecCache}
 
-            #boot
-            bootElements(domain, hypervisor)
+    @param digest: sha1 of the document, see L{DomainSpecCache.getSpecs}
+    @type digest: String
 
-            #time
-            clock = clockElement('utc')
+    @param workers: number of VirtualSystems whose images are provisioned
+                    at the same time.  When one fails no other is started,
+                    the images made for the others are removed and its
+                    error is raised.
+    @type workers: int
 
-            #features
-            features = featuresElement(acpi=True)
+    @param envFiles: ovf:id to the environment iso of a VirtualSystem, in
+                     place of the one in envDirectory
+    @type envFiles: dictionary
+
+    @return: ovf:id to domain description
+    @rtype: dictionary
+    """
+    #directory = os.path.abspath(path.rsplit("/", 1)[0])
+    directory = path
+
+    if cache != None:
+        compiled = cache.getSpecs(ovf, hypervisor, configId, digest)
+    else:
+        compiled = compileOvfDomainSpecs(ovf, hypervisor, configId)
+
+    # For each system, provision the images of its domain
+    jobs = []
+    for (ovfId, spec) in compiled['specs'].items():
+        envFile = None
+        if envFiles and envFiles.has_key(ovfId):
+            envFile = envFiles[ovfId]
+        elif envDirectory:
+            envFile = os.path.join(envDirectory, ovfId + '.iso')
+        jobs.append((ovfId, (spec, envFile)))
+    jobs.sort()
+
+    def provision(ovfId, job):
+        return provisionDomainSpec(job[0], directory, job[1], strategies)
+
+    (specs, error) = Ovf.runPool(provision, jobs, workers)
+    if error != None:
+        for (ovfId, spec) in specs.items():
+            _removeImages(getProvisionedImages(compiled['specs'][ovfId],
+                                               spec, directory))
+        raise error[0], error[1], error[2]
+
+    return specs
+
+def getOvfDomains(ovf, path, hypervisor=None, configId=None, envDirectory=None,
+                  template=True, cache=None, digest=None, workers=1,
+                  envFiles=None):
+    """
+    Returns a dictionary with all of the VirtualSystems in an ovf
+    listed as keys with the libvirt domain, for the specified configuration,
+    stored as the value.  The values are L{DomainXml} strings.
 
-            #life cycle
-            onPowerOff = onPowerOffElement('destroy')
-            onReboot = onRebootElement('restart')
-            onCrash = onCrashElement('destroy')
+    @param ovf: Ovf file
+    @type ovf: DOM Document
 
-            #devices - graphics
-            graphics = graphicsElement('vnc', 'localhost', '-1')
+    @param path: path to Ovf file
+    @type path: String
 
-            #devices - console
-            console = consoleElement('pty', '0')
+    @param configId: configuration name
+    @type configId: String
 
-            #devices
-            devices = devicesElement(graphics, console)
+    @param template: render the XML with L{renderDomain}; if False build
+                     it as a DOM with L{renderDomainDocument}.  Both give
+                     the same XML.
+    @type template: boolean
 
-            #disks
-            envFile = None
-            if envDirectory:
-                envFile = os.path.join(envDirectory, ovfId + '.iso')
-            diskDicts = getOvfDisks(virtualHardware, directory, refs,
-                                    disks, configId, envFile)
-            for dsk in diskDicts:
-                addDevice(devices, diskElement(dsk))
+    @param cache: cache of compiled descriptions to use
+    @type cache: L{DomainSpecCache}
 
-            #network
-            netDicts = getOvfNetworks(virtualHardware, configId)
-            for networkDict in netDicts:
-                network = networkElement(networkDict)
-                addDevice(devices, network)
+    @param digest: sha1 of the document, see L{DomainSpecCache.getSpecs}
+    @type digest: String
 
-            #document
-            document = libvirtDocument(domain, name, memory, vcpu,
-                                       clock, features, onPowerOff,
-                                       onReboot, onCrash, devices)
+    @param workers: number of VirtualSystems whose images are provisioned
+                    at the same time, see L{getOvfDomainSpecs}
+    @type workers: int
 
-        domains[ovfId] = Ovf.xmlString(document)
+    @param envFiles: ovf:id to environment iso, see L{getOvfDomainSpecs}
+    @type envFiles: dictionary
 
-    # Delete any extra copies of disk images
-    cleanupExtraDiskImages(directory, refs, disks)
+    @todo: needs work, very basic, assumes hypervisor type
+    """
+    domains = dict()
+    specs = getOvfDomainSpecs(ovf, path, hypervisor, configId, envDirectory,
+                              cache=cache, digest=digest, workers=workers,
+                              envFiles=envFiles)
+    for (ovfId, spec) in specs.items():
+        if template:
+            xml = renderDomain(spec)
+        else:
+            xml = Ovf.xmlString(renderDomainDocument(spec))
+        domains[ovfId] = DomainXml(xml, spec['domainType'])
 
     return domains
 
+def getOvfPlan(ovf, path, hypervisor=None, configId=None, strategies=None,
+               sizes=None):
+    """
+    Returns what L{getOvfDomains} would allocate and write for a
+    configuration, without writing anything or using libvirt: only the
+    envelope is read, and the disk image files are only looked at with
+    os.stat.
+
+    Each Disk whose file is shared gets its own image, see L{getOvfDisks};
+    the plan gives the strategy that would be tried first and the bytes it
+    writes, and the bytes a full copy writes should every other strategy
+    fail.  Other disks are used in place and write nothing.
+
+    The plan has these keys, all values being Strings, numbers, None,
+    lists or dictionaries, so that it can be written as JSON:
+        - configuration: configuration name, None without
+          DeploymentOptionSection
+        - systems: ovf:id to a dictionary of
+            - domainType: libvirt domain type
+            - memory: bytes of memory
+            - vcpu: number of virtual cpus
+            - disks: list of dictionaries of
+                - diskId: ovf:diskId
+                - file: href of the image file
+                - bytes: size of the image file, None if it is missing
+                - shared: True if other Disks use the file
+                - strategy: first provisioning strategy, None if the file
+                  is used in place
+                - bytesWritten: bytes that strategy writes
+                - worstCaseBytes: bytes a full copy writes
+            - bytesWritten, worstCaseBytes: the sums for its disks
+        - memory, vcpu, bytesWritten, worstCaseBytes: the sums for all
+          VirtualSystems
+        - missing: hrefs of image files that do not exist
+
+    @param ovf: Ovf file
+    @type ovf: DOM Document
+
+    @param path: directory of the disk image files
+    @type path: String
+
+    @param hypervisor: virtual system type, default is what each
+                       VirtualSystem asks for
+    @type hypervisor: String
+
+    @param configId: configuration name
+    @type configId: String
+
+    @param strategies: provisioning strategies for shared disk files, see
+                       L{getDomainSpec}
+    @type strategies: sequence of Strings
+
+    @param sizes: href to the size of each image file, as in an archive
+                  that is not extracted; path is not looked at then
+    @type sizes: dictionary
+
+    @return: plan
+    @rtype: dictionary
+    """
+    (configId, refs, index, systems) = _getVirtualSystems(ovf, configId)
+
+    plan = dict(configuration=configId, systems={}, memory=0, vcpu=0,
+                bytesWritten=0, worstCaseBytes=0, missing=[])
+    found = {}
+    for (system, hardwareSection) in systems:
+        profile = HardwareProfile(hardwareSection, configId)
+        domainType = _getSystemTypes(system, hypervisor)[1]
+        systemStrategies = strategies
+        if systemStrategies == None:
+            systemStrategies = OvfProvision.getStrategies(domainType)
+
+        memory = getOvfMemory(profile)
+        vcpu = getOvfVcpu(profile)
+        systemPlan = dict(domainType=domainType,
+                          memory=memory and int(memory) * 1024 or 0,
+                          vcpu=vcpu and int(vcpu) or 0,
+                          disks=[], bytesWritten=0, worstCaseBytes=0)
+
+        for resource in profile.getItems('14', '15', '17'):
+            hostResource = resource['rasd:HostResource']
+            for (fileId, diskId, shared) in index.getHostResources(hostResource):
+                href = index.getHref(fileId)
+                if href == None:
+                    continue
+                if not found.has_key(href):
+                    if sizes != None:
+                        found[href] = sizes.get(os.path.normpath(href))
+                    else:
+                        try:
+                            found[href] = os.path.getsize(os.path.join(path,
+                                                                       href))
+                        except OSError:
+                            found[href] = None
+                    if found[href] == None:
+                        plan['missing'].append(href)
+                size = found[href]
+
+                strategy = None
+                written = 0
+                worstCase = 0
+                if shared and systemStrategies:
+                    strategy = systemStrategies[0]
+                    if size == None:
+                        written = worstCase = None
+                    else:
+                        worstCase = size
+                        if strategy == 'overlay':
+                            written = OvfProvision.getOverlaySize(size)
+                        elif strategy == 'reflink':
+                            written = 0
+                        else:
+                            written = size
+                        if 'copy' not in systemStrategies:
+                            worstCase = written
+
+                systemPlan['disks'].append(dict(diskId=diskId, file=href,
+                                                bytes=size, shared=shared,
+                                                strategy=strategy,
+                                                bytesWritten=written,
+                                                worstCaseBytes=worstCase))
+                for key, value in (('bytesWritten', written),
+                                   ('worstCaseBytes', worstCase)):
+                    if value != None:
+                        systemPlan[key] += value
+
+        plan['systems'][system.getAttribute('ovf:id')] = systemPlan
+        for key in ('memory', 'vcpu', 'bytesWritten', 'worstCaseBytes'):
+            plan[key] += systemPlan[key]
+
+    return plan
+
+#: StartupSection Item attributes kept by L{getOvfStartup}
+STARTUP_ATTRIBUTES = ('ovf:order', 'ovf:startDelay', 'ovf:waitingForGuest',
+                      'ovf:startAction', 'ovf:stopDelay', 'ovf:stopAction')
+
 def getOvfStartup(ovf):
     """
     Returns a schedule representing the startup order for a virtual
     appliance from an ovf.
 
+    Each entity maps the L{StartupSection attributes<STARTUP_ATTRIBUTES>}
+    of its Item to their values; a collection also has 'systems', the ids of
+    its members.
+
     @param ovf: Ovf file
     @type ovf: DOM Document
 
@@ -1360,8 +2392,7 @@ def getOvfStartup(ovf):
                 attr = item.attributes.item(i)
                 if attr.name == 'ovf:id':
                     sysId = attr.value
-                elif(attr.name == 'ovf:order' or
-                   attr.name == 'ovf:startDelay'):
+                elif attr.name in STARTUP_ATTRIBUTES:
                     attributes.append((attr.name, attr.value))
 
             # Store attribute pairs in dicitonary
@@ -1371,11 +2402,17 @@ def getOvfStartup(ovf):
             if not virtualSys.has_key('ovf:startDelay'):
                 virtualSys['ovf:startDelay'] = '0'
 
+            # a collection may already have an entry from its own section
             parentId = section.parentNode.getAttribute('ovf:id')
             if not systems.has_key(parentId):
                 systems[parentId] = dict(systems=[])
+            elif not systems[parentId].has_key('systems'):
+                systems[parentId]['systems'] = []
             systems[parentId]['systems'].append(sysId)
-            systems[sysId] = virtualSys
+            if systems.has_key(sysId):
+                systems[sysId].update(virtualSys)
+            else:
+                systems[sysId] = virtualSys
 
     # Create a default entry for each system not in a startup section
     for each in Ovf.getNodes(ovf, (Ovf.hasTagName, 'VirtualSystem')):
@@ -1391,7 +2428,7 @@ def getOvfStartup(ovf):
             parentId = parent.getAttribute('ovf:id')
             if systems.has_key(parentId) and \
                 not systems.has_key(sysId):
-                systems[parentId]['systems'].append(sysId)
+                systems[parentId].setdefault('systems', []).append(sysId)
                 systems[sysId] = {'ovf:order':'0', 'ovf:startDelay':'0'}
 
             # set parent info
@@ -1401,7 +2438,9 @@ def getOvfStartup(ovf):
             while(not systems.has_key(parentId)):
                 systems[parentId] = {'systems':[]}
                 systems[parentId]['systems'].append(sysId)
-                systems[sysId] = {'ovf:order':'0', 'ovf:startDelay':'0'}
+                entry = systems.setdefault(sysId, {})
+                entry.setdefault('ovf:order', '0')
+                entry.setdefault('ovf:startDelay', '0')
 
                 # Increment, if not at root
                 if parent.parentNode.tagName == 'Envelope':
@@ -1436,58 +2475,183 @@ def cleanupExtraDiskImages(dir, references, diskSection):
     """
     Check if any image file is referred more than once, and remove extra copies
 
+    L{getOvfDomains} no longer calls this: the per-Disk images it provisions
+    may be overlays backed by the shared files, and keeping the shared files
+    lets the package be deployed again.
+
     @param dir: directory path to Ovf file/disk image files
     @type dir: String
+
+    @param references: Ovf References Node
+    @type references: DOM Element
+
+    @param diskSection: Ovf DiskSection Node or L{DiskIndex}
+    @type diskSection: DOM Element or L{DiskIndex}
     """
-    # Get file list from References and list of disks from DiskSection
-    refList = Ovf.getDict(references)['children']
-    diskList = Ovf.getDict(diskSection)['children']
+    index = getDiskIndex(references, diskSection)
 
     # Clean up image files referred more than once
-    for file in refList:
-        fileId = file['ovf:id']
-        source = os.path.join(dir, file['ovf:href'])
-        fileRefCnt = 0
-        prefCnt = 0
-        for disk in diskList:
-            if disk.has_key('ovf:fileRef'):
-                if disk['ovf:fileRef'] == fileId:
-                    fileRefCnt = fileRefCnt + 1
-
-            if disk.has_key('ovf:parentRef'):
-                if disk['ovf:parentRef'] == fileId:
-                    prefCnt = prefCnt + 1
-
-        if fileRefCnt >= 2 or prefCnt >= 2:
-            if os.path.isfile(source):
-                os.remove(source)
-
-def startDomain(domainXml):
+    for fileId in index.getSharedFiles():
+        source = os.path.join(dir, index.getHref(fileId))
+        if os.path.isfile(source):
+            os.remove(source)
+
+class DomainXml(unicode):
     """
-    Starts the domain given the Xml string
+    Libvirt domain XML, as made by L{getOvfDomains}, that also carries the
+    domain type so it need not be parsed again to start the domain.
+
+    @ivar domainType: libvirt domain type, as in 'kvm'
+    @type domainType: String
+    """
+    def __new__(cls, xml, domainType):
+        """
+        @param xml: domain XML
+        @type xml: String
+
+        @param domainType: libvirt domain type of the domain
+        @type domainType: String
+        """
+        domainXml = unicode.__new__(cls, xml)
+        domainXml.domainType = domainType
+        return domainXml
+
+    def __getnewargs__(self):
+        """Arguments of L{__new__} for copy and pickle."""
+        return (unicode(self), self.domainType)
+
+def getDomainType(domainXml):
+    """
+    Returns the libvirt domain type of domain XML.  A L{DomainXml} is not
+    parsed.
+
     @param domainXml: Xml string defining the domain
-    @type domains: String
+    @type domainXml: String or L{DomainXml}
+
+    @return: domain type, as in 'kvm'
+    @rtype: String
+    """
+    domainType = getattr(domainXml, 'domainType', None)
+    if domainType == None:
+        document = parseString(domainXml)
+        domainElement = document.getElementsByTagName('domain')[0]
+        domainType = domainElement.getAttribute('type')
+    return domainType
+
+def openConnection(uri):
+    """
+    Opens a libvirt connection.
+
+    @param uri: libvirt connection string
+    @type uri: String
+
+    @return: connection
+    @rtype: libvirt virConnect
     """
     import libvirt
-    # Get the domain type from the xml
-    document = parseString(domainXml)
-    domainElement = document.getElementsByTagName('domain')[0]
-    domainType = domainElement.getAttribute('type')
+    return libvirt.open(uri)
+
+class ConnectionPool:
+    """
+    Libvirt connections shared by all users of the same connection string.
+    A connection is opened when first asked for and kept until L{close}; one
+    that libvirt reports as dead is opened again.
+    """
+    def __init__(self, opener=openConnection):
+        """
+        @param opener: called with a connection string, returns a connection
+        @type opener: function
+        """
+        self.opener = opener
+        self.connections = {}
+        self._lock = threading.Lock()
+
+    def getConnection(self, uri):
+        """
+        Returns the connection for uri, opening it if needed.
+
+        @param uri: libvirt connection string
+        @type uri: String
+
+        @return: connection
+        @rtype: libvirt virConnect
+        """
+        self._lock.acquire()
+        try:
+            conn = self.connections.get(uri)
+            if conn != None and hasattr(conn, 'isAlive') and not conn.isAlive():
+                conn = None
+            if conn == None:
+                conn = self.opener(uri)
+                self.connections[uri] = conn
+            return conn
+        finally:
+            self._lock.release()
+
+    def close(self):
+        """Closes all connections."""
+        self._lock.acquire()
+        try:
+            for conn in self.connections.values():
+                conn.close()
+            self.connections = {}
+        finally:
+            self._lock.release()
+
+#: connections used by L{startDomain} unless given others
+CONNECTION_POOL = ConnectionPool()
+
+def startDomain(domainXml, pool=None):
+    """
+    Starts the domain given the Xml string
+    @param domainXml: Xml string defining the domain
+    @type domainXml: String or L{DomainXml}
 
-    # Get the appropriate connection string for the domain type
-    connString = getConnectionStringForVirtType(domainType)
+    @param pool: connections to use, default is L{CONNECTION_POOL}
+    @type pool: L{ConnectionPool}
 
-    # Open the libvirt connection
-    conn = libvirt.open(connString)
+    @return: the started domain
+    @rtype: libvirt virDomain
+    """
+    if pool == None:
+        pool = CONNECTION_POOL
+
+    # Get the appropriate connection string for the domain type
+    connString = getConnectionStringForVirtType(getDomainType(domainXml))
 
     # Create the domain
-    conn.createLinux(domainXml, 0)
+    conn = pool.getConnection(connString)
+    return conn.createLinux(domainXml, 0)
+
+def stopDomain(domain, stopAction='powerOff'):
+    """
+    Stops a domain started by L{startDomain}.
+
+    @raise ValueError: unknown stopAction
+
+    @param domain: the running domain
+    @type domain: libvirt virDomain
+
+    @param stopAction: StartupSection stopAction, 'powerOff', 'guestShutdown'
+                       or 'none'
+    @type stopAction: String
+    """
+    if stopAction == 'powerOff':
+        domain.destroy()
+    elif stopAction == 'guestShutdown':
+        domain.shutdown()
+    elif stopAction != 'none':
+        raise ValueError("OvfLibvirt.stopDomain: unknown stopAction " +
+                         stopAction)
 
 def getSchedule(startup, domains):
     """
     Returns a schedule representing the startup order for a virtual
     appliance and boots the defined domains.
 
+    The schedule starts one domain at a time; L{BootScheduler} starts each
+    order group concurrently and can also stop the appliance.
+
     @param startup: L{Startup dictionary<getOvfStartup>}
     @type startup: dictionary
 
@@ -1521,3 +2685,227 @@ def getSchedule(startup, domains):
             queue.extend(system['systems'])
 
     return schedule
+
+class BootScheduler:
+    """
+    Starts and stops the domains of a virtual appliance in the order given
+    by its StartupSections.
+
+    The members of a collection start in waves, one per ovf:order value in
+    ascending order.  The members of a wave start concurrently, and the
+    next wave starts when each of them has started and waited its
+    startDelay.  With waitingForGuest, and a guestReady test, the wait ends
+    as soon as the guest is ready.  A member that is itself a collection
+    starts its own waves the same way.  Stopping runs the waves in reverse,
+    using each member's stopAction and stopDelay.  An entity whose
+    startAction is none is not started, nor waited for.
+
+    @ivar started: domain id to the running domain, as returned by startAction
+    @type started: dictionary
+
+    @ivar latencies: domain id to the seconds its startAction took
+    @type latencies: dictionary
+    """
+    def __init__(self, startup, domains, workers=8, guestReady=None,
+                 startAction=startDomain, stopAction=stopDomain,
+                 sleep=time.sleep, clock=time.time, pollInterval=1):
+        """
+        @param startup: L{Startup dictionary<getOvfStartup>}
+        @type startup: dictionary
+
+        @param domains: L{Domain dictionary<getOvfDomains>}
+        @type domains: dictionary
+
+        @param workers: most startActions to run at the same time
+        @type workers: int
+
+        @param guestReady: called with a started domain, returns True when
+                           its guest is ready.  Without it waitingForGuest
+                           waits the whole startDelay.
+        @type guestReady: function
+
+        @param startAction: called with the domain XML, returns the domain
+        @type startAction: function
+
+        @param stopAction: called with a started domain and its stopAction
+        @type stopAction: function
+
+        @param sleep: function to wait a number of seconds
+        @type sleep: function
+
+        @param clock: function returning the current time in seconds
+        @type clock: function
+
+        @param pollInterval: seconds between guestReady tests
+        @type pollInterval: number
+        """
+        self.startup = startup
+        self.domains = domains
+        self.guestReady = guestReady
+        self.startAction = startAction
+        self.stopAction = stopAction
+        self.sleep = sleep
+        self.clock = clock
+        self.pollInterval = pollInterval
+        self.started = {}
+        self.latencies = {}
+        self._slots = threading.Semaphore(workers)
+
+    def getWaves(self, sysId=None):
+        """
+        Returns the members of an entity grouped by ascending ovf:order.
+
+        @param sysId: entity id, default is the root of the appliance
+        @type sysId: String
+
+        @return: list of lists of entity ids; a VirtualSystem is a single
+                 wave with itself
+        @rtype: list
+        """
+        if sysId == None:
+            sysId = self.startup['boot']
+        entities = self.startup['entities']
+        entity = entities[sysId]
+        if not entity.has_key('systems'):
+            return [[sysId]]
+
+        groups = {}
+        for member in entity['systems']:
+            order = int(entities[member].get('ovf:order', '0'))
+            wave = groups.setdefault(order, [])
+            if member not in wave:
+                wave.append(member)
+        orders = groups.keys()
+        orders.sort()
+        return [groups[order] for order in orders]
+
+    def getTimeline(self, sysId=None):
+        """
+        Returns when each domain of an entity would start, without starting
+        anything: every startAction is taken to be instant and every wait
+        to last its whole startDelay, so this is the longest the startup
+        takes apart from the startActions themselves.
+
+        @param sysId: entity id, default is the root of the appliance
+        @type sysId: String
+
+        @return: (domain id to its start in seconds from the beginning,
+                 seconds until the startup is done)
+        @rtype: tuple
+        """
+        if sysId == None:
+            sysId = self.startup['boot']
+        timeline = {}
+        end = self._getTimeline(sysId, 0, timeline)
+        return (timeline, end)
+
+    def _getTimeline(self, sysId, begin, timeline):
+        """Adds the starts of an entity to timeline, returns when it ends."""
+        entity = self.startup['entities'][sysId]
+        if entity.get('ovf:startAction') == 'none':
+            return begin
+
+        end = begin
+        if entity.has_key('systems'):
+            for wave in self.getWaves(sysId):
+                waveEnd = end
+                for member in wave:
+                    waveEnd = max(waveEnd,
+                                  self._getTimeline(member, end, timeline))
+                end = waveEnd
+        else:
+            timeline[sysId] = begin
+
+        return end + int(entity.get('ovf:startDelay', '0'))
+
+    def start(self):
+        """
+        Starts the appliance.  When a startAction fails the rest of its
+        wave still starts, but no later wave does.
+
+        @raise Exception: the first error of the failed wave
+
+        @return: L{latencies<BootScheduler>}
+        @rtype: dictionary
+        """
+        self._startEntity(self.startup['boot'])
+        return self.latencies
+
+    def stop(self, sysId=None):
+        """
+        Stops the started domains of an entity, last wave first.
+
+        @param sysId: entity id, default is the root of the appliance
+        @type sysId: String
+        """
+        if sysId == None:
+            sysId = self.startup['boot']
+        entity = self.startup['entities'][sysId]
+
+        if entity.has_key('systems'):
+            waves = self.getWaves(sysId)
+            waves.reverse()
+            for wave in waves:
+                self._runWave(self.stop, wave)
+        elif self.started.has_key(sysId):
+            self.stopAction(self.started.pop(sysId),
+                            entity.get('ovf:stopAction', 'powerOff'))
+        else:
+            return
+
+        delay = int(entity.get('ovf:stopDelay', '0'))
+        if delay:
+            self.sleep(delay)
+
+    def _startEntity(self, sysId):
+        """Starts a VirtualSystem or the waves of a collection and waits."""
+        entity = self.startup['entities'][sysId]
+        if entity.get('ovf:startAction') == 'none':
+            return
+
+        domain = None
+        if entity.has_key('systems'):
+            for wave in self.getWaves(sysId):
+                self._runWave(self._startEntity, wave)
+        else:
+            self._slots.acquire()
+            try:
+                begin = self.clock()
+                domain = self.startAction(self.domains[sysId])
+                self.latencies[sysId] = self.clock() - begin
+            finally:
+                self._slots.release()
+            self.started[sysId] = domain
+
+        delay = int(entity.get('ovf:startDelay', '0'))
+        waiting = entity.get('ovf:waitingForGuest', 'false') == 'true'
+        if waiting and self.guestReady != None and domain != None:
+            deadline = self.clock() + delay
+            while(not self.guestReady(domain) and self.clock() < deadline):
+                self.sleep(self.pollInterval)
+        elif delay:
+            self.sleep(delay)
+
+    def _runWave(self, function, wave):
+        """Calls function for each id of wave in its own thread."""
+        if len(wave) == 1:
+            function(wave[0])
+            return
+
+        errors = []
+        def run(sysId):
+            try:
+                function(sysId)
+            except Exception, e:
+                errors.append(e)
+
+        threads = []
+        for sysId in wave:
+            thread = threading.Thread(target=run, args=(sysId,))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+        if errors:
+            raise errors[0]
@@ -13,7 +13,6 @@
 This module contains functions dealing with platform information.
 """
 
-import OvfLibvirt
 from locale import getlocale, getdefaultlocale
 from time import timezone
 
@@ -42,6 +41,8 @@ def getVsSystemType(vs):
     @rtype: String
     @return: Platform type for Virtual System
     """
+    # imported here, OvfLibvirt is large and imports this module
+    import OvfLibvirt
     virtTypes = OvfLibvirt.getOvfSystemType(vs)
 
     for virtType in virtTypes:
@@ -15,8 +15,28 @@ product sections in an ovf file.
 """
 
 from xml.dom import Node
+import re
 import Ovf
 
+#: ovf:type of integer properties and their ranges
+INTEGER_TYPES = {'uint8' : (0, 2 ** 8 - 1),
+                 'sint8' : (-2 ** 7, 2 ** 7 - 1),
+                 'uint16' : (0, 2 ** 16 - 1),
+                 'sint16' : (-2 ** 15, 2 ** 15 - 1),
+                 'uint32' : (0, 2 ** 32 - 1),
+                 'sint32' : (-2 ** 31, 2 ** 31 - 1),
+                 'uint64' : (0, 2 ** 64 - 1),
+                 'sint64' : (-2 ** 63, 2 ** 63 - 1)}
+
+#: ovf:type of real properties
+REAL_TYPES = ('real32', 'real64')
+
+#: values of boolean properties
+BOOLEAN_VALUES = ('true', 'false')
+
+_QUALIFIER = re.compile(r'(\w+)\s*(?:\(([^)]*)\)|\{([^}]*)\})')
+_MAP_ENTRY = re.compile(r'"([^"]*)"')
+
 def getPropertyDefaultValue(propertyNode, configuration):
     """
     Get the default value for a given Property node.  The value returned is
@@ -42,29 +62,32 @@ def getPropertyDefaultValue(propertyNode, configuration):
 
         configuration = Ovf.getDefaultConfiguration(docNode)
 
-    if configuration:
-        valueNodes = Ovf.getChildNodes(propertyNode,
-                                       (Ovf.hasTagName, 'Value'),
-                                       (Ovf.hasAttribute, 'ovf:configuration',
-                                        configuration))
-        if valueNodes:
-            attributes = Ovf.getAttributes(valueNodes[0])
-            if attributes.has_key('ovf:value'):
-                return attributes['ovf:value']
-
-    attributes = Ovf.getAttributes(propertyNode)
-    if attributes.has_key('ovf:value'):
-        return attributes['ovf:value']
-
-    valueNodes = Ovf.getChildNodes(propertyNode, (Ovf.hasTagName, 'Value'))
-    if valueNodes:
-        attributes = Ovf.getAttributes(valueNodes[0])
-        if attributes.has_key('ovf:value'):
-            return attributes['ovf:value']
+    return _getValue(propertyNode, configuration)
+
+def _getValue(propertyNode, configuration):
+    """
+    Returns the default value of a Property for a configuration that is
+    already resolved, reading its Value children in one pass.
+    """
+    firstValue = None
+    configured = None
+    for child in propertyNode.childNodes:
+        if child.nodeType != Node.ELEMENT_NODE or child.tagName != 'Value':
+            continue
+        if firstValue == None:
+            firstValue = child
+        if(configured == None and configuration and
+           child.getAttribute('ovf:configuration') == configuration):
+            configured = child
+            break
+
+    for node in (configured, propertyNode, firstValue):
+        if node != None and node.hasAttribute('ovf:value'):
+            return node.getAttribute('ovf:value')
 
     return None
 
-def getPropertiesForNode(node, configuration):
+def getPropertiesForNode(node, configuration, resolver=None):
     """
     Generate an array of tuples containing the environment information
     for a single node (vs or vsc)
@@ -72,18 +95,185 @@ def getPropertiesForNode(node, configuration):
     @param node: virtual system or collection DOM node
     @type configuration: String
     @param configuration: Configuration being used.  Can be None
+    @type resolver: L{PropertyResolver}
+    @param resolver: resolver to use, shared by the nodes of a document.
+                     Default is a new one for node's document and
+                     configuration.
 
     @rtype: array
     @return: array of [(key, property node, value)]
     """
-    # Start by getting all product sections for this node
-    productSections = Ovf.getChildNodes(node, (Ovf.hasTagName,
-                                               'ProductSection'))
-    retArray = []
-
-    # it's valid for there to be 0 product sections
-    if productSections != []:
-        for prodNode in productSections:
+    if resolver == None:
+        resolver = PropertyResolver(node.ownerDocument, configuration)
+    return list(resolver.getProperties(node))
+
+def getValidator(propertyNode):
+    """
+    Returns a function that checks a value of a Property against its
+    ovf:type and ovf:qualifiers.  Both are parsed here, once, so the
+    function is cheap to call for many values.
+
+    Integer types are checked for their range, real types for being a
+    number and boolean for 'true' or 'false'; other types take any String.
+    The qualifiers checked are MinLen(n) and MaxLen(n), on the length of
+    the value, and ValueMap{"a", "b", ...}, whose entries may be integer
+    ranges as in "1..10", "..10" or "1..".  Other qualifiers are ignored.
+
+    @raise ValueError: a qualifier cannot be parsed
+
+    @param propertyNode: Property node
+    @type propertyNode: DOM Element
+
+    @return: function taking a value String, raising ValueError if the
+             value is not valid for the Property
+    @rtype: function
+    """
+    key = propertyNode.getAttribute('ovf:key')
+    propType = propertyNode.getAttribute('ovf:type')
+    checks = []
+
+    if INTEGER_TYPES.has_key(propType):
+        (low, high) = INTEGER_TYPES[propType]
+        def checkInteger(value):
+            number = long(value)
+            if number < low or number > high:
+                raise ValueError(value + " out of range for " + propType)
+        checks.append(checkInteger)
+    elif propType in REAL_TYPES:
+        checks.append(float)
+    elif propType == 'boolean':
+        def checkBoolean(value):
+            if value not in BOOLEAN_VALUES:
+                raise ValueError(value + " is not a boolean")
+        checks.append(checkBoolean)
+
+    for (name, argument, entries) in \
+            _QUALIFIER.findall(propertyNode.getAttribute('ovf:qualifiers')):
+        if name in ('MinLen', 'MaxLen'):
+            try:
+                length = int(argument)
+            except ValueError:
+                raise ValueError("Property " + key + ": bad qualifier " +
+                                 name + "(" + argument + ")")
+            if name == 'MinLen':
+                def checkLength(value, length=length):
+                    if len(value) < length:
+                        raise ValueError("shorter than " + str(length))
+            else:
+                def checkLength(value, length=length):
+                    if len(value) > length:
+                        raise ValueError("longer than " + str(length))
+            checks.append(checkLength)
+        elif name == 'ValueMap':
+            checks.append(_getValueMapCheck(_MAP_ENTRY.findall(entries)))
+
+    def validate(value):
+        for check in checks:
+            try:
+                check(value)
+            except ValueError, e:
+                raise ValueError("Property " + key + ": invalid value '" +
+                                 value + "', " + str(e))
+    return validate
+
+def _getValueMapCheck(entries):
+    """Returns the check of a ValueMap qualifier with the given entries."""
+    values = {}
+    ranges = []
+    for entry in entries:
+        if '..' in entry:
+            (low, high) = entry.split('..', 1)
+            if low.strip():
+                low = long(low)
+            else:
+                low = None
+            if high.strip():
+                high = long(high)
+            else:
+                high = None
+            ranges.append((low, high))
+        else:
+            values[entry] = True
+
+    def checkValueMap(value):
+        if values.has_key(value):
+            return
+        for (low, high) in ranges:
+            try:
+                number = long(value)
+            except ValueError:
+                break
+            if((low == None or number >= low) and
+               (high == None or number <= high)):
+                return
+        raise ValueError("not in ValueMap")
+    return checkValueMap
+
+class PropertyResolver:
+    """
+    Resolves the properties of the entities of one document for one
+    configuration.  The default configuration is looked up once, and the
+    properties of each entity are read once and kept, so an entity asked
+    for again, as the sibling of another, costs a lookup.  The document
+    must not change while the resolver is used.
+
+    @ivar configuration: configuration used, the default configuration of
+                         the document if none was given
+    @type configuration: String
+    """
+    def __init__(self, ovfDoc, configuration=None):
+        """
+        @param ovfDoc: OVF document
+        @type ovfDoc: DOM Document
+
+        @param configuration: configuration, default is the document's
+                              default configuration
+        @type configuration: String
+        """
+        if not configuration:
+            configuration = Ovf.getDefaultConfiguration(ovfDoc)
+        self.document = ovfDoc
+        self.configuration = configuration
+        self._properties = {}
+        self._validators = {}
+
+    def getPropertyValue(self, propertyNode):
+        """
+        Returns the default value of a Property, see
+        L{getPropertyDefaultValue}.
+
+        @param propertyNode: Property node
+        @type propertyNode: DOM Element
+
+        @return: default value, None if no default was specified
+        @rtype: String
+        """
+        return _getValue(propertyNode, self.configuration)
+
+    def getProperties(self, node):
+        """
+        Returns the properties of an entity, as L{getPropertiesForNode}
+        does.  The result is kept and must not be changed.
+
+        @raise RuntimeError: a Property has no ovf:key
+
+        @param node: VirtualSystem or VirtualSystemCollection node
+        @type node: DOM Element
+
+        @return: (key, property node, value) tuples in document order,
+                 key being class.key.instance
+        @rtype: tuple
+        """
+        properties = self._properties.get(node)
+        if properties != None:
+            return properties
+
+        properties = []
+        # it's valid for there to be 0 product sections
+        for prodNode in node.childNodes:
+            if(prodNode.nodeType != Node.ELEMENT_NODE or
+               prodNode.tagName != 'ProductSection'):
+                continue
             prodClass = prodNode.getAttribute('ovf:class')
             if prodClass != '':
                 prodClass += '.'
@@ -91,22 +281,63 @@ def getPropertiesForNode(node, configuration):
             if prodInstance != '':
                 prodInstance = '.' + prodInstance
 
-            properties = Ovf.getChildNodes(prodNode,
-                                           (Ovf.hasTagName, 'Property'))
-
-            if properties == []:
-                continue
-
-            for propertyNode in properties:
-                attributes = Ovf.getAttributes(propertyNode)
-                if not attributes.has_key('ovf:key'):
+            for propertyNode in prodNode.childNodes:
+                if(propertyNode.nodeType != Node.ELEMENT_NODE or
+                   propertyNode.tagName != 'Property'):
+                    continue
+                if not propertyNode.hasAttribute('ovf:key'):
                     raise RuntimeError, 'Node missing required attribute ' +\
                                         'ovf:key'
 
-                propKey = prodClass + attributes['ovf:key'] + prodInstance
-                retArray.append((propKey, propertyNode,
-                                getPropertyDefaultValue(propertyNode,\
-                                                        configuration)))
+                propKey = (prodClass + propertyNode.getAttribute('ovf:key') +
+                           prodInstance)
+                properties.append((propKey, propertyNode,
+                                   _getValue(propertyNode,
+                                             self.configuration)))
+
+        properties = tuple(properties)
+        self._properties[node] = properties
+        return properties
+
+    def getValidator(self, propertyNode):
+        """
+        Returns the L{validator<getValidator>} of a Property, made once.
+
+        @param propertyNode: Property node
+        @type propertyNode: DOM Element
+
+        @rtype: function
+        """
+        validator = self._validators.get(propertyNode)
+        if validator == None:
+            validator = getValidator(propertyNode)
+            self._validators[propertyNode] = validator
+        return validator
+
+    def getPropertyMap(self, node, overrides=None):
+        """
+        Returns the resolved value of each property of an entity.  When a
+        key appears twice the last value is kept.
+
+        @raise ValueError: an override is not valid for its Property
+
+        @param node: VirtualSystem or VirtualSystemCollection node
+        @type node: DOM Element
+
+        @param overrides: class.key.instance to a value that replaces the
+                          default, checked with L{getValidator}.  Keys of
+                          other entities are ignored.
+        @type overrides: dictionary
 
-    return retArray
+        @return: class.key.instance to value, None if no default was
+                 specified
+        @rtype: dictionary
+        """
+        propertyMap = {}
+        for (key, propertyNode, value) in self.getProperties(node):
+            if overrides and overrides.has_key(key):
+                value = overrides[key]
+                self.getValidator(propertyNode)(value)
+            propertyMap[key] = value
+        return propertyMap
 
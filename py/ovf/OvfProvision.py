@@ -0,0 +1,259 @@
+# vi: ts=4 expandtab syntax=python
+##############################################################################
+# Copyright (c) 2008 IBM Corporation
+# All rights reserved. This program and the accompanying materials
+# are made available under the terms of the Eclipse Public License v1.0
+# which accompanies this distribution, and is available at
+# http://www.eclipse.org/legal/epl-v10.html
+#
+##############################################################################
+"""
+Provisioning of writable per-VirtualSystem disk images from the images of
+an OVF package.
+
+A disk image that is shared by several Disks must not be written by all of
+them.  Each user gets its own image, made by the first strategy that works:
+    - overlay: a qcow2 image backed by the original, written by
+      L{createOverlay} without any external tool.  Constant time and space.
+    - reflink: a copy-on-write clone of the file (Linux FICLONE).  Constant
+      time and space on file systems that support it.
+    - copy: a full copy of the file.
+The original image is never changed, so a package can be deployed again.
+"""
+
+import os
+import shutil
+import struct
+
+#: all strategies, in order of preference
+STRATEGIES = ('overlay', 'reflink', 'copy')
+
+#: libvirt domain types that can run qcow2 overlays
+QEMU_DOMAIN_TYPES = ('qemu', 'kqemu', 'kvm')
+
+QCOW2_MAGIC = 'QFI\xfb'
+#: 64k clusters, the qemu default
+QCOW2_CLUSTER_BITS = 16
+#: header extension naming the format of the backing file
+QCOW2_EXT_BACKING_FORMAT = 0xE2792ACA
+
+VMDK_MAGIC = 'KDMV'
+
+#: ioctl to clone a file, from linux/fs.h
+FICLONE = 0x40049409
+
+def getStrategies(domainType):
+    """
+    Returns the strategies that suit a libvirt domain type.  Only qemu based
+    domains can use qcow2 overlays.
+
+    @param domainType: libvirt domain type, as in 'kvm'
+    @type domainType: String
+
+    @return: strategies in order of preference
+    @rtype: tuple of Strings
+    """
+    if domainType in QEMU_DOMAIN_TYPES:
+        return STRATEGIES
+    return STRATEGIES[1:]
+
+def getImageInfo(path):
+    """
+    Returns the format and virtual size of a disk image.  qcow2 and sparse
+    vmdk images are recognized from their headers, anything else is taken
+    to be raw.
+
+    @param path: disk image
+    @type path: String
+
+    @return: (format, size in bytes), format is 'qcow2', 'vmdk' or 'raw'
+    @rtype: tuple
+    """
+    fileObj = open(path, 'rb')
+    try:
+        header = fileObj.read(512)
+    finally:
+        fileObj.close()
+
+    if header.startswith(QCOW2_MAGIC) and len(header) >= 32:
+        return ('qcow2', struct.unpack('>Q', header[24:32])[0])
+    if header.startswith(VMDK_MAGIC) and len(header) >= 20:
+        return ('vmdk', struct.unpack('<Q', header[12:20])[0] * 512)
+    return ('raw', os.path.getsize(path))
+
+def _getOverlayLayout(size):
+    """Returns (L1 entries, clusters) of an overlay of size bytes."""
+    clusterSize = 1 << QCOW2_CLUSTER_BITS
+    l2Entries = clusterSize / 8
+    l1Size = max(1, (size + clusterSize * l2Entries - 1) /
+                    (clusterSize * l2Entries))
+    l1Clusters = (l1Size * 8 + clusterSize - 1) / clusterSize
+    clusters = 3 + l1Clusters
+    if clusters > clusterSize / 2:
+        raise ValueError("Image too large for a qcow2 overlay: " + str(size))
+    return (l1Size, clusters)
+
+def getOverlaySize(size):
+    """
+    Returns the size of the file L{createOverlay} writes for an image of
+    size bytes.
+
+    @raise ValueError: the image would be too large for an overlay
+
+    @param size: virtual size in bytes
+    @type size: int
+
+    @return: file size in bytes
+    @rtype: int
+    """
+    return _getOverlayLayout(size)[1] << QCOW2_CLUSTER_BITS
+
+def createOverlay(backingFile, path, size=None, backingFormat=None):
+    """
+    Writes a qcow2 (version 2) image at path that is backed by backingFile.
+    Nothing is allocated; reads fall through to the backing file and writes
+    go to path.  The image holds a header, a refcount table, one refcount
+    block and the L1 table, one cluster each, as qemu-img creates them.
+
+    The backing file is recorded relative to path when both are in the
+    same directory, so the pair can be moved together.
+
+    @raise ValueError: the image would be too large for one refcount block
+
+    @param backingFile: image the overlay is based on
+    @type backingFile: String
+
+    @param path: overlay to create, replaced if it exists
+    @type path: String
+
+    @param size: virtual size in bytes.  Default is the size of the backing
+                 file, see L{getImageInfo}.
+    @type size: int
+
+    @param backingFormat: format of backingFile.  Detected if not given.
+    @type backingFormat: String
+    """
+    if size == None or backingFormat == None:
+        (detected, detectedSize) = getImageInfo(backingFile)
+        if size == None:
+            size = detectedSize
+        if backingFormat == None:
+            backingFormat = detected
+
+    if(os.path.dirname(os.path.abspath(backingFile)) ==
+       os.path.dirname(os.path.abspath(path))):
+        backingName = os.path.basename(backingFile)
+    else:
+        backingName = os.path.abspath(backingFile)
+    if isinstance(backingName, unicode):
+        backingName = backingName.encode('UTF-8')
+
+    clusterSize = 1 << QCOW2_CLUSTER_BITS
+    (l1Size, clusters) = _getOverlayLayout(size)
+
+    # header extensions, then the backing file name
+    extension = backingFormat
+    extension += '\0' * (-len(extension) % 8)
+    extensions = struct.pack('>II', QCOW2_EXT_BACKING_FORMAT,
+                             len(backingFormat)) + extension
+    extensions += struct.pack('>II', 0, 0)
+    backingOffset = 72 + len(extensions)
+    if backingOffset + len(backingName) > clusterSize:
+        raise ValueError("Backing file name too long: " + backingName)
+
+    header = struct.pack('>4sIQIIQIIQQIIQ',
+                         QCOW2_MAGIC,
+                         2,                     # version
+                         backingOffset,
+                         len(backingName),
+                         QCOW2_CLUSTER_BITS,
+                         size,
+                         0,                     # no encryption
+                         l1Size,
+                         3 * clusterSize,       # L1 table
+                         clusterSize,           # refcount table
+                         1,                     # refcount table clusters
+                         0,                     # no snapshots
+                         0)
+
+    refcountTable = struct.pack('>Q', 2 * clusterSize)
+    refcountBlock = struct.pack('>%dH' % clusters, *([1] * clusters))
+
+    fileObj = open(path, 'wb')
+    try:
+        fileObj.write(header + extensions + backingName)
+        fileObj.seek(clusterSize)
+        fileObj.write(refcountTable)
+        fileObj.seek(2 * clusterSize)
+        fileObj.write(refcountBlock)
+        fileObj.truncate(clusters * clusterSize)
+    finally:
+        fileObj.close()
+
+def reflinkFile(source, path):
+    """
+    Clones source to path with the FICLONE ioctl, so that both share their
+    blocks until either is written.
+
+    @raise IOError: the file system, or the platform, cannot clone files
+
+    @param source: file to clone
+    @type source: String
+
+    @param path: clone to create, replaced if it exists
+    @type path: String
+    """
+    try:
+        import fcntl
+    except ImportError:
+        raise IOError("reflink is not supported on this platform")
+
+    sourceObj = open(source, 'rb')
+    try:
+        targetObj = open(path, 'wb')
+        try:
+            fcntl.ioctl(targetObj.fileno(), FICLONE, sourceObj.fileno())
+        finally:
+            targetObj.close()
+    finally:
+        sourceObj.close()
+    shutil.copymode(source, path)
+
+def provisionDisk(source, path, strategies=STRATEGIES):
+    """
+    Creates a writable image at path with the contents of source, using
+    the first of strategies that works.  An overlay is written as qcow2, so
+    its extension is changed to .qcow2.
+
+    @raise IOError: every strategy failed, the error of the last is raised
+
+    @param source: original image
+    @type source: String
+
+    @param path: image to create
+    @type path: String
+
+    @param strategies: strategies to try, see L{STRATEGIES}
+    @type strategies: sequence of Strings
+
+    @return: (path of the new image, strategy used)
+    @rtype: tuple
+    """
+    error = IOError("No provisioning strategy given")
+    for strategy in strategies:
+        target = path
+        try:
+            if strategy == 'overlay':
+                target = os.path.splitext(path)[0] + '.qcow2'
+                createOverlay(source, target)
+            elif strategy == 'reflink':
+                reflinkFile(source, target)
+            elif strategy == 'copy':
+                shutil.copy(source, target)
+            else:
+                raise ValueError("Unknown provisioning strategy " + strategy)
+            return (target, strategy)
+        except (IOError, OSError, ValueError), error:
+            if os.path.exists(target) and target != source:
+                os.remove(target)
+    raise error
@@ -14,15 +14,26 @@ import os
 import shutil
 import tarfile
 import tempfile
+import threading
+import time
+import Queue
 
+from xml.dom.minidom import parseString
+
+import Ovf
 import OvfFile
-import OvfLibvirt
+import OvfProvision
 import OvfReferencedFile
 import OvfManifest
+# OvfLibvirt and OvfTransport are imported by the methods that deploy, so
+# that reading and writing packages does not load them
 
 FORMAT_DIR = "Dir"
 FORMAT_TAR = "Tar"
 
+#: default domain name of an instance, see L{OvfSet.deployMany}
+DEFAULT_NAMING = "%(id)s-%(index)d"
+
 class OvfSet(object):
     """
     This is the base OvfSet class. It represents an OVF Set, either as a tar
@@ -383,10 +394,10 @@ class OvfSet(object):
             # ovf file doesn't reference itself, so its not in the
             # found list.  add it if it is present in the expected
             if expected[self.name + ".ovf"]:
-                nref = OvfReferencedFile.OvfReferencedFile(
-                        os.path.join(self.archivePath, self.name + ".ovf"),
-                        self.name + ".ovf")
-                nref.doChecksum()
+                ovfPath = os.path.join(self.archivePath, self.name + ".ovf")
+                nref = OvfReferencedFile.OvfReferencedFile(ovfPath,
+                                                           self.name + ".ovf")
+                nref.checksum = self.ovfFile.getChecksum(ovfPath)
                 found[nref.href] = nref
 
             for href in expected:
@@ -398,13 +409,33 @@ class OvfSet(object):
             raise
 
 # Libvirt Interface
-    def boot(self, virtPlatform = None, configId=None, installLoc=None, envDirectory=None):
+    def boot(self, virtPlatform = None, configId=None, installLoc=None, envDirectory=None,
+             cache=None, workers=1, transport=None):
         """
-        Boots OvfSet as libvirt domain(s).
+        Boots OvfSet as libvirt domain(s), see L{OvfLibvirt.BootScheduler}.
 
         @param configId: configuration identifier
         @type configId: String
+
+        @param envDirectory: directory holding an environment iso for each
+                             VirtualSystem, named after its ovf:id
+        @type envDirectory: String
+
+        @param cache: cache of compiled domain descriptions to use
+        @type cache: L{OvfLibvirt.DomainSpecCache}
+
+        @param workers: number of VirtualSystems whose disk images are
+                        provisioned at the same time
+        @type workers: int
+
+        @param transport: puts the environments in envDirectory that have
+                          no iso on one first, see L{makeEnvironmentIsos}
+        @type transport: L{OvfTransport.TransportBuilder}
+
+        @return: domain id to the seconds it took to start
+        @rtype: dictionary
         """
+        import OvfLibvirt
         ovf = self.ovfFile.document
 
         # TODO: Verify reservations DON'T exceed capabilities
@@ -417,13 +448,439 @@ class OvfSet(object):
         else:
             dirpath = installLoc
 
+        envFiles = None
+        if envDirectory and transport != None:
+            envFiles = self.makeEnvironmentIsos(envDirectory, dirpath,
+                                                transport)
+
         # Get Domain definitions
+        digest = self._getCacheDigest(cache)
         domains = OvfLibvirt.getOvfDomains(ovf, dirpath,
                                            virtPlatform, configId,
-                                           envDirectory)
+                                           envDirectory, cache=cache,
+                                           digest=digest, workers=workers,
+                                           envFiles=envFiles)
+
+        # start each ovf:order group concurrently
+        scheduler = OvfLibvirt.BootScheduler(startup, domains)
+        return scheduler.start()
+
+    def _getCacheDigest(self, cache):
+        """
+        Returns the digest that keys the compiled domain descriptions of
+        the document in cache, None without a cache.  The document is
+        serialized and hashed each time, since changes made directly to
+        the DOM can not be detected otherwise; that costs much less than
+        compiling the descriptions again.
+        """
+        if cache == None:
+            return None
+        return self.ovfFile.getDigest()
+
+    def plan(self, virtPlatform=None, configId=None, installLoc=None):
+        """
+        Returns what L{boot} would allocate, write and wait for, without
+        doing any of it: see L{OvfLibvirt.getOvfPlan} and
+        L{OvfLibvirt.BootScheduler.getTimeline}.  The plan can be written
+        as JSON.
+
+        @param virtPlatform: virtual system type, default is what each
+                             VirtualSystem asks for
+        @type virtPlatform: String
 
-        # queue domains with action: domains[id].create()
-        schedule = OvfLibvirt.getSchedule(startup, domains)
+        @param configId: configuration identifier, default is to plan each
+                         configuration
+        @type configId: String
+
+        @param installLoc: directory the package would be copied to, as
+                           ova runtime does, before booting
+        @type installLoc: String
+
+        @return: dictionary with
+            - name: package name
+            - copyBytes: bytes copied to installLoc, 0 without it
+            - configurations: list of L{configuration plans
+              <OvfLibvirt.getOvfPlan>}
+            - start: domain id to the seconds after which it starts
+            - seconds: seconds until the startup is done
+        @rtype: dictionary
+        """
+        dirpath = os.path.dirname(os.path.abspath(self.ovfFile.path))
+
+        copyBytes = 0
+        if installLoc != None:
+            files = [self.ovfFile.path, self.manifest, self.certificate]
+            files.extend([each.path for each in self.ovfFile.files])
+            for path in files:
+                if path != None and os.path.isfile(path):
+                    copyBytes += os.path.getsize(path)
+
+        return _makePlan(self.ovfFile.document, self.getName(), copyBytes,
+                         virtPlatform, configId, dirpath)
+
+    def makeEnvironmentIsos(self, envDirectory, isoDirectory, transport=None):
+        """
+        Puts the environment of each VirtualSystem that envDirectory has
+        no iso for, named after its ovf:id with an .xml extension, on an
+        iso in isoDirectory for L{boot} and L{deployMany} to attach.  The
+        files in envDirectory are left as they are.  Unchanged
+        environments are copied from the cache of transport instead of
+        being put on an iso again.
+
+        @raise RuntimeError: an environment can not be put on its iso
+
+        @param envDirectory: directory of the environments
+        @type envDirectory: String
+
+        @param isoDirectory: directory for the isos, named after the
+                             ovf:id with an -env.iso extension
+        @type isoDirectory: String
+
+        @param transport: makes the isos
+        @type transport: L{OvfTransport.TransportBuilder}
+
+        @return: ovf:id to the iso made for it
+        @rtype: dictionary
+        """
+        import OvfTransport
+        ovfIds = []
+        fileList = []
+        for node in Ovf.getNodes(self.ovfFile.document,
+                                 (Ovf.hasTagName, 'VirtualSystem')):
+            ovfId = node.getAttribute('ovf:id')
+            envFile = os.path.join(envDirectory, ovfId + '.xml')
+            if os.path.isfile(envFile) and \
+               not os.path.exists(os.path.join(envDirectory, ovfId + '.iso')):
+                ovfIds.append(ovfId)
+                fileList.append((os.path.join(isoDirectory,
+                                              ovfId + '-env.iso'),
+                                 [envFile]))
+        isoFiles = OvfTransport.makeISOTransport(fileList, transport)
+        return dict(zip(ovfIds, isoFiles))
+
+    def deployMany(self, count, naming=DEFAULT_NAMING, overlays=True,
+                   parallel=4, virtPlatform=None, configId=None,
+                   installLoc=None, envDirectory=None, environment=None,
+                   start=True, progress=None, startAction=None,
+                   cache=None, transport=None):
+        """
+        Deploys count instances of the appliance.  The OVF is read once.
+        Each instance gets domains with unique names, uuids and MAC
+        addresses, and its own image of every writable disk, made with
+        L{OvfProvision.provisionDisk} next to the package's images, which
+        are left as they are.  Instances are provisioned and started by
+        parallel worker threads; the domains of one instance start in
+        the order of its StartupSections, see L{OvfLibvirt.BootScheduler}.
 
-        schedule.run()
+        @raise ValueError: naming does not give unique names
 
+        @param count: number of instances
+        @type count: int
+
+        @param naming: domain name of each VirtualSystem of an instance,
+                       either a format string using %(id)s (ovf:id),
+                       %(index)d (0 based instance number) and %(name)s
+                       (package name), or a function taking the ovf:id and
+                       the index
+        @type naming: String or function
+
+        @param overlays: provision qcow2 overlays where the hypervisor
+                         can use them; otherwise clone or copy the images
+        @type overlays: boolean
+
+        @param parallel: number of worker threads
+        @type parallel: int
+
+        @param virtPlatform: virtualization platform, as for L{boot}
+        @type virtPlatform: String
+
+        @param configId: configuration identifier
+        @type configId: String
+
+        @param installLoc: directory for the instance images, default is
+                           the directory of the package
+        @type installLoc: String
+
+        @param envDirectory: directory of environment isos shared by all
+                             instances, named after the ovf:id
+        @type envDirectory: String
+
+        @param environment: called with the domain name, ovf:id and index
+                            of each VirtualSystem; returns the path of its
+                            ovf-env.xml, or None.  The file is put on an iso
+                            for that domain alone.
+        @type environment: function
+
+        @param start: start the domains; if False only provision them
+        @type start: boolean
+
+        @param progress: called with each finished instance, the number of
+                         finished instances and count
+        @type progress: function
+
+        @param startAction: starts a domain, default is
+                            L{OvfLibvirt.startDomain}
+        @type startAction: function
+
+        @param cache: cache of compiled domain descriptions to use
+        @type cache: L{OvfLibvirt.DomainSpecCache}
+
+        @param transport: makes the environment isos, with its cache of
+                          isos made before, including those of
+                          envDirectory, see L{makeEnvironmentIsos}
+        @type transport: L{OvfTransport.TransportBuilder}
+
+        @return: one dictionary per instance, in index order, with
+            - index: instance number
+            - domains: ovf:id to L{OvfLibvirt.DomainXml}
+            - images: disk images made for the instance
+            - latencies: domain id to the seconds its start took
+            - seconds: time taken to provision and start the instance
+            - error: the exception that stopped the instance, or None
+        @rtype: list
+        """
+        import OvfLibvirt
+        if envDirectory and environment:
+            raise ValueError("envDirectory and environment exclude each other")
+
+        ovf = self.ovfFile.document
+        sourceDir = os.path.dirname(os.path.abspath(self.ovfFile.path))
+        if installLoc == None:
+            installLoc = sourceDir
+        installLoc = os.path.abspath(installLoc)
+        if not os.path.isdir(installLoc):
+            os.makedirs(installLoc)
+        if self.__tmpdir__ != None:
+            # images in an unpacked archive do not outlive this object
+            self.writeAsDir(installLoc)
+            sourceDir = installLoc
+        envFiles = None
+        if envDirectory and transport != None:
+            envFiles = self.makeEnvironmentIsos(envDirectory, installLoc,
+                                                transport)
+
+        # read the package once; shared images are provisioned per instance
+        digest = self._getCacheDigest(cache)
+        specs = OvfLibvirt.getOvfDomainSpecs(ovf, sourceDir, virtPlatform,
+                                             configId, envDirectory, (),
+                                             cache, digest, envFiles=envFiles)
+        startup = OvfLibvirt.getOvfStartup(ovf)
+
+        names = {}
+        macs = set()
+        instances = []
+        for index in range(count):
+            instance = dict(index=index, domains={}, images=[],
+                            latencies={}, seconds=0, error=None,
+                            specs={})
+            for (ovfId, spec) in specs.items():
+                if callable(naming):
+                    name = naming(ovfId, index)
+                else:
+                    name = naming % dict(id=ovfId, index=index,
+                                         name=self.getName())
+                if names.has_key(name):
+                    raise ValueError("Domain name used twice: " + name)
+                names[name] = True
+
+                instanceSpec = spec.copy()
+                instanceSpec['name'] = name
+                instanceSpec['uuid'] = OvfLibvirt.makeUuid()
+                instanceSpec['disks'] = [disk.copy() for disk in spec['disks']]
+                instanceSpec['networks'] = []
+                for network in spec['networks']:
+                    network = network.copy()
+                    if network['interfaceType'] in ('network', 'bridge',
+                                                    'user'):
+                        network['macAddress'] = \
+                            OvfLibvirt.makeMacAddress(macs)
+                    instanceSpec['networks'].append(network)
+                instance['specs'][ovfId] = instanceSpec
+            instances.append(instance)
+
+        if startAction == None:
+            startAction = OvfLibvirt.startDomain
+
+        lock = threading.Lock()
+        finished = [0]
+        queue = Queue.Queue()
+        for instance in instances:
+            queue.put(instance)
+
+        def worker():
+            while True:
+                try:
+                    instance = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                begin = time.time()
+                try:
+                    self._deployInstance(instance, installLoc, overlays,
+                                         environment, startup, start,
+                                         startAction, transport)
+                except Exception, e:
+                    instance['error'] = e
+                instance['seconds'] = time.time() - begin
+
+                lock.acquire()
+                try:
+                    finished[0] += 1
+                    if progress != None:
+                        progress(instance, finished[0], count)
+                finally:
+                    lock.release()
+
+        threads = []
+        for number in range(max(1, min(parallel, count))):
+            thread = threading.Thread(target=worker)
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+        for instance in instances:
+            del instance['specs']
+        return instances
+
+    def _deployInstance(self, instance, installLoc, overlays, environment,
+                        startup, start, startAction, transport):
+        """
+        Provisions the images and environment of one instance from
+        L{deployMany}, renders its domains and starts them.
+        """
+        import OvfLibvirt
+        import OvfTransport
+        for (ovfId, spec) in instance['specs'].items():
+            name = spec['name']
+            targets = {}
+            if overlays:
+                strategies = OvfProvision.getStrategies(spec['domainType'])
+            else:
+                strategies = OvfProvision.STRATEGIES[1:]
+
+            for disk in spec['disks']:
+                if disk.get('readonly'):
+                    continue
+                # a file used by two disks of a domain gets two images
+                source = disk['sourceFile']
+                baseName = os.path.basename(source)
+                fileName = name + '-' + baseName
+                while targets.has_key(fileName):
+                    fileName = '%s-%d-%s' % (name, len(targets), baseName)
+                targets[fileName] = True
+                target = os.path.join(installLoc, fileName)
+                (path, strategy) = OvfProvision.provisionDisk(source, target,
+                                                              strategies)
+                instance['images'].append(path)
+                disk['sourceFile'] = path
+                if strategy == 'overlay':
+                    disk['driverName'] = 'qemu'
+                    disk['driverType'] = 'qcow2'
+
+            if environment != None:
+                envXml = environment(name, ovfId, instance['index'])
+                if envXml != None:
+                    isoFile = os.path.join(installLoc, name + '-env.iso')
+                    OvfTransport.makeISOTransport([(isoFile, [envXml])],
+                                                  transport)
+                    instance['images'].append(isoFile)
+                    spec['disks'].append(dict(diskType='file',
+                                              targetDev='hdc:cdrom',
+                                              sourceFile=isoFile,
+                                              targetBus='ide',
+                                              diskDevice='cdrom',
+                                              readonly=True))
+
+            instance['domains'][ovfId] = OvfLibvirt.DomainXml(
+                OvfLibvirt.renderDomain(spec), spec['domainType'])
+
+        if start:
+            scheduler = OvfLibvirt.BootScheduler(startup, instance['domains'],
+                                                 startAction=startAction)
+            try:
+                scheduler.start()
+            finally:
+                instance['latencies'] = scheduler.latencies
+
+def planArchive(path, virtPlatform=None, configId=None, installLoc=None):
+    """
+    Returns the plan of L{OvfSet.plan} for an ova file without extracting
+    it: only the envelope is read from the archive, and the sizes of the
+    other files are taken from their tar headers.
+
+    @raise IOError: the archive is unsafe or holds no ovf file
+
+    @param path: ova file
+    @type path: String
+
+    @param virtPlatform: virtual system type, see L{OvfSet.plan}
+    @type virtPlatform: String
+
+    @param configId: configuration identifier, see L{OvfSet.plan}
+    @type configId: String
+
+    @param installLoc: directory the package would be extracted to
+    @type installLoc: String
+
+    @return: plan, see L{OvfSet.plan}
+    @rtype: dictionary
+    """
+    sizes = {}
+    ovfName = None
+    data = None
+    tf = tarfile.open(path, "r")
+    try:
+        for ti in tf.getmembers():
+            if ti.name.find("..") != -1 or ti.name.startswith("/"):
+                raise IOError("Unsafe Tar file" + path)
+            if not ti.isfile():
+                continue
+            name = os.path.normpath(ti.name)
+            sizes[name] = ti.size
+            if ovfName == None and name.endswith(".ovf"):
+                ovfName = name
+                data = tf.extractfile(ti).read()
+    finally:
+        tf.close()
+    if ovfName == None:
+        raise IOError("no ovf file in " + path)
+
+    ovf = parseString(data)
+    ovf.normalize()
+    name = os.path.basename(ovfName)[:-4]
+
+    copyBytes = 0
+    if installLoc != None:
+        files = [ovfName, name + ".mf", name + ".cert"]
+        files.extend([each.href for each in
+                      OvfFile.getReferencedFilesFromOvf(ovf.documentElement)])
+        for each in files:
+            copyBytes += sizes.get(os.path.normpath(each), 0)
+
+    return _makePlan(ovf, name, copyBytes, virtPlatform, configId,
+                     os.path.dirname(os.path.abspath(path)), sizes)
+
+def _makePlan(ovf, name, copyBytes, virtPlatform, configId, dirpath,
+              sizes=None):
+    """
+    Returns the plan of L{OvfSet.plan} for a document, see
+    L{OvfLibvirt.getOvfPlan} for dirpath and sizes.
+    """
+    import OvfLibvirt
+    if configId != None:
+        configIds = [configId]
+    else:
+        configIds = [node.getAttribute('ovf:id') for node in
+                     Ovf.getNodes(ovf, (Ovf.hasTagName, 'Configuration'))]
+        if configIds == []:
+            configIds = [None]
+    configurations = [OvfLibvirt.getOvfPlan(ovf, dirpath, virtPlatform,
+                                            each, sizes=sizes)
+                      for each in configIds]
+
+    startup = OvfLibvirt.getOvfStartup(ovf)
+    (start, seconds) = OvfLibvirt.BootScheduler(startup, {}).getTimeline()
+
+    return dict(name=name, copyBytes=copyBytes,
+                configurations=configurations, start=start,
+                seconds=seconds)
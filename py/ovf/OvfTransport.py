@@ -14,19 +14,27 @@ This module contains functions dealing with the environment transport
 """
 
 import os
+import sha
 import shutil
 import tempfile
+import threading
 from subprocess import call
-from subprocess import Popen
 from subprocess import PIPE
 from subprocess import STDOUT
 
+import Ovf
+import OvfIso
+
+#: name of the environment file on the transport media
+ENV_FILE_NAME = 'ovf-env.xml'
+
 def selectISOProgram():
     """
     Identify if genisoimage or mkisofs in installed.  Will check genisoimage
     first and use that if available.  Will return None if neither is
     present.  Both programs support the same set of parms, at least as far
-    as our usage is concerned.
+    as our usage is concerned.  The isos themselves are written by
+    L{OvfIso} and need neither program.
     @rtype: String
     @return: iso program.  'genisoimage' or 'mkisofs'
     """
@@ -38,38 +46,202 @@ def selectISOProgram():
 
     return None
 
-def makeISOTransport(fileList):
+class TransportBuilder:
+    """
+    Makes environment isos, those of one L{makeISOTransport} call on up to
+    workers threads.  Given a directory, a copy of each image is kept in
+    it, named after the sha1 of the names and contents of its files.  An
+    iso of files that were put on one before, by this or an earlier
+    process, is then copied from there instead of being made again.  An
+    image is named by its content, so an entry never goes stale; nothing
+    is removed from the directory.
+
+    @ivar hits: isos copied from the directory
+    @type hits: int
+
+    @ivar misses: isos made
+    @type misses: int
+    """
+    def __init__(self, directory=None, workers=1):
+        """
+        @param directory: directory for the images, created if needed
+        @type directory: String
+
+        @param workers: number of isos made at the same time
+        @type workers: int
+        """
+        self.directory = directory
+        self.workers = workers
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def getKey(self, files):
+        """
+        Returns the sha1, in hex, of the names and contents of files.
+
+        @param files: (name, contents) of each file on the iso
+        @type files: list of tuples
+
+        @rtype: String
+        """
+        digest = sha.new()
+        for (name, data) in files:
+            digest.update('%d:%s%d:' % (len(name), name, len(data)))
+            digest.update(data)
+        return digest.hexdigest()
+
+    def getPath(self, key):
+        """
+        Returns the cached image of a key, see L{getKey}.
+
+        @rtype: String
+        """
+        return os.path.join(self.directory, key + '.iso')
+
+    def makeISO(self, outFile, files):
+        """
+        Create an iso containing files, copying it from the directory if
+        it was made before.
+
+        @raise RuntimeError: the iso can not be made or written
+
+        @param outFile: iso file to create, replaced if it exists
+        @type outFile: String
+
+        @param files: (name, contents) of each file, see L{OvfIso.makeIso}
+        @type files: list of tuples
+
+        @return: True if the iso was copied from the directory
+        @rtype: boolean
+        """
+        try:
+            if self.directory != None:
+                path = self.getPath(self.getKey(files))
+                if os.path.isfile(path):
+                    shutil.copyfile(path, outFile)
+                    self._count(True)
+                    return True
+            OvfIso.writeIso(outFile, files)
+            if self.directory != None:
+                self._store(outFile, path)
+        except (IOError, OSError, ValueError), e:
+            raise RuntimeError, str(e)
+        self._count(False)
+        return False
+
+    def makeISOTransport(self, fileList):
+        """
+        Create the isos of fileList, see L{makeISOTransport}.  After the
+        first error no more isos are started, and the error is raised once
+        the running ones are done.
+
+        @raise RuntimeError: a file can not be read or put on the iso
+
+        @param fileList: List in the format [outFileName, [inFileNames]]
+        @type fileList: List
+
+        @return: the iso files, in the order of fileList
+        @rtype: List of Strings
+        """
+        def make(index, (outFile, inFileList)):
+            if not outFile:
+                # no outfile name, base it on the first file in inFileList
+                outFile = os.path.splitext(inFileList[0])[0] + '.iso'
+            makeEnvironmentISO(outFile, _readFile(inFileList[0]),
+                               inFileList[1:], self)
+            return outFile
+
+        (results, error) = Ovf.runPool(make, list(enumerate(fileList)),
+                                       self.workers)
+        if error != None:
+            raise error[0], error[1], error[2]
+        return [results[index] for index in range(len(fileList))]
+
+    def _count(self, hit):
+        """Counts a hit or a miss."""
+        self._lock.acquire()
+        try:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        finally:
+            self._lock.release()
+
+    def _store(self, outFile, path):
+        """Copies an image to the directory, replacing it atomically."""
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                # made by another worker in the meantime
+                if not os.path.isdir(self.directory):
+                    raise
+        (fd, tmpPath) = tempfile.mkstemp(dir=self.directory)
+        os.close(fd)
+        try:
+            shutil.copyfile(outFile, tmpPath)
+            os.rename(tmpPath, path)
+        except:
+            os.remove(tmpPath)
+            raise
+
+def makeEnvironmentISO(outFile, envData, inFileNames=None, builder=None):
     """
-    Create an iso(s) containing the file(s) passed by the user.
+    Create an iso containing an environment, stored as ovf-env.xml, and
+    optionally other files.  The environment is taken as is, so it does
+    not need to be written to a file first.
+    @type outFile: String
+    @param outFile: iso file to create, replaced if it exists
+    @type envData: String
+    @param envData: serialized environment, see
+                    L{EnvironmentSection.toXML}
+    @type inFileNames: List of Strings
+    @param inFileNames: other files to put on the iso under their base name
+    @type builder: L{TransportBuilder}
+    @param builder: builder to make the iso with, for its cache
+
+    @raise RuntimeError: a file can not be read or put on the iso
+
+    @rtype: boolean
+    @return: True if the iso was copied from the builder's cache
+    """
+    files = [(ENV_FILE_NAME, envData)]
+    for inFileName in inFileNames or []:
+        files.append((os.path.basename(inFileName), _readFile(inFileName)))
+
+    if builder == None:
+        builder = TransportBuilder()
+    return builder.makeISO(outFile, files)
+
+def _readFile(fileName):
+    """Returns the contents of fileName, as RuntimeError if it fails."""
+    try:
+        fileHandle = open(fileName, 'rb')
+        try:
+            return fileHandle.read()
+        finally:
+            fileHandle.close()
+    except IOError, e:
+        raise RuntimeError, str(e)
+
+def makeISOTransport(fileList, builder=None):
+    """
+    Create an iso(s) containing the file(s) passed by the user.  The first
+    file of each iso is the environment and is stored as ovf-env.xml.
     @type fileList: List
     @param fileList: List in the format [outFileName, [inFileNames]]
                      For each entry in the list, an iso file outFileName will
                      be created containing the files in inFileNames
+    @type builder: L{TransportBuilder}
+    @param builder: builder to make the isos with, for its workers and cache
 
-    @raise RuntimeError: a) No ISO format program
-                         b) ISO format program returns an error
-    """
-    prog = selectISOProgram()
-    if not prog:
-        raise RuntimeError, "No ISO format program available."
-
-    for (outFile, inFileList) in fileList:
-        if not outFile:
-            # no outfile name, base it on the first file in inFileList
-            outFile = os.path.splitext(inFileList[0])[0] + '.iso'
-
-        localInFileList = inFileList
-        envFileBasename = os.path.basename(localInFileList[0])
-        if envFileBasename != 'ovf-env.xml':
-            tempDir = tempfile.mkdtemp()
-            targetFileName = os.path.join(tempDir, 'ovf-env.xml')
-            shutil.copyfile(localInFileList[0], targetFileName)
-            localInFileList[0] = targetFileName
-        callArgs = [prog, "-JR", "-o", outFile]
-        callArgs.extend(inFileList)
-
-        pObject = Popen(callArgs, stdout=PIPE, stderr=STDOUT)
-        pStdout = pObject.communicate()[0]
-        if pObject.returncode:
-            raise RuntimeError, pStdout
+    @raise RuntimeError: a file can not be read or put on the iso
 
+    @rtype: List of Strings
+    @return: the iso files, in the order of fileList
+    """
+    if builder == None:
+        builder = TransportBuilder()
+    return builder.makeISOTransport(fileList)
@@ -14,5 +14,6 @@ __all__ = ["Ovf",
            "OvfFile",
            "OvfLibvirt",
            "OvfManifest",
+           "OvfProvision",
            "OvfReferencedFile",
            "OvfSet"]
@@ -189,3 +189,106 @@ class MultipleNodeError(Exception):
         This function will return the error message.
         """
         return self.message
+
+#: option accepted by the tools that work on existing OVF nodes
+SELECT_OPTION = { 'flags' : [ '--select' ],
+                  'parms' : { 'dest' : 'select',
+                              'help' : 'Path expression selecting the nodes'
+                                       ' to work on, for example'
+                                       ' "VirtualSystem[@ovf:id=web]/'
+                                       'VirtualHardwareSection/'
+                                       'Item[rasd:ResourceType=17]".' } }
+
+def getSelectedNodes(ovfFile, options, tagName):
+    """
+    Returns the tagName elements a command works on.  Without --select
+    those are all tagName elements of the document.  With --select they
+    are the tagName elements that are selected, inside a selected node or
+    on the path to one.
+
+    @raise ValueError: the --select expression is not valid
+
+    @param ovfFile: OVF file
+    @type ovfFile: OvfFile
+
+    @param options: parsed options, the select attribute is used if set
+    @type options: optparse.Values
+
+    @param tagName: tag name of the elements
+    @type tagName: String
+
+    @return: elements in document order
+    @rtype: list of DOM Nodes
+    """
+    index = ovfFile.getIndex()
+    nodes = index.get(tagName, [])
+    expr = getattr(options, 'select', None)
+    if not expr:
+        return list(nodes)
+
+    selected = {}
+    above = {}
+    for node in ovfFile.selectNodes(expr, index):
+        selected[id(node)] = True
+        parent = node.parentNode
+        while parent != None and not above.has_key(id(parent)):
+            above[id(parent)] = True
+            parent = parent.parentNode
+
+    ret = []
+    for node in nodes:
+        if above.has_key(id(node)):
+            ret.append(node)
+            continue
+        parent = node
+        while parent != None:
+            if selected.has_key(id(parent)):
+                ret.append(node)
+                break
+            parent = parent.parentNode
+    return ret
+
+def getSelectedNode(ovfFile, options, tagName, attrName=None, value=None):
+    """
+    Returns the single tagName element a command works on, see
+    L{getSelectedNodes}.  If several elements match, the --node-number
+    option picks one of them.
+
+    @raise ValueError: no element matched, or the --select expression is
+                       not valid
+    @raise MultipleNodeError: more than one element matched
+
+    @param ovfFile: OVF file
+    @type ovfFile: OvfFile
+
+    @param options: parsed options
+    @type options: optparse.Values
+
+    @param tagName: tag name of the element
+    @type tagName: String
+
+    @param attrName: if given with value, only elements with this attribute
+                     set to value match
+    @type attrName: String
+
+    @param value: attribute value
+    @type value: String
+
+    @return: element
+    @rtype: DOM Node
+    """
+    nodes = getSelectedNodes(ovfFile, options, tagName)
+    if attrName != None and value != None:
+        nodes = [node for node in nodes if node.getAttribute(attrName) == value]
+
+    if not nodes:
+        raise ValueError("No " + tagName + " was found.")
+    if len(nodes) > 1:
+        number = getattr(options, 'nodenumber', None)
+        if number == None:
+            raise MultipleNodeError(nodes)
+        try:
+            return nodes[int(number)]
+        except (ValueError, IndexError):
+            raise ValueError("Invalid node number " + str(number) + ".")
+    return nodes[0]
@@ -0,0 +1,110 @@
+# vi: ts=4 expandtab syntax=python
+##############################################################################
+# Copyright (c) 2008 IBM Corporation
+# All rights reserved. This program and the accompanying materials
+# are made available under the terms of the Eclipse Public License v1.0
+# which accompanies this distribution, and is available at
+# http://www.eclipse.org/legal/epl-v10.html
+#
+##############################################################################
+
+"""
+Reads the properties of an ovf-env file without building a DOM, for
+programs in the guest that only need a few values at boot.  This module
+only depends on expat, so importing it is cheap.
+"""
+
+import os
+from xml.parsers import expat
+
+class ReadOnlyDict(dict):
+    """
+    Dictionary that can not be changed after it is made.
+    """
+    __slots__ = ()
+
+    def _readOnly(self, *args, **kwargs):
+        """Refuses any change."""
+        raise TypeError("read-only dictionary")
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = \
+        update = _readOnly
+
+    def copy(self):
+        """Returns a changeable copy."""
+        return dict(self)
+
+#: path to ((mtime, size, inode), properties) of each file read
+_cache = {}
+
+def loadProperties(path):
+    """
+    Returns the properties of an ovf-env file, by Entity.  The file is
+    parsed with expat, without building a DOM, and the result is kept
+    until the modification time, size or inode of the file change.
+    Namespace prefixes do not matter, only local names are compared.
+
+    @raise IOError: the file can not be read
+    @raise ValueError: the file is not well-formed XML
+
+    @param path: path to ovf-env.xml file
+    @type  path: String
+
+    @return: ovfenv:id of each Entity to its properties, property key to
+             value.  The properties of the Environment itself are under
+             None.
+    @rtype: L{ReadOnlyDict} of L{ReadOnlyDict}
+    """
+    stat = os.stat(path)
+    version = (stat.st_mtime, stat.st_size, stat.st_ino)
+    entry = _cache.get(path)
+    if entry != None and entry[0] == version:
+        return entry[1]
+
+    entities = {None : {}}
+    # stack of local names of the open elements, and the Entity id
+    names = []
+    current = [None]
+
+    def localName(name):
+        return name[name.rfind(' ') + 1:]
+
+    def getAttribute(attributes, name):
+        for (attrName, value) in attributes.iteritems():
+            if localName(attrName) == name:
+                return value
+        return None
+
+    def start(name, attributes):
+        name = localName(name)
+        if name == 'Entity' and len(names) == 1:
+            current[0] = getAttribute(attributes, 'id')
+            entities.setdefault(current[0], {})
+        elif name == 'Property' and names and names[-1] == 'PropertySection':
+            key = getAttribute(attributes, 'key')
+            if key != None:
+                entities[current[0]][key] = getAttribute(attributes, 'value')
+        names.append(name)
+
+    def end(name):
+        names.pop()
+        if len(names) == 1:
+            current[0] = None
+
+    parser = expat.ParserCreate(namespace_separator=' ')
+    parser.StartElementHandler = start
+    parser.EndElementHandler = end
+    fileObj = open(path, 'rb')
+    try:
+        try:
+            parser.ParseFile(fileObj)
+        except expat.ExpatError, e:
+            raise ValueError("%s: %s" % (path, e))
+    finally:
+        fileObj.close()
+
+    properties = ReadOnlyDict([(entityId, ReadOnlyDict(entityProperties))
+                               for (entityId, entityProperties)
+                               in entities.items()])
+    _cache[path] = (version, properties)
+    return properties
@@ -17,11 +17,12 @@ Contains methods to generate/manipulate environment xml file.
 
 #from xml.dom.ext import PrettyPrint
 import os
+from StringIO import StringIO
 from xml.dom.minidom import parse, Document
 from xml.dom.minidom import NodeList
 import Constants
+from EnvironmentReader import loadProperties
 from ovf import validation
-from ovf.Ovf import remove_whitespace_nodes
 from ovf.Ovf import xwritexml
 
 class EnvironmentSection:
@@ -43,6 +44,10 @@ class EnvironmentSection:
         self.environment = None #: Environment object.
         self.oldChild = None #: used for merging nodes.
         self.path = None
+        self._entities = None #: Entity id to Entity, see findElementById.
+        self._indexedDocument = None #: document self._entities is for.
+        self._duplicateIds = False #: an Entity id is used more than once.
+        self._sections = {} #: section to its key index, see _getSectionIndex.
 
         if path != None:
             self.path = path
@@ -186,6 +191,11 @@ class EnvironmentSection:
         element = self.document.createElement(Constants.ENT_SEC)
         element.setAttribute("ovfenv:id", envId)
         self.environment.appendChild(element)
+        entities = self._getEntities()
+        if entities.has_key(envId):
+            self._duplicateIds = True
+        else:
+            entities[envId] = element
 
 
     def addSection(self, section, secType, data):
@@ -228,10 +238,10 @@ class EnvironmentSection:
             self.addAttributesFromDict(Constants.PROPERTY, \
                                        Constants.PREFIX, platform, data)
         if section == self.environment:
-            elements = section.getElementsByTagName(Constants.ENT_SEC)
-            if elements != []:
-                section.insertBefore(platform, elements[0])
-                return
+            for node in section.childNodes:
+                if node.localName == Constants.ENT_SEC:
+                    section.insertBefore(platform, node)
+                    return
         section.appendChild(platform)
 
 
@@ -255,14 +265,21 @@ class EnvironmentSection:
             raise ValueError (Constants.MISSING_SECTION)
 
         if platformDict != None:
+            index = self._sections.get(node)
             for key, val in platformDict.iteritems():
                 element = self.document.createElement(key)
                 text = self.document.createTextNode(str(val))
                 element.appendChild(text)
                 if attachBeforeNode != None:
                     node.insertBefore(element, attachBeforeNode)
+                    if index != None:
+                        # the document order is no longer known
+                        del self._sections[node]
+                        index = None
                 else:
                     node.appendChild(element)
+                    if index != None:
+                        index.setdefault(key, []).append(element)
 
 
 
@@ -297,11 +314,15 @@ class EnvironmentSection:
             raise ValueError (Constants.MISSING_SECTION)
 
         if attrDict != None:
+            index = self._sections.get(node)
             for key, val in attrDict.iteritems():
                 element = self.document.createElement(elementName)
                 element.setAttribute(prefix+"key", key)
                 element.setAttribute(prefix+"value", val)
                 node.appendChild(element)
+                if index != None:
+                    indexKey = element.getAttribute(Constants.PREFIX + "key")
+                    index.setdefault(indexKey, []).append(element)
 
 
     def findElementById(self, envID):
@@ -325,27 +346,72 @@ class EnvironmentSection:
         if envID == None:
             raise ValueError (Constants.NO_ENVID)
 
-        rootElement = self.document.getElementsByTagName(Constants.ENV_SEC)
-        if rootElement == []:
+        rootElement = self.document.documentElement
+        if rootElement == None or rootElement.tagName != Constants.ENV_SEC:
             raise ValueError (Constants.MISSING_ENV)
 
-        attr = rootElement[0].attributes
-        if attr != None:
-            for i in range (0, attr.length):
-                if (attr.item(i).name == Constants.ID) \
-                & (attr.item(i).nodeValue == envID):
-                    return rootElement[0]
+        if rootElement.hasAttribute(Constants.ID) \
+        and rootElement.getAttribute(Constants.ID) == envID:
+            return rootElement
 
-        entityElement = self.document.getElementsByTagName(Constants.ENT_SEC)
-        if entityElement != []:
-            lenth = len(entityElement)
-            for i in range (0, lenth):
-                nam = entityElement[i]
-                if (nam.hasAttribute(Constants.ID)) \
-                & (nam.getAttribute(Constants.ID) == envID):
-                    return nam
+        return self._getEntities().get(envID)
 
-        return None
+    def touch(self):
+        """
+        Drop the Entity and Property indexes.  The methods of this class
+        keep them up to date; code that adds, removes or renames Entity
+        elements or properties directly through the DOM must call this
+        before using them again.
+        """
+        self._entities = None
+        self._indexedDocument = None
+        self._duplicateIds = False
+        self._sections = {}
+
+    def _getEntities(self):
+        """
+        Returns the index of Entity elements by id, made on first use.  An
+        id used twice maps to the first Entity, in document order.
+        """
+        if self._entities == None or \
+           self._indexedDocument is not self.document:
+            self._entities = {}
+            self._sections = {}
+            self._indexedDocument = self.document
+            self._duplicateIds = False
+            for entity in self.document.getElementsByTagName(Constants.ENT_SEC):
+                if entity.hasAttribute(Constants.ID):
+                    envId = entity.getAttribute(Constants.ID)
+                    if self._entities.has_key(envId):
+                        self._duplicateIds = True
+                    else:
+                        self._entities[envId] = entity
+        return self._entities
+
+    def _getSectionIndex(self, section, tagName=None):
+        """
+        Returns the index of a section, made on first use: the Property
+        elements of a PropertySection by ovfenv:key or, with tagName
+        None, the elements of a PlatformSection by tag name.  Each maps to
+        a list in document order.
+
+        @raise ValueError: a Property has no attributes
+        """
+        self._getEntities()
+        index = self._sections.get(section)
+        if index == None:
+            index = {}
+            if tagName == None:
+                for node in section.getElementsByTagName('*'):
+                    index.setdefault(node.tagName, []).append(node)
+            else:
+                for node in section.getElementsByTagName(tagName):
+                    if node.attributes.length == 0:
+                        raise ValueError(Constants.MISSING_PROPERTY)
+                    key = node.getAttribute(Constants.PREFIX + "key")
+                    index.setdefault(key, []).append(node)
+            self._sections[section] = index
+        return index
 
 
     def removeSection(self, secID, sectionName):
@@ -364,6 +430,9 @@ class EnvironmentSection:
             raise ValueError(Constants.MISSING_SECTION)
         for i in range(0, section.length):
             element.removeChild(section[i])
+            self._sections.pop(section[i], None)
+        if sectionName == Constants.ENT_SEC:
+            self.touch()
 
     def removeProperties (self, secID, keys):
         """
@@ -389,21 +458,15 @@ class EnvironmentSection:
         section = self.findNodeBySectionName(element, Constants.PROP_SEC)
         if section == []:
             raise ValueError(Constants.MISSING_SECTION)
-        #: Remove properties with given keys.
+        #: Remove properties with given keys, each key once.
         for x in range(0, section.length):
-            props = section[x].getElementsByTagName("Property")
-            for i in range(0, props.length):
-                attrs = props[i].attributes
-                attrList = attrs.items()
-                if attrList == []:
-                    raise ValueError(Constants.MISSING_PROPERTY)
-                else:
-                    for l in range(0, len(keys)):
-                        if keys[l] == attrList[0][1]:
-                            section[x].removeChild(props[i])
-                            keys.remove(keys[l])
-                            done = 1
-                            break
+            index = self._getSectionIndex(section[x], Constants.PROPERTY)
+            for key in keys[:]:
+                props = index.get(key)
+                if props:
+                    section[x].removeChild(props.pop(0))
+                    keys.remove(key)
+                    done = 1
         if done == 0:
             raise  ValueError(Constants.MISSING_PROPERTY)
 
@@ -434,10 +497,10 @@ class EnvironmentSection:
             raise ValueError(Constants.MISSING_SECTION)
         #: Remove properties with given keys.
         for x in range(0, section.length):
-            for y in range(0, len(keys)):
-                props = section[x].getElementsByTagName(keys[y])
-                for z in range(0, props.length):
-                    section[x].removeChild(props[z])
+            index = self._getSectionIndex(section[x])
+            for key in keys:
+                for prop in index.pop(key, []):
+                    section[x].removeChild(prop)
                     done = 1
         if done == 0:
             raise  ValueError(Constants.MISSING_PROPERTY)
@@ -459,12 +522,36 @@ class EnvironmentSection:
 
         fileHandle = open ( fileName, mode )
         if pretty:
-            remove_whitespace_nodes(self.document)
-            xwritexml(self.document, fileHandle, '', '\t', '\n', encoding)
+            xwritexml(self.document, fileHandle, '', '\t', '\n', encoding,
+                      skipWhitespace=True)
         else:
             fileHandle.write(self.document.toxml())
         fileHandle.close()
 
+    def toXML(self, pretty=True, encoding=None):
+        """ Returns the xml as written by L{generateXML}, for consumers
+        that do not need a file, such as L{OvfTransport.makeEnvironmentISO}.
+
+        @param pretty: if True format/indent (writexml) False = toxml()
+        @type  pretty: Boolean
+
+        @param encoding: The encoding used for the XML, default is UTF-8.
+        @type encoding: String
+
+        @return: serialized environment
+        @rtype: String
+        """
+        if pretty:
+            buffer = StringIO()
+            xwritexml(self.document, buffer, '', '\t', '\n', encoding,
+                      skipWhitespace=True)
+            data = buffer.getvalue()
+        else:
+            data = self.document.toxml()
+        if isinstance(data, unicode):
+            data = data.encode(encoding or 'UTF-8')
+        return data
+
 
     def changeID(self, oldId, newId):
         """ Will change ID of a section from oldId to newId.
@@ -490,6 +577,14 @@ class EnvironmentSection:
             raise ValueError(Constants.MISSING_ID)
         #: Replace oldId with newId
         modifyAttribute(element, Constants.ID, newId)
+        if element != self.document.documentElement:
+            if self._duplicateIds:
+                # another Entity may have oldId too
+                self.touch()
+            else:
+                entities = self._getEntities()
+                del entities[oldId]
+                entities[newId] = element
 
 
     def findNodeBySectionName(self, element, sectionName):
@@ -509,20 +604,23 @@ class EnvironmentSection:
 
         if element == None:
             raise ValueError (Constants.MISSING_ID)
-        # Find the section in given entity.
-        section = element.getElementsByTagName(sectionName)
-        if section.length == 0:
-            raise NameError (Constants.MISSING_ELEMENT)
         if element == self.environment:
-            # Weed out the Entity sections
+            # The root's own sections come before the Entity sections
             section = NodeList()
-            nodes = element.childNodes
-            for i in range(0, nodes.length):
-                if nodes[i].localName == Constants.ENT_SEC:
+            for node in element.childNodes:
+                if node.localName == Constants.ENT_SEC:
                     break
-                elif nodes[i].localName == sectionName:
-                    section.append(nodes[i])
-        return section
+                elif node.localName == sectionName:
+                    section.append(node)
+            if section.length:
+                return section
+        # Find the section in given entity.
+        found = element.getElementsByTagName(sectionName)
+        if found.length == 0:
+            raise NameError (Constants.MISSING_ELEMENT)
+        if element == self.environment:
+            return section
+        return found
 
 
 def modifyAttribute(section, key, value):
@@ -557,9 +655,6 @@ def validateXML(xmlFile, schemaFile):
     @type schemaFile: String
     """
 
-    message = None
-    first = 1
-
     if not schemaFile or not os.path.exists(schemaFile):
         raise ValueError (Constants.MISSING_SCHEMA)
 
@@ -568,6 +663,38 @@ def validateXML(xmlFile, schemaFile):
 
     msgHandler = validation.ErrorHandler()
     ret = validation.validateOVF(schemaFile, xmlFile, msgHandler)
+    return _checkValidation(ret, msgHandler)
+
+def validateDocument(document, schemaFile):
+    """
+    This method validates a document in memory against the schema, so
+    that it does not need to be written to a file first.
+
+    @param document: An L{EnvironmentSection}, a DOM Node, the serialized
+                     xml or a stream to read it from.
+    @type document: L{EnvironmentSection}, DOM Node, String or file
+
+    @param schemaFile: Path to schema file used for validation.
+    @type schemaFile: String
+    """
+
+    if not schemaFile or not os.path.exists(schemaFile):
+        raise ValueError (Constants.MISSING_SCHEMA)
+
+    if isinstance(document, EnvironmentSection):
+        document = document.toXML()
+
+    msgHandler = validation.ErrorHandler()
+    ret = validation.validateDocument(schemaFile, document, msgHandler)
+    return _checkValidation(ret, msgHandler)
+
+def _checkValidation(ret, msgHandler):
+    """
+    Returns ret, the result of a validation; raises ValueError with the
+    error messages if it failed.
+    """
+    message = None
+    first = 1
 
     for each in msgHandler.error_list:
         if first:
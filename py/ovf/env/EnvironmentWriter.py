@@ -0,0 +1,205 @@
+# vi: ts=4 expandtab syntax=python
+##############################################################################
+# Copyright (c) 2008 IBM Corporation
+# All rights reserved. This program and the accompanying materials
+# are made available under the terms of the Eclipse Public License v1.0
+# which accompanies this distribution, and is available at
+# http://www.eclipse.org/legal/epl-v10.html
+#
+##############################################################################
+
+"""
+Writes an ovf-env document as its sections are produced, without building
+a DOM.
+"""
+
+import Constants
+from ovf.Ovf import xmlEscape
+
+class EnvironmentWriter:
+    """
+    Writes an ovf-env document piece by piece, in the format of
+    L{EnvironmentSection.generateXML<EnvironmentSection.EnvironmentSection.generateXML>}.
+    The sections of the Environment come first, then its Entity elements,
+    each with its own sections, so a document with any number of
+    entities is written in constant memory.
+
+    @ivar entityIds: ids of the Entity elements written
+    @type entityIds: dictionary
+    """
+
+    def __init__(self, fileObj, envId=None, encoding=None):
+        """
+        Writes the XML declaration and starts the Environment element.
+
+        @param fileObj: destination, anything with write()
+        @type fileObj: file
+
+        @param envId: id of the Environment
+        @type envId: String
+
+        @param encoding: The encoding declared in the XML header and used
+                         for unicode values, default is UTF-8.
+        @type encoding: String
+        """
+        self._write = fileObj.write
+        self.encoding = encoding
+        self.entityIds = {}
+        self._open = [] #: tags of the elements being written
+        self._pending = False #: the last start tag is not finished yet
+
+        if encoding == None:
+            self._write('<?xml version="1.0" ?>\n')
+        else:
+            self._write('<?xml version="1.0" encoding="%s"?>\n' % encoding)
+        attributes = {Constants.XSI_KEY : Constants.XSI_VAL,
+                      Constants.ENV_KEY : Constants.ENV_VAL,
+                      Constants.STR_KEY : Constants.STR_VAL,
+                      Constants.NS_KEY : Constants.NS_VAL}
+        if envId != None:
+            attributes[Constants.ID] = envId
+        self._start(Constants.ENV_SEC, attributes)
+
+    def writePlatformSection(self, platformDict):
+        """
+        Write a PlatformSection in the Environment or the current Entity.
+
+        @raise ValueError: an Entity of the Environment was written already
+
+        @param platformDict: deployment platform, see
+                             L{PlatformSection.PlatformSection}
+        @type platformDict: dict
+        """
+        self._checkSection()
+        self._start(Constants.PLAT_SEC)
+        for key, val in platformDict.iteritems():
+            self._element(key, str(val))
+        self._end()
+
+    def writePropertySection(self, propertyDict):
+        """
+        Write a PropertySection in the Environment or the current Entity.
+
+        @raise ValueError: an Entity of the Environment was written already
+
+        @param propertyDict: property key to value
+        @type propertyDict: dict
+        """
+        self._checkSection()
+        self._start(Constants.PROP_SEC)
+        for key, val in propertyDict.iteritems():
+            self._element(Constants.PROPERTY,
+                          attributes={Constants.PREFIX + "key" : key,
+                                      Constants.PREFIX + "value" : val})
+        self._end()
+
+    def startEntity(self, entityId):
+        """
+        Start an Entity; the sections written until L{endEntity} are its.
+
+        @raise ValueError: The possible cases are as follow
+            - I{B{Case 1:}} No id provided.
+            - I{B{Case 2:}} An Entity with the id was written already.
+            - I{B{Case 3:}} An Entity is being written.
+
+        @param entityId: Unique ID of the Entity
+        @type entityId: String
+        """
+        if entityId == None:
+            raise ValueError(Constants.NO_ENVID)
+        if self.entityIds.has_key(entityId):
+            raise ValueError(Constants.ENT_EXISTS)
+        if len(self._open) != 1:
+            raise ValueError(Constants.MISSING_ENV)
+        self.entityIds[entityId] = True
+        self._start(Constants.ENT_SEC, {Constants.ID : entityId})
+
+    def endEntity(self):
+        """End the Entity started by L{startEntity}."""
+        if len(self._open) != 2:
+            raise ValueError(Constants.MISSING_ELEMENT)
+        self._end()
+
+    def writeEntity(self, entityId, propertyDict=None, platformDict=None):
+        """
+        Write an Entity with a PlatformSection and a PropertySection.
+
+        @param entityId: Unique ID of the Entity
+        @type entityId: String
+
+        @param propertyDict: property key to value, None for no
+                             PropertySection
+        @type propertyDict: dict
+
+        @param platformDict: deployment platform, None for no
+                             PlatformSection
+        @type platformDict: dict
+        """
+        self.startEntity(entityId)
+        if platformDict != None:
+            self.writePlatformSection(platformDict)
+        if propertyDict != None:
+            self.writePropertySection(propertyDict)
+        self.endEntity()
+
+    def close(self):
+        """
+        End the Environment.  The file is left open.
+        """
+        while self._open:
+            self._end()
+
+    def _checkSection(self):
+        """Sections of the Environment go before its Entity elements."""
+        if not self._open or (len(self._open) == 1 and self.entityIds):
+            raise ValueError(Constants.ENT_EXISTS)
+
+    def _text(self, data):
+        """Returns escaped data, encoded if it is unicode."""
+        data = xmlEscape(data)
+        if isinstance(data, unicode):
+            data = data.encode(self.encoding or 'UTF-8')
+        return data
+
+    def _finishStart(self):
+        """Finish a start tag that is known to have children."""
+        if self._pending:
+            self._write(">\n")
+            self._pending = False
+
+    def _start(self, tagName, attributes=None):
+        """Start an element; it is closed by L{_end}."""
+        self._finishStart()
+        self._write('\t' * len(self._open) + '<' + tagName +
+                    self._attributes(attributes))
+        self._open.append(tagName)
+        self._pending = True
+
+    def _end(self):
+        """End the innermost element."""
+        tagName = self._open.pop()
+        if self._pending:
+            self._write("/>\n")
+            self._pending = False
+        else:
+            self._write('\t' * len(self._open) + '</' + tagName + '>\n')
+
+    def _element(self, tagName, data=None, attributes=None):
+        """Write an element with only text, empty text is left out."""
+        self._finishStart()
+        start = '\t' * len(self._open) + '<' + tagName + \
+                self._attributes(attributes)
+        if data == None or not data.strip():
+            self._write(start + '/>\n')
+        else:
+            self._write(start + '>' + self._text(data) + '</' + tagName +
+                        '>\n')
+
+    def _attributes(self, attributes):
+        """Returns attributes as written in a start tag, sorted by name."""
+        if not attributes:
+            return ''
+        names = attributes.keys()
+        names.sort()
+        return ''.join([' %s="%s"' % (name, self._text(attributes[name]))
+                        for name in names])
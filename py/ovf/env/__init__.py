@@ -10,5 +10,7 @@
 # Dave Leskovec (IBM) - initial implementation
 ##############################################################################
 __all__ = ["Constants",
+           "EnvironmentReader",
            "EnvironmentSection",
+           "EnvironmentWriter",
            "PlatformSection"]
@@ -10,10 +10,19 @@
 # Murillo Fernandes Bernardes (IBM) - initial implementation
 ##############################################################################
 
-"""OVF schema validation"""
+"""
+OVF schema validation.  libxml2 is imported when the first schema is
+compiled or document parsed, so importing this module is cheap and works
+without it.
+"""
 
-import libxml2
-import sys
+import cPickle
+import os
+import threading
+
+#: absolute path of each compiled schema to ((mtime, size), schema)
+_schemas = {}
+_schemasLock = threading.Lock()
 
 class ErrorHandler:
     """Schema validation error/warning messages handler"""
@@ -44,9 +53,38 @@ class ErrorHandler:
         """
         self.warning_list.append(msg)
 
+def getSchema(schema_file):
+    """
+    Returns the compiled schema of schema_file.  A schema, with the ones
+    it imports, is compiled once per process and kept until the
+    modification time or size of schema_file change.
+
+    @type   schema_file: string
+    @param  schema_file: OVF Schema path.
+    @rtype:     libxml2.Schema
+    @return:    the compiled schema.
+    """
+    path = os.path.abspath(schema_file)
+    stat = os.stat(path)
+    version = (stat.st_mtime, stat.st_size)
+
+    _schemasLock.acquire()
+    try:
+        entry = _schemas.get(path)
+        if entry == None or entry[0] != version:
+            import libxml2
+            ctxt_parser = libxml2.schemaNewParserCtxt(path)
+            entry = (version, ctxt_parser.schemaParse())
+            del ctxt_parser
+            _schemas[path] = entry
+        return entry[1]
+    finally:
+        _schemasLock.release()
+
 def validateOVF(schema_file, ovf_file, handler=None):
     """
-    OVF schema validation.
+    OVF schema validation.  The schema is compiled on the first call, see
+    L{getSchema}.
 
     @type   schema_file: string
     @param  schema_file: OVF Schema path.
@@ -59,11 +97,7 @@ def validateOVF(schema_file, ovf_file, handler=None):
     @return:    Error Code. 0 (zero) is OK.
     """
 
-    ctxt_parser = libxml2.schemaNewParserCtxt(schema_file)
-    ctxt_schema = ctxt_parser.schemaParse()
-    del ctxt_parser
-
-    validator  = ctxt_schema.schemaNewValidCtxt()
+    validator = getSchema(schema_file).schemaNewValidCtxt()
 
     if not handler:
         handler = ErrorHandler()
@@ -73,7 +107,142 @@ def validateOVF(schema_file, ovf_file, handler=None):
     # Test valid document
     ret = validator.schemaValidateFile(ovf_file, 0)
 
-    del ctxt_schema
     del validator
 
     return ret
+
+def validateDocument(schema_file, document, handler=None, name=None):
+    """
+    OVF schema validation of a document in memory, so that it does not
+    have to be written to a file first.
+
+    @type   schema_file: string
+    @param  schema_file: OVF Schema path.
+    @type   document: string, file, DOM Node or L{OvfFile<ovf.OvfFile.OvfFile>}
+    @param  document: the serialized document, a stream to read it from,
+            a DOM Node, or an object with a serialize() method, such as
+            an OvfFile, which is serialized as it is now.
+    @type   handler: L{ErrorHandler}
+    @param  handler: object used to return validation
+            error and warning messages.
+    @type   name: string
+    @param  name: name of the document in messages.
+    @rtype:     int
+    @return:    Error Code. 0 (zero) is OK, -1 the document is not
+                well-formed.
+    """
+    if hasattr(document, 'serialize'):
+        data = document.serialize()
+    elif hasattr(document, 'read'):
+        data = document.read()
+    elif hasattr(document, 'toxml'):
+        data = document.toxml('UTF-8')
+    else:
+        data = document
+    if isinstance(data, unicode):
+        data = data.encode('UTF-8')
+
+    if not handler:
+        handler = ErrorHandler()
+
+    import libxml2
+    try:
+        doc = libxml2.readMemory(data, len(data), name or 'noname.xml',
+                                 None, 0)
+    except libxml2.treeError, e:
+        handler.error(str(e))
+        return -1
+
+    try:
+        validator = getSchema(schema_file).schemaNewValidCtxt()
+        validator.setValidityErrorHandler(handler.error, handler.warning)
+        ret = validator.schemaValidateDoc(doc)
+        del validator
+    finally:
+        doc.freeDoc()
+
+    return ret
+
+def validateMany(schema_file, ovf_files, workers=1):
+    """
+    Validates many files against one schema.  The schema is compiled
+    once, then ovf_files are shared out between up to workers processes,
+    each with its own copy of the compiled schema, which validate them at
+    the same time.  Where processes can not be forked, the files are
+    validated in this process.
+
+    @raise RuntimeError: a worker process failed
+
+    @type   schema_file: string
+    @param  schema_file: OVF Schema path.
+    @type   ovf_files: list of strings
+    @param  ovf_files: OVF file paths.
+    @type   workers: int
+    @param  workers: number of processes, 1 validates in this process.
+    @rtype:     list of tuples
+    @return:    (Error Code, L{ErrorHandler}) of each file, in the order
+                of ovf_files.
+    """
+    # compiled before forking, so that the workers inherit it
+    getSchema(schema_file)
+
+    workers = min(workers, len(ovf_files))
+    if workers <= 1 or not hasattr(os, 'fork'):
+        return [_validateFile(schema_file, ovf_file)
+                for ovf_file in ovf_files]
+
+    children = []
+    for worker in range(workers):
+        (readFd, writeFd) = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            # worker: validate every workers-th file, send back the results
+            os.close(readFd)
+            status = 1
+            try:
+                try:
+                    results = [(ret, handler.error_list, handler.warning_list)
+                               for (ret, handler) in
+                               [_validateFile(schema_file, ovf_file)
+                                for ovf_file in ovf_files[worker::workers]]]
+                    writer = os.fdopen(writeFd, 'wb')
+                    cPickle.dump(results, writer, cPickle.HIGHEST_PROTOCOL)
+                    writer.close()
+                    status = 0
+                except:
+                    pass
+            finally:
+                os._exit(status)
+        os.close(writeFd)
+        children.append((pid, os.fdopen(readFd, 'rb')))
+
+    results = [None] * len(ovf_files)
+    failed = False
+    for (worker, (pid, reader)) in enumerate(children):
+        try:
+            try:
+                workerResults = cPickle.load(reader)
+            except (EOFError, cPickle.UnpicklingError):
+                workerResults = None
+        finally:
+            reader.close()
+        (pid, status) = os.waitpid(pid, 0)
+        if workerResults == None or status != 0:
+            failed = True
+            continue
+        for (index, (ret, errors, warnings)) in \
+                zip(range(worker, len(ovf_files), workers), workerResults):
+            handler = ErrorHandler()
+            handler.error_list = errors
+            handler.warning_list = warnings
+            results[index] = (ret, handler)
+
+    if failed:
+        raise RuntimeError("schema validation process failed")
+    return results
+
+def _validateFile(schema_file, ovf_file):
+    """Returns (Error Code, L{ErrorHandler}) of one file."""
+    handler = ErrorHandler()
+    ret = validateOVF(schema_file, ovf_file, handler)
+    return (ret, handler)
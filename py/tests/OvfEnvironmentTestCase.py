@@ -15,10 +15,16 @@ pyUnit tests
 """
 
 import os, unittest
+import shutil
+import tempfile
+from StringIO import StringIO
 from xml.dom.minidom import parse
 
+from ovf.env import Constants
 from ovf.env import EnvironmentSection
+from ovf.env import EnvironmentWriter
 from ovf.env import PlatformSection
+from ovf import validation
 
 TEST_FILES_DIR = os.path.join(os.path.dirname(__file__), "test_files/")
 SCHEMA_FILES_DIR = os.path.join(os.path.dirname(__file__), "..", "..", "..")
@@ -456,6 +462,150 @@ class OvfEnvironmentTestCase (unittest.TestCase):
         self.assertRaises(ValueError, EnvironmentSection.validateXML,
                           "out.xml", OVF_ENV_XSD)
 
+    def testValidateMany(self):
+        """ Test validation.validateMany and the schema cache. """
+        self.assertTrue(validation.getSchema(OVF_ENV_XSD) is
+                        validation.getSchema(OVF_ENV_XSD))
+
+        tmpDir = tempfile.mkdtemp()
+        try:
+            invalid = os.path.join(tmpDir, "invalid.xml")
+            self.ovfEnv.createSection("12", "PlatformSection", self.propdata)
+            self.ovfEnv.generateXML(invalid)
+            files = [self.fileName, invalid, self.fileName]
+
+            for workers in (1, 2, 4):
+                results = validation.validateMany(OVF_ENV_XSD, files, workers)
+                self.assertEquals(len(results), 3)
+                self.assertEquals(results[0][0], 0)
+                self.assertNotEquals(results[1][0], 0)
+                self.assertTrue(results[1][1].error_list)
+                self.assertEquals(results[2][0], 0)
+                self.assertEquals(results[2][1].error_list, [])
+        finally:
+            shutil.rmtree(tmpDir)
+
+    def testValidateDocument(self):
+        """ Test validateDocument with documents in memory. """
+        data = self.ovfEnv.toXML()
+        self.assertEquals(EnvironmentSection.validateDocument(self.ovfEnv,
+                                                              OVF_ENV_XSD), 0)
+        self.assertEquals(EnvironmentSection.validateDocument(data,
+                                                              OVF_ENV_XSD), 0)
+        self.assertEquals(EnvironmentSection.validateDocument(StringIO(data),
+                                                              OVF_ENV_XSD), 0)
+        self.assertEquals(EnvironmentSection.validateDocument(
+                          self.ovfEnv.document, OVF_ENV_XSD), 0)
+
+        self.assertRaises(ValueError, EnvironmentSection.validateDocument,
+                          data, None)
+        self.assertRaises(ValueError, EnvironmentSection.validateDocument,
+                          data[:len(data) / 2], OVF_ENV_XSD)
+        self.ovfEnv.createSection("12", "PlatformSection", self.propdata)
+        self.assertRaises(ValueError, EnvironmentSection.validateDocument,
+                          self.ovfEnv, OVF_ENV_XSD)
+
+    def testIndexes(self):
+        """ Test the Entity and Property indexes. """
+        self.ovfEnv2.createHeader("root")
+        for i in range(0, 1000):
+            envId = "e%d" % i
+            self.ovfEnv2.createSection(envId, "Entity")
+            self.ovfEnv2.createSection(envId, "PropertySection",
+                                       {'a' : str(i), 'b' : str(i)})
+        self.assertEquals(self.ovfEnv2.findElementById("root"),
+                          self.ovfEnv2.environment)
+        entity = self.ovfEnv2.findElementById("e500")
+        self.assertEquals(entity.getAttribute("ovfenv:id"), "e500")
+        self.assertRaises(ValueError, self.ovfEnv2.createSection, "e500",
+                          "Entity")
+
+        self.ovfEnv2.changeID("e500", "renamed")
+        self.assertEquals(self.ovfEnv2.findElementById("e500"), None)
+        self.assertEquals(self.ovfEnv2.findElementById("renamed"), entity)
+
+        # properties added after the index is made are found too
+        keys = ['a']
+        self.ovfEnv2.removeProperties("renamed", keys)
+        self.assertEquals(keys, [])
+        section = entity.getElementsByTagName("PropertySection")[0]
+        self.ovfEnv2.addAttributesFromDict("Property", "ovfenv:", section,
+                                           {'c' : 'x'})
+        self.ovfEnv2.removeProperties("renamed", ['b', 'c'])
+        self.assertEquals(section.getElementsByTagName("Property").length, 0)
+        self.assertRaises(ValueError, self.ovfEnv2.removeProperties,
+                          "renamed", ['a'])
+
+        # changes made through the DOM are seen after touch
+        self.ovfEnv2.environment.removeChild(entity)
+        self.ovfEnv2.touch()
+        self.assertEquals(self.ovfEnv2.findElementById("renamed"), None)
+        self.ovfEnv2.createSection("renamed", "Entity")
+        self.assertNotEquals(self.ovfEnv2.findElementById("renamed"), None)
+
+    def testEnvironmentWriter(self):
+        """ Test that EnvironmentWriter writes what generateXML does. """
+        self.ovfEnv2.createHeader("vs")
+        self.ovfEnv2.createSection(None, "PlatformSection", self.platdata)
+        self.ovfEnv2.createSection(None, "PropertySection",
+                                   {'a' : '1 & <2>', 'b' : ''})
+        self.ovfEnv2.createSection("e1", "Entity")
+        self.ovfEnv2.createSection("e1", "PropertySection", self.propdata)
+        self.ovfEnv2.createSection("e2", "Entity")
+
+        output = StringIO()
+        writer = EnvironmentWriter.EnvironmentWriter(output, "vs")
+        writer.writePlatformSection(self.platdata)
+        writer.writePropertySection({'a' : '1 & <2>', 'b' : ''})
+        writer.writeEntity("e1", self.propdata)
+        writer.startEntity("e2")
+        writer.endEntity()
+        self.assertRaises(ValueError, writer.writeEntity, "e1")
+        self.assertRaises(ValueError, writer.writePropertySection, {})
+        writer.close()
+        self.assertEquals(output.getvalue(), self.ovfEnv2.toXML())
+
+        output = StringIO()
+        EnvironmentWriter.EnvironmentWriter(output).close()
+        self.ovfEnv2 = EnvironmentSection.EnvironmentSection()
+        self.ovfEnv2.createHeader()
+        self.assertEquals(output.getvalue(), self.ovfEnv2.toXML())
+
+    def testLoadProperties(self):
+        """ Test EnvironmentSection.loadProperties. """
+        properties = EnvironmentSection.loadProperties(self.fileName)
+        self.assertEquals(properties,
+                          {None : {},
+                           '2' : {'UserName' : 'Sharad Mishra',
+                                  'Passord' : 'password111',
+                                  'IP' : '9.47.55.55'},
+                           '3' : {}})
+        self.assertRaises(TypeError, properties['2'].__setitem__, 'IP', '')
+        self.assert_(EnvironmentSection.loadProperties(self.fileName) is
+                     properties, "not cached")
+
+        # another prefix, and a changed file is read again
+        tmpDir = tempfile.mkdtemp()
+        try:
+            fileName = os.path.join(tmpDir, 'ovf-env.xml')
+            envFile = open(fileName, 'w')
+            envFile.write('<oe:Environment xmlns:oe="%s">'
+                          '<oe:PropertySection><oe:Property oe:key="k" '
+                          'oe:value="&lt;v&gt;"/></oe:PropertySection>'
+                          '</oe:Environment>' % Constants.ENV_VAL)
+            envFile.close()
+            properties = EnvironmentSection.loadProperties(fileName)
+            self.assertEquals(properties, {None : {'k' : '<v>'}})
+
+            envFile = open(fileName, 'w')
+            envFile.write('<Environment/')
+            envFile.close()
+            os.utime(fileName, (0, 0))
+            self.assertRaises(ValueError, EnvironmentSection.loadProperties,
+                              fileName)
+        finally:
+            shutil.rmtree(tmpDir)
+
 if __name__ == "__main__":
     __runTest__ = unittest.TestLoader().loadTestsFromTestCase\
     (OvfEnvironmentTestCase)
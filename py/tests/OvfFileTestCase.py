@@ -11,8 +11,10 @@
 # Marcos Cintron (IBM) - initial implementation
 ##############################################################################
 import os, unittest
+import sha
 from xml.dom.minidom import parse
 
+from ovf import Ovf
 from ovf import OvfFile
 from ovf import OvfReferencedFile
 import testUtils
@@ -82,6 +84,73 @@ class OvfFileTestCase(unittest.TestCase):
 
         os.remove(fullname)
 
+    def test_serialize(self):
+        """Testing OvfFile.serialize and OvfFile.getDigest"""
+        data = self.ovfFile.serialize()
+        self.assertEqual(self.ovfFile.serialize(), data)
+        self.assertEqual(self.ovfFile.getDigest(), sha.new(data).hexdigest())
+        self.assertNotEqual(self.ovfFile.serialize(False), data)
+
+        # changes through the create/add methods are serialized
+        self.ovfFile.createComment('changed')
+        self.assertTrue('<!--changed-->' in self.ovfFile.serialize())
+
+        # and so are direct DOM changes
+        digest = self.ovfFile.getDigest()
+        self.ovfFile.envelope.setAttribute('ovf:version', '0.9')
+        data = self.ovfFile.serialize()
+        self.assertTrue('0.9' in data)
+        self.assertNotEqual(self.ovfFile.getDigest(), digest)
+        self.assertEqual(self.ovfFile.getDigest(), sha.new(data).hexdigest())
+
+    def test_getChecksum(self):
+        """Testing OvfFile.getChecksum"""
+        self.assertEqual(self.ovfFile.getChecksum(),
+                         Ovf.sha1sumFile(self.fileName))
+
+        fullname = self.path+"/"+"tester.ovf"
+        fileObj = open(fullname, "w")
+        self.ovfFile.writeFile(fileObj)
+        fileObj.close()
+        try:
+            self.assertEqual(self.ovfFile.getChecksum(fullname),
+                             self.ovfFile.getDigest())
+            self.assertEqual(self.ovfFile.getChecksum(fullname),
+                             Ovf.sha1sumFile(fullname))
+
+            # a DOM change made after a write is written the next time
+            self.ovfFile.envelope.setAttribute('ovf:version', '9.9')
+            fileObj = open(fullname, "w")
+            self.ovfFile.writeFile(fileObj)
+            fileObj.close()
+            self.assertTrue('9.9' in open(fullname).read())
+            self.assertEqual(self.ovfFile.getChecksum(fullname),
+                             Ovf.sha1sumFile(fullname))
+            self.assertEqual(self.ovfFile.getChecksum(fullname),
+                             self.ovfFile.getDigest())
+
+            # a file changed behind our back is read again
+            fileObj = open(fullname, "a")
+            fileObj.write("\n")
+            fileObj.close()
+            self.assertEqual(self.ovfFile.getChecksum(fullname),
+                             Ovf.sha1sumFile(fullname))
+        finally:
+            os.remove(fullname)
+
+    def test_selectNodes(self):
+        """Testing OvfFile.selectNodes and OvfFile.getIndex"""
+        index = self.ovfFile.getIndex()
+        files = self.ovfFile.selectNodes('References/File[@ovf:id=file2]',
+                                         index)
+        self.assertEqual(len(files), 1)
+        self.assertEqual(files[0].getAttribute('ovf:href'), 'Ubuntu-0.vmdk')
+
+        # nodes removed through the DOM are not selected any more
+        files[0].parentNode.removeChild(files[0])
+        self.assertEqual(
+            self.ovfFile.selectNodes('References/File[@ovf:id=file2]'), [])
+
     def test_syncReferencedFilesToDom(self):
         fileID = []
         fileHref = []
@@ -158,6 +227,18 @@ class OvfFileTestCase(unittest.TestCase):
             self.assertTrue(node.getAttribute("ovf:capacityAllocationUnits") == "GigaBytes")
             self.assertTrue(node.getAttribute("ovf:parentRef") =='')
 
+        # sizes are checked with the DSP0004 unit parser
+        dict['diskId'] = 'disk2'
+        dict['capacityAllocUnits'] = "percent"
+        self.assertRaises(ValueError, self.ovfFile3.addDisk,
+                          self.ovfFile3.document.getElementsByTagName(
+                              'DiskSection')[0], diskDictList)
+        dict['capacityAllocUnits'] = "byte * 2^30"
+        dict['populatedSize'] = 'big'
+        self.assertRaises(ValueError, self.ovfFile3.addDisk,
+                          self.ovfFile3.document.getElementsByTagName(
+                              'DiskSection')[0], diskDictList)
+
     def test_createNetworkSection(self):
         """Testing OvfFile.createNetworkSection:"""
 
@@ -0,0 +1,156 @@
+#!/usr/bin/python
+# vi: ts=4 expandtab syntax=python
+##############################################################################
+# Copyright (c) 2008 IBM Corporation
+# All rights reserved. This program and the accompanying materials
+# are made available under the terms of the Eclipse Public License v1.0
+# which accompanies this distribution, and is available at
+# http://www.eclipse.org/legal/epl-v10.html
+#
+##############################################################################
+"""
+Test case for functions in OvfIso.py
+"""
+
+import unittest
+import struct
+
+from ovf import OvfIso
+
+SECTOR = OvfIso.SECTOR_SIZE
+
+def readDirectory(image, extent, size):
+    """
+    Returns the records of a directory as (name, extent, size, flags,
+    systemUse), following records to the next sector when a sector ends.
+    """
+    records = []
+    offset = extent * SECTOR
+    end = offset + size
+    while offset < end:
+        length = ord(image[offset])
+        if length == 0:
+            offset = (offset / SECTOR + 1) * SECTOR
+            continue
+        record = image[offset:offset + length]
+        nameLength = ord(record[32])
+        systemUse = record[33 + nameLength + (nameLength + 1) % 2:]
+        records.append((record[33:33 + nameLength],
+                        struct.unpack('<I', record[2:6])[0],
+                        struct.unpack('<I', record[10:14])[0],
+                        ord(record[25]), systemUse))
+        offset += length
+    return records
+
+def getSuspEntries(systemUse):
+    """Returns the SUSP entries of a system use area as {signature: data}"""
+    entries = {}
+    while len(systemUse) >= 4:
+        length = ord(systemUse[2])
+        if length == 0:
+            break
+        entries[systemUse[:2]] = systemUse[:length]
+        systemUse = systemUse[length:]
+    return entries
+
+def readIso(image, joliet=False):
+    """
+    Returns the files of the root directory of an image as {name: data},
+    named by Rock Ridge, or with joliet by the Joliet tree.
+    """
+    descriptor = 16
+    if joliet:
+        descriptor = 17
+    root = image[descriptor * SECTOR + 156:descriptor * SECTOR + 190]
+    files = {}
+    for (name, extent, size, flags, systemUse) in \
+            readDirectory(image, struct.unpack('<I', root[2:6])[0],
+                          struct.unpack('<I', root[10:14])[0]):
+        if name in ('\0', '\1'):
+            continue
+        if joliet:
+            name = name.decode('utf_16_be').encode('UTF-8')
+            name = name[:name.rindex(';')]
+        else:
+            name = getSuspEntries(systemUse)['NM'][5:]
+        files[name] = image[extent * SECTOR:extent * SECTOR + size]
+    return files
+
+class OvfIsoTestCase(unittest.TestCase):
+    """
+    Test OvfIso functions
+    """
+
+    files = [('ovf-env.xml', '<Environment/>\n' * 200),
+             ('empty', ''),
+             ('Long name, two dots.tar.gz', 'x' * SECTOR),
+             ('ovf-env2.xml', 'y')]
+
+    def test_getIsoName(self):
+        """
+        Test OvfIso.getIsoName
+        """
+        used = {}
+        assert OvfIso.getIsoName('ovf-env.xml', used) == 'OVF_ENV.XML;1', \
+               "name mismatch"
+        assert OvfIso.getIsoName('OVF-ENV.XML', used) == 'OVF_ENV1.XML;1', \
+               "taken name not numbered"
+        assert OvfIso.getIsoName('a very long name.html') == \
+               'A_VERY_L.HTM;1', "name not cut"
+        assert OvfIso.getIsoName('README') == 'README.;1', "no extension"
+        assert OvfIso.getIsoName('.hidden') == '_.HID;1', "no base name"
+
+    def test_makeIso(self):
+        """
+        Test OvfIso.makeIso
+        """
+        image = OvfIso.makeIso(self.files, 'OVF_ENV', 0)
+        assert len(image) % SECTOR == 0, "image not in sectors"
+
+        primary = image[16 * SECTOR:17 * SECTOR]
+        assert primary[:8] == '\1CD001\1\0', "no primary descriptor"
+        assert primary[40:47] == 'OVF_ENV', "volume identifier mismatch"
+        assert struct.unpack('<I', primary[80:84])[0] * SECTOR == len(image), \
+               "volume size mismatch"
+        assert primary[813:830] == '1970010100000000\0', "date mismatch"
+        joliet = image[17 * SECTOR:18 * SECTOR]
+        assert joliet[:8] == '\2CD001\1\0', "no Joliet descriptor"
+        assert joliet[88:91] == OvfIso.JOLIET_ESCAPE, "Joliet escape mismatch"
+        assert image[18 * SECTOR:18 * SECTOR + 7] == '\xffCD001\1', \
+               "no terminator"
+
+        expected = dict(self.files)
+        assert readIso(image) == expected, "Rock Ridge tree mismatch"
+        assert readIso(image, joliet=True) == expected, "Joliet tree mismatch"
+
+        # the Rock Ridge extension is announced from the root directory
+        root = readDirectory(image, struct.unpack('<I', primary[158:162])[0],
+                             SECTOR)[0]
+        entries = getSuspEntries(root[4])
+        assert entries['SP'][4:6] == '\xbe\xef', "no SP entry"
+        continuation = struct.unpack('<I', entries['CE'][4:8])[0]
+        area = image[continuation * SECTOR:(continuation + 1) * SECTOR]
+        assert area[:2] == 'ER' and area[8:18] == OvfIso.RRIP_ID, \
+               "no ER entry"
+
+        # the ISO 9660 names are unique, sorted d-characters
+        names = [record[0] for record in
+                 readDirectory(image, root[1], root[2])[2:]]
+        assert names == ['EMPTY.;1', 'LONG_NAM.GZ;1', 'OVF_ENV.XML;1',
+                         'OVF_ENV2.XML;1'], "ISO 9660 names mismatch"
+
+    def test_makeIsoErrors(self):
+        """
+        Test OvfIso.makeIso with invalid names
+        """
+        self.assertRaises(ValueError, OvfIso.makeIso, [('dir/file', '')])
+        self.assertRaises(ValueError, OvfIso.makeIso, [('..', '')])
+        self.assertRaises(ValueError, OvfIso.makeIso,
+                          [('same', ''), ('same', 'x')])
+        self.assertRaises(ValueError, OvfIso.makeIso, [('n' * 63, '')])
+        OvfIso.makeIso([('n' * 62, '')])
+
+if __name__ == "__main__":
+    TEST = unittest.TestLoader().loadTestsFromTestCase(OvfIsoTestCase)
+    RUNNER = unittest.TextTestRunner(verbosity=2)
+    RUNNER.run(unittest.TestSuite(TEST))
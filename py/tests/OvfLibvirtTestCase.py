@@ -10,15 +10,94 @@
 # Contributors:
 # Eric Casler (IBM) - initial implementation
 ##############################################################################
+import copy
 import os
+import pickle
+import shutil
+import tempfile
+import threading
 import unittest
-from xml.dom.minidom import Document
+from xml.dom.minidom import Document, parseString
 
 from ovf import OvfLibvirt
 from ovf import Ovf
+import fakelibvirt
 
 TEST_FILES_DIR = os.path.join(os.path.dirname(__file__), "test_files/")
 
+STARTUP_OVF = """<Envelope xmlns:ovf="urn:ovf">
+  <VirtualSystemCollection ovf:id="app">
+    <StartupSection>
+      <Item ovf:id="db" ovf:order="1" ovf:startDelay="30"
+            ovf:waitingForGuest="true" ovf:stopAction="guestShutdown"
+            ovf:stopDelay="20"/>
+      <Item ovf:id="web" ovf:order="2" ovf:startDelay="5"/>
+    </StartupSection>
+    <VirtualSystem ovf:id="db"/>
+    <VirtualSystemCollection ovf:id="web">
+      <VirtualSystem ovf:id="web1"/>
+      <VirtualSystem ovf:id="web2"/>
+    </VirtualSystemCollection>
+  </VirtualSystemCollection>
+</Envelope>"""
+
+CONFIG_SYSTEM = """<VirtualSystem ovf:id="%s">
+      <Info>system</Info>
+      <VirtualHardwareSection>
+        <Info>hardware</Info>
+        <System>
+          <vssd:VirtualSystemType>kvm</vssd:VirtualSystemType>
+        </System>
+        %s
+        <Item><rasd:InstanceID>3</rasd:InstanceID>
+          <rasd:ResourceType>6</rasd:ResourceType></Item>
+        <Item><rasd:InstanceID>4</rasd:InstanceID>
+          <rasd:ResourceType>17</rasd:ResourceType>
+          <rasd:Parent>3</rasd:Parent>
+          <rasd:HostResource>ovf:/disk/%s</rasd:HostResource></Item>
+      </VirtualHardwareSection>
+    </VirtualSystem>"""
+
+CONFIG_MEMORY = """<Item%s><rasd:InstanceID>%d</rasd:InstanceID>
+          <rasd:ResourceType>4</rasd:ResourceType>
+          <rasd:AllocationUnits>byte * 2^20</rasd:AllocationUnits>
+          <rasd:VirtualQuantity>%d</rasd:VirtualQuantity></Item>"""
+
+CONFIG_OVF = """<?xml version="1.0" encoding="UTF-8"?>
+<Envelope xmlns="http://schemas.dmtf.org/ovf/envelope/1"
+  xmlns:ovf="http://schemas.dmtf.org/ovf/envelope/1"
+  xmlns:vssd="http://schemas.dmtf.org/wbem/wscim/1/cim-schema/2/CIM_VirtualSystemSettingData"
+  xmlns:rasd="http://schemas.dmtf.org/wbem/wscim/1/cim-schema/2/CIM_ResourceAllocationSettingData">
+  <References>
+    <File ovf:id="dbFile" ovf:href="db.img"/>
+    <File ovf:id="webFile" ovf:href="web.img"/>
+  </References>
+  <DiskSection>
+    <Info>disks</Info>
+    <Disk ovf:diskId="db" ovf:fileRef="dbFile" ovf:capacity="1048576"/>
+    <Disk ovf:diskId="web" ovf:fileRef="webFile" ovf:capacity="1048576"/>
+  </DiskSection>
+  <DeploymentOptionSection>
+    <Info>sizes</Info>
+    <Configuration ovf:id="small" ovf:default="true">
+      <Label>small</Label><Description>small</Description>
+    </Configuration>
+    <Configuration ovf:id="large">
+      <Label>large</Label><Description>large</Description>
+    </Configuration>
+  </DeploymentOptionSection>
+  <VirtualSystemCollection ovf:id="app">
+    <Info>app</Info>
+    %s
+    %s
+  </VirtualSystemCollection>
+</Envelope>
+""" % (CONFIG_SYSTEM % ('db',
+                       CONFIG_MEMORY % (' ovf:configuration="small"', 1, 256) +
+                       CONFIG_MEMORY % (' ovf:configuration="large"', 2, 1024),
+                       'db'),
+       CONFIG_SYSTEM % ('web', CONFIG_MEMORY % ('', 1, 512), 'web'))
+
 class OvfLibvirtTestCase(unittest.TestCase):
     def setUp(self):
         """Setup"""
@@ -126,6 +205,89 @@ class OvfLibvirtTestCase(unittest.TestCase):
 #        self.assertEqual(Ovf.xmlString(createBootloaderArgsBootElem('--append single')),
 #                         '<bootloader_args>--append single</bootloader_args>')
 
+    def test_getOvfMemory(self):
+        """Testing OvfLibvirt.getOvfMemory and getOvfCurrentMemory"""
+        template = ('<VirtualHardwareSection xmlns:rasd="urn:rasd">'
+                    '<Info>hw</Info><Item>'
+                    '<rasd:AllocationUnits>%s</rasd:AllocationUnits>'
+                    '<rasd:ResourceType>4</rasd:ResourceType>'
+                    '<rasd:VirtualQuantity>%s</rasd:VirtualQuantity>'
+                    '</Item></VirtualHardwareSection>')
+        for (units, quantity, memory) in (('byte * 2^20', '256', '262144'),
+                                          ('MegaBytes', '256', '262144'),
+                                          ('GigaBytes', '2', '2097152'),
+                                          ('bit * 2^33', '1', '1048576')):
+            section = parseString(template % (units, quantity))
+            section = section.documentElement
+            self.assertEqual(OvfLibvirt.getOvfMemory(section), memory)
+            self.assertEqual(OvfLibvirt.getOvfCurrentMemory(section), memory)
+
+        section = parseString(template % ('percent', '50')).documentElement
+        self.assertRaises(ValueError, OvfLibvirt.getOvfMemory, section)
+
+    def test_HardwareProfile(self):
+        """Testing OvfLibvirt.HardwareProfile"""
+        item = ('<Item%s><rasd:InstanceID>%s</rasd:InstanceID>'
+                '<rasd:ResourceType>%s</rasd:ResourceType>'
+                '<rasd:VirtualQuantity>%s</rasd:VirtualQuantity></Item>')
+        section = parseString('<VirtualHardwareSection xmlns:rasd="urn:rasd"'
+                              ' xmlns:ovf="urn:ovf"><Info>hw</Info>' +
+                              item % ('', '1', '3', '1') +
+                              item % (' ovf:configuration="big huge"', '2',
+                                      '3', '4') +
+                              item % ('', '03', '6', '') +
+                              item % ('', '4', '17', '') +
+                              '</VirtualHardwareSection>').documentElement
+
+        profile = OvfLibvirt.HardwareProfile(section)
+        self.assertEqual(len(profile.items), 4)
+        self.assertEqual(len(profile.getItems('3')), 2)
+        self.assertEqual([each['rasd:InstanceID'] for each in
+                          profile.getItems('17', '6')], ['03', '4'])
+        self.assertEqual(profile.getItem('3')['rasd:ResourceType'], '6')
+        self.assertEqual(profile.getItem('5'), None)
+        self.assertEqual(profile.getValue('3'), '4')
+        self.assertEqual(profile.getValue('4'), '')
+
+        # untagged Items apply to every configuration
+        profile = OvfLibvirt.HardwareProfile(section, 'small')
+        self.assertEqual(OvfLibvirt.getOvfVcpu(profile), '1')
+        self.assertEqual(OvfLibvirt.getOvfVcpu(section, 'huge'), '4')
+        self.assertTrue(OvfLibvirt.getHardwareProfile(profile) is profile)
+
+    def test_DiskIndex(self):
+        """Testing OvfLibvirt.DiskIndex"""
+        envelope = parseString('<Envelope xmlns:ovf="urn:ovf"><References>'
+                               '<File ovf:id="base" ovf:href="base.img"/>'
+                               '<File ovf:id="data" ovf:href="data.img"/>'
+                               '</References><DiskSection><Info>d</Info>'
+                               '<Disk ovf:diskId="os" ovf:fileRef="base"/>'
+                               '<Disk ovf:diskId="d1" ovf:fileRef="data"/>'
+                               '<Disk ovf:diskId="d2" ovf:fileRef="data"/>'
+                               '<Disk ovf:diskId="delta" ovf:fileRef="data"'
+                               ' ovf:parentRef="os"/>'
+                               '<Disk ovf:diskId="blank"/>'
+                               '</DiskSection></Envelope>')
+        index = OvfLibvirt.DiskIndex(
+            envelope.getElementsByTagName('References')[0],
+            envelope.getElementsByTagName('DiskSection')[0])
+
+        self.assertEqual(index.getHref('data'), 'data.img')
+        self.assertEqual(index.getDisk('os')['ovf:fileRef'], 'base')
+        self.assertEqual(index.getUsers('data'), ['d1', 'd2', 'delta'])
+        self.assertFalse(index.isShared('base'))
+        self.assertEqual(index.getSharedFiles(), ['data'])
+
+        self.assertEqual(index.getHostResources('ovf:/disk/os'),
+                         [('base', 'os', False)])
+        self.assertEqual(index.getHostResources('ovf://disk/d1'),
+                         [('data', 'd1', True)])
+        self.assertEqual(index.getHostResources('ovf:/disk/delta'),
+                         [('base', 'delta', True), ('data', 'delta', True)])
+        self.assertEqual(index.getHostResources('ovf:/disk/blank'), [])
+        self.assertEqual(index.getHostResources('ovf:/disk/none'), [])
+        self.assertTrue(OvfLibvirt.getDiskIndex(None, index) is index)
+
     def test_memoryElement(self):
         """Testing OvfLibvirt.memoryElement"""
         self.assertEqual(Ovf.xmlString(OvfLibvirt.memoryElement('262144')),
@@ -222,6 +384,238 @@ class OvfLibvirtTestCase(unittest.TestCase):
     def test_addDevice(self):
         """Testing OvfLibvirt.addDevice"""
 
+    def test_getOvfStartup(self):
+        """Testing OvfLibvirt.getOvfStartup"""
+        startup = OvfLibvirt.getOvfStartup(parseString(STARTUP_OVF))
+        self.assertEqual(startup['boot'], 'app')
+
+        entities = startup['entities']
+        self.assertEqual(entities['app']['systems'], ['db', 'web'])
+        self.assertEqual(entities['db'],
+                         {'ovf:order' : '1', 'ovf:startDelay' : '30',
+                          'ovf:waitingForGuest' : 'true',
+                          'ovf:stopAction' : 'guestShutdown',
+                          'ovf:stopDelay' : '20'})
+        # a collection keeps its members and its own Item attributes
+        self.assertEqual(entities['web']['systems'], ['web1', 'web2'])
+        self.assertEqual(entities['web']['ovf:order'], '2')
+        self.assertEqual(entities['web1'],
+                         {'ovf:order' : '0', 'ovf:startDelay' : '0'})
+
+    def test_DomainSpecCache(self):
+        """Testing OvfLibvirt.DomainSpecCache"""
+        ovf = parseString(CONFIG_OVF)
+        directory = tempfile.mkdtemp()
+        try:
+            cache = OvfLibvirt.DomainSpecCache(os.path.join(directory, 'c'))
+            small = cache.getSpecs(ovf)
+            self.assertEqual(small['configuration'], 'small')
+            self.assertEqual(small['configurable'], ['db'])
+            self.assertEqual(small['specs']['db']['memory'], '262144')
+            self.assertEqual(small['specs']['db']['disks'][0]['file'],
+                             'db.img')
+
+            # only the VirtualSystem that depends on it is compiled again
+            large = cache.getSpecs(ovf, configId='large')
+            self.assertEqual(large['specs']['db']['memory'], '1048576')
+            self.assert_(large['specs']['web'] is small['specs']['web'])
+            self.assertEqual((cache.hits, cache.misses), (0, 2))
+            self.assert_(cache.getSpecs(ovf) is small)
+            self.assertEqual(cache.hits, 1)
+            self.assertRaises(RuntimeError, cache.getSpecs, ovf,
+                              configId='huge')
+
+            # another process finds the entries, and boots the same domains
+            cache = OvfLibvirt.DomainSpecCache(os.path.join(directory, 'c'))
+            for configId in ('small', 'large'):
+                domains = OvfLibvirt.getOvfDomains(ovf, directory,
+                                                   configId=configId,
+                                                   cache=cache)
+                self.assertEqual(domains,
+                                 OvfLibvirt.getOvfDomains(ovf, directory,
+                                                          configId=configId))
+            self.assertEqual((cache.hits, cache.misses), (2, 0))
+            self.assert_(os.path.join(directory, 'db.img') in domains['db'])
+
+            # a changed document is another entry
+            ovf.documentElement.setAttribute('xml:lang', 'en')
+            cache.getSpecs(ovf, configId='small')
+            self.assertEqual(cache.misses, 1)
+        finally:
+            shutil.rmtree(directory)
+
+        # only the entries used last are kept in memory
+        cache = OvfLibvirt.DomainSpecCache(maxEntries=2)
+        small = cache.getSpecs(ovf, configId='small')
+        cache.getSpecs(ovf, configId='large')
+        self.assert_(cache.getSpecs(ovf, configId='small') is small)
+        cache.getSpecs(ovf, 'kvm', 'small')
+        self.assertEqual(len(cache.entries), 2)
+        self.assertEqual((cache.hits, cache.misses), (1, 3))
+        cache.getSpecs(ovf, configId='large')
+        self.assertEqual((cache.hits, cache.misses), (1, 4))
+
+    def test_renderDomain(self):
+        """Testing OvfLibvirt.renderDomain"""
+        spec = dict(name=u'web & <db>', domainType='kvm',
+                    uuid='3e3fce45-4f53-4fa7-bb32-11f34168b82b',
+                    boot=OvfLibvirt.getBootDict('kvm'),
+                    memory='524288', vcpu='2', clock='utc',
+                    features=dict(acpi=True, pae=True),
+                    onPowerOff='destroy', onReboot='restart',
+                    onCrash='destroy',
+                    graphics=dict(graphicsType='vnc', listen='localhost',
+                                  port='-1'),
+                    console=dict(deviceType='pty', port='0'),
+                    disks=[dict(diskType='file', diskDevice='disk',
+                                sourceFile='/images/a "b".qcow2',
+                                targetBus='scsi', targetDev='hda',
+                                readonly=False, driverName='qemu',
+                                driverType='qcow2'),
+                           dict(diskType='file', diskDevice='cdrom',
+                                sourceFile='/env/web.iso', targetBus='ide',
+                                targetDev='hdc:cdrom', readonly=True)],
+                    networks=[dict(interfaceType='network',
+                                   sourceName='default'),
+                              dict(interfaceType='bridge', sourceName='br0',
+                                   macAddress='52:54:00:00:00:01'),
+                              dict(interfaceType='user'),
+                              dict(interfaceType='mcast',
+                                   sourceAddress='230.0.0.1',
+                                   sourcePort='5558')])
+
+        xml = OvfLibvirt.renderDomain(spec)
+        self.assertEqual(xml,
+                         Ovf.xmlString(OvfLibvirt.renderDomainDocument(spec)))
+        self.assert_('<name>web &amp; &lt;db&gt;</name>' in xml)
+        self.assert_('file="/images/a &quot;b&quot;.qcow2"' in xml)
+        self.assertEqual(parseString(xml.encode('UTF-8')).documentElement.
+                         getAttribute('type'), 'kvm')
+
+        for boot in (OvfLibvirt.getBootDict('xenpv'),
+                     dict(type='linux', kernel='/boot/vmlinuz',
+                          initrd='/boot/initrd', cmdline='ro quiet',
+                          arch='x86_64')):
+            spec['boot'] = boot
+            spec['features'] = {}
+            self.assertEqual(OvfLibvirt.renderDomain(spec),
+                Ovf.xmlString(OvfLibvirt.renderDomainDocument(spec)))
+
+        spec['networks'] = [dict(interfaceType='bogus')]
+        self.assertRaises(ValueError, OvfLibvirt.renderDomain, spec)
+
+    def test_startDomain(self):
+        """Testing OvfLibvirt.startDomain and ConnectionPool"""
+        domainXml = OvfLibvirt.DomainXml(u'<domain type="kvm"/>', 'kvm')
+        self.assertEqual(domainXml, '<domain type="kvm"/>')
+        self.assertEqual(OvfLibvirt.getDomainType(domainXml), 'kvm')
+        self.assertEqual(OvfLibvirt.getDomainType('<domain type="xen"/>'),
+                         'xen')
+
+        # copies and pickles keep the domain type
+        for other in [copy.copy(domainXml), copy.deepcopy(domainXml)] + \
+                     [pickle.loads(pickle.dumps(domainXml, protocol))
+                      for protocol in range(3)]:
+            self.assertEqual(other, domainXml)
+            self.assertEqual(other.domainType, 'kvm')
+
+        del fakelibvirt.connections[:]
+        pool = OvfLibvirt.ConnectionPool(fakelibvirt.open)
+        first = OvfLibvirt.startDomain(domainXml, pool)
+        second = OvfLibvirt.startDomain(domainXml, pool)
+        OvfLibvirt.startDomain('<domain type="xen"/>', pool)
+
+        # one connection per connection string
+        self.assertEqual([conn.uri for conn in fakelibvirt.connections],
+                         ['qemu:///system', 'xen:///'])
+        self.assert_(first.conn is second.conn)
+        self.assertEqual(first.xml, domainXml)
+
+        # dead connections are opened again, close() closes all
+        first.conn.close()
+        third = OvfLibvirt.startDomain(domainXml, pool)
+        self.failIf(third.conn is first.conn)
+        self.assertEqual(len(fakelibvirt.connections), 3)
+        pool.close()
+        self.assertEqual(pool.connections, {})
+        self.failIf(third.conn.isAlive())
+
+    def test_BootScheduler(self):
+        """Testing OvfLibvirt.BootScheduler"""
+        startup = OvfLibvirt.getOvfStartup(parseString(STARTUP_OVF))
+        domains = dict(db='<db/>', web1='<web1/>', web2='<web2/>')
+
+        events = []
+        sleeps = []
+        together = threading.Event()
+        def start(domainXml):
+            events.append(('start', domainXml))
+            if domainXml == '<web1/>':
+                together.wait(5)
+            elif domainXml == '<web2/>':
+                together.set()
+            return domainXml
+        def stop(domain, stopAction):
+            events.append((stopAction, domain))
+        ready = []
+        def guestReady(domain):
+            ready.append(domain)
+            return len(ready) > 1
+
+        scheduler = OvfLibvirt.BootScheduler(startup, domains,
+                                             guestReady=guestReady,
+                                             startAction=start,
+                                             stopAction=stop,
+                                             sleep=sleeps.append)
+        self.assertEqual(scheduler.getWaves(), [['db'], ['web']])
+        self.assertEqual(scheduler.getWaves('web'), [['web1', 'web2']])
+        self.assertEqual(scheduler.getWaves('db'), [['db']])
+        # db waits its whole startDelay, web's delay follows its members
+        self.assertEqual(scheduler.getTimeline(),
+                         ({'db' : 0, 'web1' : 30, 'web2' : 30}, 35))
+        self.assertEqual(scheduler.getTimeline('web'),
+                         ({'web1' : 0, 'web2' : 0}, 5))
+        self.assertEqual(events, [])
+
+        latencies = scheduler.start()
+        self.assertEqual(sorted(latencies.keys()), ['db', 'web1', 'web2'])
+        # web1 and web2 started concurrently, after db was ready
+        self.assert_(together.isSet())
+        self.assert_(latencies['web1'] < 5)
+        self.assertEqual(events[0], ('start', '<db/>'))
+        self.assertEqual(ready, ['<db/>', '<db/>'])
+        self.assertEqual(sleeps, [1, 5])
+
+        del events[:]
+        del sleeps[:]
+        scheduler.stop()
+        self.assertEqual(sorted(events[:2]),
+                         [('powerOff', '<web1/>'), ('powerOff', '<web2/>')])
+        self.assertEqual(events[2], ('guestShutdown', '<db/>'))
+        self.assertEqual(sleeps, [20])
+        self.assertEqual(scheduler.started, {})
+
+        # a failed wave stops the startup
+        def failing(domainXml):
+            if domainXml == '<db/>':
+                raise RuntimeError(domainXml)
+            return domainXml
+        scheduler = OvfLibvirt.BootScheduler(startup, domains,
+                                             startAction=failing,
+                                             sleep=sleeps.append)
+        self.assertRaises(RuntimeError, scheduler.start)
+        self.assertEqual(scheduler.started, {})
+
+        # an entity with startAction none is left alone
+        startup['entities']['web2']['ovf:startAction'] = 'none'
+        scheduler = OvfLibvirt.BootScheduler(startup, domains,
+                                             startAction=start,
+                                             sleep=sleeps.append)
+        self.assertEqual(scheduler.getTimeline('web'), ({'web1' : 0}, 5))
+        self.assertEqual(sorted(scheduler.start().keys()), ['db', 'web1'])
+        startup['entities']['web']['ovf:startAction'] = 'none'
+        self.assertEqual(scheduler.getTimeline(), ({'db' : 0}, 30))
+
 
 if __name__ == "__main__":
     libvirtSuite = unittest.TestLoader().loadTestsFromTestCase(OvfLibvirtTestCase)
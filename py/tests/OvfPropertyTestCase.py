@@ -15,6 +15,7 @@ Test case for functions in OvfProperty.py
 """
 
 import unittest, os
+from xml.dom.minidom import parseString
 
 from ovf import Ovf
 from ovf.OvfFile import OvfFile
@@ -166,6 +167,101 @@ class OvfPropertyTestCase(unittest.TestCase):
             assert value == propertiesMaxConfig[propOffset][1], "value mismatch"
             propOffset = propOffset + 1
 
+    def test_PropertyResolver(self):
+        """
+        Test OvfProperty.PropertyResolver
+        """
+        ovfFile = OvfFile(self.path + "/" + self.ovf)
+        vsNode = Ovf.getNodes(ovfFile.envelope,
+                              (Ovf.hasTagName, 'VirtualSystem'),
+                              (Ovf.hasAttribute, 'ovf:id', 'MyLampService'))[0]
+
+        resolver = OvfProperty.PropertyResolver(ovfFile.document)
+        assert resolver.configuration == \
+               Ovf.getDefaultConfiguration(ovfFile.document), \
+               "default configuration mismatch"
+        properties = resolver.getProperties(vsNode)
+        assert list(properties) == \
+               OvfProperty.getPropertiesForNode(vsNode, None), \
+               "properties mismatch"
+        assert resolver.getProperties(vsNode) is properties, "not cached"
+
+        propertyMap = resolver.getPropertyMap(vsNode)
+        assert propertyMap['org.apache.httpd.startThreads'] == '50', \
+               "default configuration value mismatch"
+        assert propertyMap['org.linuxdistx.hostname'] == None, \
+               "no default mismatch"
+        assert propertyMap['org.apache.httpd.httpPort'] == '80', \
+               "attribute value mismatch"
+
+        resolver = OvfProperty.PropertyResolver(ovfFile.document, 'Minimal')
+        propertyMap = resolver.getPropertyMap(vsNode)
+        assert propertyMap['org.apache.httpd.startThreads'] == '10', \
+               "configuration value mismatch"
+        assert len(propertyMap) == 18, "property count mismatch"
+
+        propertyMap = resolver.getPropertyMap(vsNode,
+                          {'org.apache.httpd.httpPort' : '8080',
+                           'other.key' : 'ignored'})
+        assert propertyMap['org.apache.httpd.httpPort'] == '8080', \
+               "override mismatch"
+        assert not propertyMap.has_key('other.key'), "foreign key kept"
+
+    def test_getValidator(self):
+        """
+        Test OvfProperty.getValidator
+        """
+        def validator(attributes):
+            document = parseString('<Property xmlns:ovf="urn:ovf" ' +
+                                   'ovf:key="k" ' + attributes + '/>')
+            return OvfProperty.getValidator(document.documentElement)
+
+        validate = validator('ovf:type="uint8"')
+        validate('0')
+        validate('255')
+        self.assertRaises(ValueError, validate, '256')
+        self.assertRaises(ValueError, validate, '-1')
+        self.assertRaises(ValueError, validate, 'ten')
+
+        validate = validator('ovf:type="sint64"')
+        validate(str(-2 ** 63))
+        self.assertRaises(ValueError, validate, str(2 ** 63))
+
+        validate = validator('ovf:type="real64"')
+        validate('1.5e3')
+        self.assertRaises(ValueError, validate, '1,5')
+
+        validate = validator('ovf:type="boolean"')
+        validate('true')
+        self.assertRaises(ValueError, validate, 'yes')
+
+        validate = validator('ovf:type="string" ' +
+                             'ovf:qualifiers="MinLen(2),MaxLen(4)"')
+        validate('abcd')
+        self.assertRaises(ValueError, validate, 'a')
+        self.assertRaises(ValueError, validate, 'abcde')
+
+        validate = validator('ovf:type="uint16" ' +
+                             'ovf:qualifiers=\'ValueMap{"0", "10..20", "100.."}\'')
+        for value in ('0', '10', '15', '20', '100', '65535'):
+            validate(value)
+        for value in ('1', '21', '99'):
+            self.assertRaises(ValueError, validate, value)
+
+        validate = validator('ovf:qualifiers=\'ValueMap{"small","large"}\'')
+        validate('large')
+        try:
+            validate('huge')
+        except ValueError, e:
+            assert str(e).startswith("Property k: invalid value 'huge'"), \
+                   "message mismatch"
+        else:
+            self.fail("huge is not in the ValueMap")
+
+        # unknown types take any value
+        validator('ovf:type="int"')('anything')
+        self.assertRaises(ValueError, validator, 'ovf:qualifiers="MaxLen(x)"')
+
 if __name__ == "__main__":
     TEST = unittest.TestLoader().loadTestsFromTestCase(OvfPropertyTestCase)
     RUNNER = unittest.TextTestRunner(verbosity=2)
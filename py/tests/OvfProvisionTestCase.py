@@ -0,0 +1,145 @@
+#!/usr/bin/python
+# vi: ts=4 expandtab syntax=python
+##############################################################################
+# Copyright (c) 2008 IBM Corporation
+# All rights reserved. This program and the accompanying materials
+# are made available under the terms of the Eclipse Public License v1.0
+# which accompanies this distribution, and is available at
+# http://www.eclipse.org/legal/epl-v10.html
+#
+##############################################################################
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+from ovf import OvfProvision
+
+class OvfProvisionTestCase(unittest.TestCase):
+    def setUp(self):
+        """Setup"""
+        self.dir = tempfile.mkdtemp()
+        self.image = os.path.join(self.dir, 'base.img')
+        fileObj = open(self.image, 'wb')
+        fileObj.write('\x55' * 4096)
+        fileObj.truncate(3 * 1024 * 1024)
+        fileObj.close()
+
+    def tearDown(self):
+        """tearDown"""
+        shutil.rmtree(self.dir)
+
+    def test_getImageInfo(self):
+        """Testing OvfProvision.getImageInfo"""
+        self.assertEqual(OvfProvision.getImageInfo(self.image),
+                         ('raw', 3 * 1024 * 1024))
+
+        vmdk = os.path.join(self.dir, 'disk.vmdk')
+        fileObj = open(vmdk, 'wb')
+        fileObj.write('KDMV' + struct.pack('<IIQ', 1, 3, 2048))
+        fileObj.close()
+        self.assertEqual(OvfProvision.getImageInfo(vmdk), ('vmdk', 1048576))
+
+        overlay = os.path.join(self.dir, 'overlay.qcow2')
+        OvfProvision.createOverlay(self.image, overlay, size=5 << 30)
+        self.assertEqual(OvfProvision.getImageInfo(overlay),
+                         ('qcow2', 5 << 30))
+
+    def test_createOverlay(self):
+        """Testing OvfProvision.createOverlay"""
+        overlay = os.path.join(self.dir, 'base-disk1.qcow2')
+        OvfProvision.createOverlay(self.image, overlay)
+
+        fileObj = open(overlay, 'rb')
+        data = fileObj.read()
+        fileObj.close()
+
+        (magic, version, backingOffset, backingSize, clusterBits, size,
+         crypt, l1Size, l1Offset, refcountOffset, refcountClusters,
+         snapshots, snapshotsOffset) = struct.unpack('>4sIQIIQIIQQIIQ',
+                                                      data[:72])
+        self.assertEqual((magic, version, clusterBits, crypt, snapshots),
+                         ('QFI\xfb', 2, 16, 0, 0))
+        self.assertEqual(size, 3 * 1024 * 1024)
+        self.assertEqual(l1Size, 1)
+        self.assertEqual((refcountOffset, refcountClusters, l1Offset),
+                         (65536, 1, 3 * 65536))
+        self.assertEqual(len(data), 4 * 65536)
+
+        # backing file is relative, its format is in a header extension
+        self.assertEqual(data[backingOffset:backingOffset + backingSize],
+                         'base.img')
+        self.assertEqual(struct.unpack('>II', data[72:80]),
+                         (OvfProvision.QCOW2_EXT_BACKING_FORMAT, 3))
+        self.assertEqual(data[80:83], 'raw')
+
+        # refcount table points to the block, which covers all clusters
+        self.assertEqual(struct.unpack('>Q', data[65536:65544])[0], 131072)
+        self.assertEqual(struct.unpack('>5H', data[131072:131082]),
+                         (1, 1, 1, 1, 0))
+        # nothing allocated
+        self.assertEqual(data[196608:], '\0' * 65536)
+
+        # backing file in another directory is absolute
+        other = tempfile.mkdtemp()
+        try:
+            overlay = os.path.join(other, 'overlay.qcow2')
+            OvfProvision.createOverlay(self.image, overlay,
+                                       backingFormat='raw')
+            fileObj = open(overlay, 'rb')
+            data = fileObj.read()
+            fileObj.close()
+            (backingOffset, backingSize) = struct.unpack('>QI', data[8:20])
+            self.assertEqual(data[backingOffset:backingOffset + backingSize],
+                             os.path.abspath(self.image))
+        finally:
+            shutil.rmtree(other)
+
+        # a large image needs more than one L1 entry
+        overlay = os.path.join(self.dir, 'large.qcow2')
+        OvfProvision.createOverlay(self.image, overlay, size=(1 << 40))
+        fileObj = open(overlay, 'rb')
+        self.assertEqual(struct.unpack('>I', fileObj.read(40)[36:40])[0],
+                         (1 << 40) / (65536 * 8192))
+        fileObj.close()
+
+    def test_getStrategies(self):
+        """Testing OvfProvision.getStrategies"""
+        self.assertEqual(OvfProvision.getStrategies('kvm'),
+                         ('overlay', 'reflink', 'copy'))
+        self.assertEqual(OvfProvision.getStrategies('xen'),
+                         ('reflink', 'copy'))
+
+    def test_provisionDisk(self):
+        """Testing OvfProvision.provisionDisk"""
+        target = os.path.join(self.dir, 'base-disk1.img')
+
+        self.assertEqual(OvfProvision.provisionDisk(self.image, target),
+                         (os.path.join(self.dir, 'base-disk1.qcow2'),
+                          'overlay'))
+
+        # reflink may not be supported here, copy always is
+        (path, strategy) = OvfProvision.provisionDisk(self.image, target,
+                                                      ('reflink', 'copy'))
+        self.assertEqual(path, target)
+        self.assert_(strategy in ('reflink', 'copy'))
+        self.assertEqual(open(path, 'rb').read(), open(self.image, 'rb').read())
+
+        # the original is never removed
+        self.assert_(os.path.isfile(self.image))
+
+        # failures fall through to the next strategy, and clean up
+        missing = os.path.join(self.dir, 'missing.img')
+        self.assertRaises(IOError, OvfProvision.provisionDisk, missing,
+                          target + '.new')
+        self.failIf(os.path.exists(target + '.new'))
+        self.failIf(os.path.exists(os.path.join(self.dir,
+                                                'base-disk1.img.qcow2')))
+        self.assertRaises(ValueError, OvfProvision.provisionDisk, self.image,
+                          target, ('bogus',))
+
+if __name__ == "__main__":
+    test = unittest.TestLoader().loadTestsFromTestCase(OvfProvisionTestCase)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(unittest.TestSuite(test))
@@ -11,11 +11,13 @@
 # Eric Casler (IBM) - initial implementation
 ##############################################################################
 
+from ovf import OvfLibvirt
 from ovf import OvfFile
 from ovf import OvfSet
+from ovf import OvfTransport
 from ovf import OvfReferencedFile
-from xml.dom.minidom import parse
-import tempfile, os, shutil, unittest, tarfile, sys
+from xml.dom.minidom import parse, parseString
+import tempfile, os, shutil, subprocess, unittest, tarfile, sys
 import testUtils
 
 TEST_FILES_DIR = os.path.join(os.path.dirname(__file__), "test_files/")
@@ -79,6 +81,21 @@ class SimpleTestCase(unittest.TestCase):
         self.assertFalse(self.ovfSetObject.verifyManifest(self.path + 'ourOVF.mf'))
         self.assertRaises(IOError, self.ovfSetObject.verifyManifest, '!')
 
+    def test_lazyImports(self):
+        """Testing that the libvirt, libxml2 and transport code load lazily"""
+        code = ('import sys\n'
+                'from ovf import OvfSet, OvfFile, OvfPlatform, validation\n'
+                'from ovf.env import EnvironmentSection\n'
+                'print " ".join([name for name in ("libxml2", "libvirt", '
+                '"ovf.OvfLibvirt", "ovf.OvfTransport", "ovf.OvfCertificate") '
+                'if name in sys.modules])\n')
+        environ = os.environ.copy()
+        environ['PYTHONPATH'] = os.pathsep.join(sys.path)
+        process = subprocess.Popen([sys.executable, '-c', code],
+                                   stdout=subprocess.PIPE, env=environ)
+        self.assertEqual(process.communicate()[0].split(), [])
+        self.assertEqual(process.returncode, 0)
+
 class WriteTestCase(unittest.TestCase):
     def setUp(self):
         # Create OvfSet Object
@@ -191,8 +208,299 @@ class WriteTestCase(unittest.TestCase):
 #        self.assertEqual(os.path.isdir(tempPath), True)
 #        os.rmdir(tempPath)
 
+DEPLOY_OVF = """<?xml version="1.0" encoding="UTF-8"?>
+<Envelope xmlns="http://schemas.dmtf.org/ovf/envelope/1"
+  xmlns:ovf="http://schemas.dmtf.org/ovf/envelope/1"
+  xmlns:rasd="http://schemas.dmtf.org/wbem/wscim/1/cim-schema/2/CIM_ResourceAllocationSettingData">
+  <References>
+    <File ovf:id="base" ovf:href="base.img"/>
+  </References>
+  <DiskSection>
+    <Info>disks</Info>
+    <Disk ovf:diskId="db" ovf:fileRef="base" ovf:capacity="1048576"/>
+    <Disk ovf:diskId="web" ovf:fileRef="base" ovf:capacity="1048576"/>
+  </DiskSection>
+  <VirtualSystemCollection ovf:id="app">
+    <Info>app</Info>
+    <StartupSection>
+      <Info>db first</Info>
+      <Item ovf:id="db" ovf:order="1"/>
+      <Item ovf:id="web" ovf:order="2"/>
+    </StartupSection>
+    %s
+  </VirtualSystemCollection>
+</Envelope>
+"""
+
+DEPLOY_SYSTEM = """<VirtualSystem ovf:id="%s">
+      <Info>system</Info>
+      <VirtualHardwareSection>
+        <Info>hardware</Info>
+        <Item><rasd:InstanceID>1</rasd:InstanceID>
+          <rasd:ResourceType>4</rasd:ResourceType>
+          <rasd:AllocationUnits>byte * 2^20</rasd:AllocationUnits>
+          <rasd:VirtualQuantity>256</rasd:VirtualQuantity></Item>
+        <Item><rasd:InstanceID>2</rasd:InstanceID>
+          <rasd:ResourceType>3</rasd:ResourceType>
+          <rasd:VirtualQuantity>1</rasd:VirtualQuantity></Item>
+        <Item><rasd:InstanceID>3</rasd:InstanceID>
+          <rasd:ResourceType>6</rasd:ResourceType></Item>
+        <Item><rasd:InstanceID>4</rasd:InstanceID>
+          <rasd:ResourceType>17</rasd:ResourceType>
+          <rasd:Parent>3</rasd:Parent>
+          <rasd:HostResource>ovf:/disk/%s</rasd:HostResource></Item>
+        <Item><rasd:InstanceID>5</rasd:InstanceID>
+          <rasd:ResourceType>10</rasd:ResourceType>
+          <rasd:Connection>default</rasd:Connection></Item>
+      </VirtualHardwareSection>
+    </VirtualSystem>"""
+
+class DeployTestCase(unittest.TestCase):
+    def setUp(self):
+        """Setup"""
+        self.dir = tempfile.mkdtemp()
+        self.image = os.path.join(self.dir, 'base.img')
+        image = open(self.image, 'wb')
+        image.write('\0' * 65536)
+        image.close()
+        systems = DEPLOY_SYSTEM % ('db', 'db') + DEPLOY_SYSTEM % ('web', 'web')
+        ovfFile = open(os.path.join(self.dir, 'app.ovf'), 'w')
+        ovfFile.write(DEPLOY_OVF % systems)
+        ovfFile.close()
+        self.ovfSet = OvfSet.OvfSet(os.path.join(self.dir, 'app.ovf'))
+
+    def tearDown(self):
+        """tearDown"""
+        self.ovfSet = None
+        shutil.rmtree(self.dir)
+
+    def test_deployMany(self):
+        """Testing OvfSet.deployMany"""
+        started = []
+        def start(domainXml):
+            started.append(domainXml)
+            return domainXml
+        reports = []
+        def progress(instance, done, count):
+            reports.append((done, count))
+
+        instances = self.ovfSet.deployMany(5, parallel=3, virtPlatform='kvm',
+                                           progress=progress,
+                                           startAction=start)
+
+        self.assertEqual([instance['index'] for instance in instances],
+                         range(5))
+        self.assertEqual(sorted(reports), [(done, 5) for done in range(1, 6)])
+        self.assertEqual(len(started), 10)
+
+        names = {}
+        uuids = {}
+        macs = {}
+        for instance in instances:
+            self.assertEqual(instance['error'], None)
+            self.assertEqual(sorted(instance['latencies'].keys()),
+                             ['db', 'web'])
+            self.assertEqual(len(instance['images']), 2)
+            for (ovfId, xml) in instance['domains'].items():
+                domain = parseString(xml.encode('UTF-8')).documentElement
+                name = domain.getElementsByTagName('name')[0].firstChild.data
+                self.assertEqual(name, '%s-%d' % (ovfId, instance['index']))
+                names[name] = True
+                uuids[domain.getElementsByTagName('uuid')[0].firstChild.data] = True
+                macs[domain.getElementsByTagName('mac')[0].getAttribute('address')] = True
+
+                # each domain writes to its own overlay of the shared image
+                source = domain.getElementsByTagName('source')[0]
+                path = source.getAttribute('file')
+                self.assertEqual(path, os.path.join(self.dir,
+                                                    name + '-base.qcow2'))
+                self.assert_(path in instance['images'])
+                self.assertEqual(domain.getElementsByTagName('driver')[0].
+                                 getAttribute('type'), 'qcow2')
+        self.assertEqual((len(names), len(uuids), len(macs)), (10, 10, 10))
+
+        # the package is unchanged and can be deployed again
+        self.assertEqual(open(self.image, 'rb').read(), '\0' * 65536)
+        instances = self.ovfSet.deployMany(2, naming='again-%(id)s-%(index)d',
+                                           overlays=False, start=False,
+                                           virtPlatform='kvm')
+        self.assertEqual(len(started), 10)
+        self.assertEqual(instances[1]['images'][0],
+                         os.path.join(self.dir, 'again-' +
+                                      instances[1]['domains'].keys()[0] +
+                                      '-1-base.img'))
+
+        self.assertRaises(ValueError, self.ovfSet.deployMany, 2,
+                          naming='%(id)s', virtPlatform='kvm')
+
+        # a failing instance does not stop the others
+        def failing(domainXml):
+            if 'b-1<' in domainXml:
+                raise RuntimeError('no room')
+            return domainXml
+        instances = self.ovfSet.deployMany(3, naming=lambda ovfId, index:
+                                               '%s%s-%d' % (ovfId[0], ovfId[-1], index),
+                                           virtPlatform='kvm',
+                                           startAction=failing)
+        self.assertEqual([instance['error'] == None for instance in instances],
+                         [True, False, True])
+
+    def test_deployManyCache(self):
+        """Testing OvfSet.deployMany with a DomainSpecCache"""
+        cache = OvfLibvirt.DomainSpecCache()
+        self.ovfSet.deployMany(1, start=False, virtPlatform='kvm', cache=cache)
+        self.ovfSet.deployMany(1, start=False, virtPlatform='kvm', cache=cache)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        # a change made through the DOM is not served from the cache
+        document = self.ovfSet.getOvfFile().document
+        quantity = document.getElementsByTagName('rasd:VirtualQuantity')[0]
+        quantity.firstChild.data = '512'
+        instances = self.ovfSet.deployMany(1, start=False, virtPlatform='kvm',
+                                           cache=cache)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+        memory = parseString(instances[0]['domains']['db'].encode('UTF-8')).\
+                 getElementsByTagName('memory')[0].firstChild.data
+        self.assertEqual(memory, str(512 * 1024))
+
+    def test_deployManyTransport(self):
+        """Testing OvfSet.deployMany with environments put on isos"""
+        envDir = os.path.join(self.dir, 'env')
+        os.mkdir(envDir)
+        envFile = open(os.path.join(envDir, 'db.xml'), 'w')
+        envFile.write('<Environment/>')
+        envFile.close()
+
+        builder = OvfTransport.TransportBuilder(os.path.join(self.dir, 'cache'))
+        for run in range(2):
+            instances = self.ovfSet.deployMany(1, start=False,
+                                               virtPlatform='kvm',
+                                               envDirectory=envDir,
+                                               transport=builder)
+        self.assertEqual((builder.hits, builder.misses), (1, 1))
+        self.assertEqual(os.listdir(envDir), ['db.xml'])
+
+        isoFile = os.path.join(self.dir, 'db-env.iso')
+        domain = parseString(instances[0]['domains']['db'].encode('UTF-8'))
+        sources = [source.getAttribute('file') for source in
+                   domain.getElementsByTagName('source')]
+        self.assert_(isoFile in sources)
+
+        # a changed environment is put on a new iso
+        envFile = open(os.path.join(envDir, 'db.xml'), 'w')
+        envFile.write('<Environment ovfenv:id="db"/>')
+        envFile.close()
+        self.assertEqual(self.ovfSet.makeEnvironmentIsos(envDir, self.dir,
+                                                         builder),
+                         {'db' : isoFile})
+        self.assertEqual((builder.hits, builder.misses), (1, 2))
+
+        # an iso in the directory is used as it is
+        envFile = open(os.path.join(envDir, 'db.iso'), 'wb')
+        envFile.write('iso')
+        envFile.close()
+        self.assertEqual(self.ovfSet.makeEnvironmentIsos(envDir, self.dir,
+                                                         builder), {})
+        instances = self.ovfSet.deployMany(1, start=False, virtPlatform='kvm',
+                                           envDirectory=envDir,
+                                           transport=builder)
+        self.assert_(os.path.join(envDir, 'db.iso') in
+                     instances[0]['domains']['db'])
+        self.assertEqual(open(os.path.join(envDir, 'db.iso'), 'rb').read(),
+                         'iso')
+
+    def test_getOvfDomainSpecs(self):
+        """Testing OvfLibvirt.getOvfDomainSpecs with workers"""
+        ovf = self.ovfSet.getOvfFile().document
+        images = [os.path.join(self.dir, 'base-db.img'),
+                  os.path.join(self.dir, 'base-web.img')]
+
+        serial = OvfLibvirt.getOvfDomainSpecs(ovf, self.dir, 'kvm',
+                                              strategies=('copy',))
+        parallel = OvfLibvirt.getOvfDomainSpecs(ovf, self.dir, 'kvm',
+                                                strategies=('copy',),
+                                                workers=4)
+        self.assertEqual(parallel, serial)
+        self.assertEqual([parallel[ovfId]['disks'][0]['sourceFile']
+                          for ovfId in ('db', 'web')], images)
+        for image in images:
+            self.assertEqual(open(image, 'rb').read(), '\0' * 65536)
+            os.remove(image)
+
+        # a failing system cancels the others and leaves no images
+        os.symlink(os.path.join(self.dir, 'missing', 'web.img'), images[1])
+        for workers in (1, 2):
+            self.assertRaises(EnvironmentError, OvfLibvirt.getOvfDomainSpecs,
+                              ovf, self.dir, 'kvm', strategies=('copy',),
+                              workers=workers)
+            self.failIf(os.path.exists(images[0]))
+        self.assert_(os.path.isfile(self.image))
+
+    def test_plan(self):
+        """Testing OvfSet.plan"""
+        before = os.listdir(self.dir)
+        plan = self.ovfSet.plan('kvm', installLoc=self.dir)
+        self.assertEqual(os.listdir(self.dir), before)
+
+        self.assertEqual(plan['name'], 'app')
+        self.assertEqual(plan['copyBytes'],
+                         65536 + os.path.getsize(os.path.join(self.dir,
+                                                              'app.ovf')))
+        self.assertEqual((plan['start'], plan['seconds']),
+                         ({'db' : 0, 'web' : 0}, 0))
+
+        self.assertEqual(len(plan['configurations']), 1)
+        config = plan['configurations'][0]
+        self.assertEqual(config['configuration'], None)
+        self.assertEqual(sorted(config['systems'].keys()), ['db', 'web'])
+        self.assertEqual((config['memory'], config['vcpu']),
+                         (2 * 256 * 1024 * 1024, 2))
+        self.assertEqual(config['missing'], [])
+
+        # the shared image gets an overlay for each system
+        db = config['systems']['db']
+        self.assertEqual((db['domainType'], db['memory'], db['vcpu']),
+                         ('kvm', 256 * 1024 * 1024, 1))
+        self.assertEqual(db['disks'],
+                         [dict(diskId='db', file='base.img', bytes=65536,
+                               shared=True, strategy='overlay',
+                               bytesWritten=4 * 65536,
+                               worstCaseBytes=65536)])
+        self.assertEqual((config['bytesWritten'], config['worstCaseBytes']),
+                         (8 * 65536, 2 * 65536))
+
+        # xen cannot use overlays, a missing image is listed
+        os.remove(self.image)
+        config = self.ovfSet.plan('xen')['configurations'][0]
+        self.assertEqual(config['missing'], ['base.img'])
+        self.assertEqual(config['systems']['web']['disks'][0]['strategy'],
+                         'reflink')
+        self.assertEqual(config['systems']['web']['disks'][0]['bytes'], None)
+        self.assertEqual(config['worstCaseBytes'], 0)
+
+    def test_planArchive(self):
+        """Testing OvfSet.planArchive"""
+        archive = os.path.join(self.dir, 'app.ova')
+        tar = tarfile.open(archive, 'w')
+        for name in ('app.ovf', 'base.img'):
+            tar.add(os.path.join(self.dir, name), name)
+        tar.close()
+        expected = self.ovfSet.plan('kvm', installLoc=self.dir)
+
+        # nothing is extracted
+        before = os.listdir(self.dir)
+        plan = OvfSet.planArchive(archive, 'kvm', installLoc=self.dir)
+        self.assertEqual(os.listdir(self.dir), before)
+        self.assertEqual(plan, expected)
+
+        plan = OvfSet.planArchive(archive, 'kvm')
+        self.assertEqual(plan['copyBytes'], 0)
+        self.assertEqual(plan['configurations'],
+                         expected['configurations'])
+
 if __name__ == "__main__":
     simple = unittest.TestLoader().loadTestsFromTestCase(SimpleTestCase)
     write = unittest.TestLoader().loadTestsFromTestCase(WriteTestCase)
+    deploy = unittest.TestLoader().loadTestsFromTestCase(DeployTestCase)
     runner = unittest.TextTestRunner(verbosity=2)
-    runner.run(unittest.TestSuite((simple, write)))
+    runner.run(unittest.TestSuite((simple, write, deploy)))
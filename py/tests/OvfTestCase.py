@@ -9,3 +9,212 @@
 # Contributors:
 # Eric Casler (IBM) - initial implementation
 ##############################################################################
+import unittest
+from StringIO import StringIO
+from xml.dom.minidom import parseString
+
+from ovf import Ovf
+
+class SendallWriter:
+    """Socket-like writer, records each sendall call"""
+    def __init__(self):
+        self.calls = []
+
+    def sendall(self, data):
+        self.calls.append(data)
+
+class OvfTestCase(unittest.TestCase):
+    def setUp(self):
+        """Setup"""
+        self.document = parseString('<Envelope b="&lt;2&gt;" a="1">\n'
+                                    '  <Info>A &amp; "B"</Info>\n'
+                                    '  <!--note-->\n'
+                                    '  <Item><Name>x</Name></Item>\n'
+                                    '  <Empty/>\n'
+                                    '</Envelope>')
+
+    def test_xmlEscape(self):
+        """Testing Ovf.xmlEscape"""
+        self.assertEqual(Ovf.xmlEscape('plain text'), 'plain text')
+        self.assertEqual(Ovf.xmlEscape('<a href="x">&</a>'),
+                         '&lt;a href=&quot;x&quot;&gt;&amp;&lt;/a&gt;')
+        self.assertEqual(Ovf.xmlEscape(u'\xe9 & \xe8'), u'\xe9 &amp; \xe8')
+
+    def test_xmlString(self):
+        """Testing Ovf.xmlString"""
+        elem = self.document.getElementsByTagName('Item')[0]
+        self.assertEqual(Ovf.xmlString(elem), '<Item><Name>x</Name></Item>')
+        self.assertEqual(Ovf.xmlString(elem, '\t', '\n'),
+                         '\t<Item>\n\t\t<Name>x</Name>\n\t</Item>\n')
+
+        testStr = ('<?xml version="1.0" encoding="UTF-8"?>'
+                   '<Envelope a="1" b="&lt;2&gt;">\n'
+                   '  <Info>A &amp; &quot;B&quot;</Info>\n'
+                   '  <!--note-->\n'
+                   '  <Item><Name>x</Name></Item>\n'
+                   '  <Empty/>\n'
+                   '</Envelope>')
+        self.assertEqual(Ovf.xmlString(self.document), testStr)
+
+    def test_xwritexml(self):
+        """Testing Ovf.xwritexml"""
+        Ovf.remove_whitespace_nodes(self.document)
+        testStr = ('<?xml version="1.0" ?>\n'
+                   '<Envelope a="1" b="&lt;2&gt;">\n'
+                   '\t<Info>A &amp; &quot;B&quot;</Info>\n'
+                   '\t<!--note-->\n'
+                   '\t<Item>\n'
+                   '\t\t<Name>x</Name>\n'
+                   '\t</Item>\n'
+                   '\t<Empty/>\n'
+                   '</Envelope>\n')
+
+        buf = StringIO()
+        Ovf.xwritexml(self.document, buf, '', '\t', '\n')
+        self.assertEqual(buf.getvalue(), testStr)
+
+        # a small buffer streams the same output in several writes
+        writer = SendallWriter()
+        Ovf.xwritexml(self.document, writer, '', '\t', '\n', bufferSize=4)
+        self.assertTrue(len(writer.calls) > 1)
+        self.assertEqual(''.join(writer.calls), testStr)
+
+    def test_xwritexmlSkipWhitespace(self):
+        """Testing Ovf.xwritexml with skipWhitespace"""
+        original = self.document.toxml()
+
+        buf = StringIO()
+        Ovf.xwritexml(self.document, buf, '', '\t', '\n',
+                      skipWhitespace=True)
+        self.assertEqual(self.document.toxml(), original)
+
+        Ovf.remove_whitespace_nodes(self.document)
+        testBuf = StringIO()
+        Ovf.xwritexml(self.document, testBuf, '', '\t', '\n')
+        self.assertEqual(buf.getvalue(), testBuf.getvalue())
+
+        # an element holding only whitespace is written as empty
+        document = parseString('<a><b>  </b></a>')
+        buf = StringIO()
+        Ovf.xwritexml(document.documentElement, buf, skipWhitespace=True)
+        self.assertEqual(buf.getvalue(), '<a><b/></a>')
+
+    def test_getDefaultConfiguration(self):
+        """Testing Ovf.getDefaultConfiguration"""
+        for xml, expected in (('<Envelope/>', None),
+                              ('<Envelope><Configuration ovf:id="a"/>'
+                               '<Configuration ovf:id="b"/></Envelope>', 'a'),
+                              ('<Envelope><Configuration ovf:id="a"/>'
+                               '<Configuration ovf:id="b" ovf:default="true"/>'
+                               '</Envelope>', 'b')):
+            document = parseString(xml.replace('<Envelope',
+                                   '<Envelope xmlns:ovf="urn:ovf"', 1))
+            self.assertEqual(Ovf.getDefaultConfiguration(document), expected)
+            self.assertEqual(Ovf.getDefaultConfiguration(document,
+                             Ovf.indexElements(document)), expected)
+
+    def test_compilePath(self):
+        """Testing Ovf.compilePath"""
+        steps = Ovf.compilePath("VirtualSystem[@ovf:id='a b']/Item[2]"
+                                "//rasd:Connection[rasd:Parent]")
+        self.assertEqual(steps,
+                         [(True, 'VirtualSystem', (('attribute', 'ovf:id',
+                                                    'a b'),)),
+                          (False, 'Item', (('position', 2, None),)),
+                          (True, 'rasd:Connection', (('child', 'rasd:Parent',
+                                                      None),))])
+        self.assertTrue(Ovf.compilePath('/Envelope/*') is
+                        Ovf.compilePath('/Envelope/*'))
+        for expr in ['', 'Item//', 'Item Name', 'Item[@x', 'Item/[1]']:
+            self.assertRaises(ValueError, Ovf.compilePath, expr)
+
+    def test_selectNodes(self):
+        """Testing Ovf.selectNodes"""
+        document = parseString('<Envelope><VirtualSystem id="web">'
+                               '<Item><Type>17</Type><Name>disk</Name></Item>'
+                               '<Item><Type>10</Type><Name>nic</Name></Item>'
+                               '</VirtualSystem><VirtualSystem id="db">'
+                               '<Item><Type> 17 </Type><Name>db</Name></Item>'
+                               '</VirtualSystem></Envelope>')
+        index = Ovf.indexElements(document)
+        self.assertEqual(len(index['Item']), 3)
+
+        def names(expr, node=document, index=None):
+            return [Ovf._getText(item.getElementsByTagName('Name')[0])
+                    for item in Ovf.selectNodes(node, expr, index)]
+
+        for idx in (None, index):
+            self.assertEqual(names('Item[Type=17]', index=idx),
+                             ['disk', 'db'])
+            self.assertEqual(names('VirtualSystem[@id=web]/Item[Type="17"]',
+                                   index=idx), ['disk'])
+            self.assertEqual(names('/Envelope/VirtualSystem/Item[2]',
+                                   index=idx), ['nic'])
+            self.assertEqual(names('VirtualSystem//Item[1]', index=idx),
+                             ['disk', 'db'])
+            # positions count within each parent on descendant steps too
+            self.assertEqual(names('//Item[1]', index=idx), ['disk', 'db'])
+            self.assertEqual(names('Item[2]', index=idx), ['nic'])
+            self.assertEqual(names('/Envelope//Item[Type=17][1]', index=idx),
+                             ['disk', 'db'])
+            self.assertEqual(names('Item', document.getElementsByTagName(
+                                'VirtualSystem')[1], idx), ['db'])
+        self.assertEqual(Ovf.selectNodes(document, '/Item'), [])
+        self.assertEqual(len(Ovf.selectNodes(document, '*[@id]')), 2)
+
+    def test_getUnitFactor(self):
+        """Testing Ovf.getUnitFactor"""
+        self.assertEqual(Ovf.getUnitFactor('byte * 2^20'),
+                         ('byte', 2**20, 1))
+        self.assertEqual(Ovf.getUnitFactor('byte*2^20'), ('byte', 2**20, 1))
+        self.assertEqual(Ovf.getUnitFactor('MegaBytes'), ('byte', 2**20, 1))
+        self.assertEqual(Ovf.getUnitFactor('GigaBits'), ('byte', 2**27, 1))
+        self.assertEqual(Ovf.getUnitFactor('bit'), ('byte', 1, 8))
+        self.assertEqual(Ovf.getUnitFactor('byte * 2^-1'), ('byte', 1, 2))
+        self.assertEqual(Ovf.getUnitFactor('percent'), ('percent', 1, 1))
+        self.assertEqual(Ovf.getUnitFactor('bit / second * 10^3'),
+                         ('byte / second', 125, 1))
+        self.assertEqual(Ovf.getUnitFactor('MegaHertz'),
+                         Ovf.getUnitFactor('hertz * 10^6'))
+        for units in ['', '2^20', 'byte ** 2', 'byte 2^20', 'byte * 0',
+                      '__import__("os")']:
+            self.assertRaises(ValueError, Ovf.getUnitFactor, units)
+
+    def test_convertQuantities(self):
+        """Testing Ovf.convertQuantity and Ovf.convertQuantities"""
+        self.assertEqual(Ovf.convertQuantity('256', 'MegaBytes',
+                                             'byte * 2^10'), 262144)
+        self.assertEqual(Ovf.convertQuantity(3, 'bit'), 0.375)
+        self.assertEqual(Ovf.convertQuantities(['1', 2, '0.5'],
+                                               ['byte * 2^20', 'MegaBytes',
+                                                'GigaBytes'],
+                                               'byte * 2^20'),
+                         [1, 2, 512])
+        self.assertEqual(Ovf.convertQuantities(['1', '2'], 'KiloBytes'),
+                         [1024, 2048])
+        self.assertRaises(ValueError, Ovf.convertQuantity, '1', 'percent')
+        self.assertRaises(ValueError, Ovf.convertQuantity, 'x', 'byte')
+        for quantity in ('-1', '-0.5', 'inf', '-inf', 'nan', -2,
+                         1e999):
+            self.assertRaises(ValueError, Ovf.convertQuantity, quantity,
+                              'byte')
+        self.assertRaises(ValueError, Ovf.convertQuantities, ['1'],
+                          ['byte', 'byte'])
+
+    def test_getDiskCapacity(self):
+        """Testing Ovf.getDiskCapacity"""
+        disk = self.document.createElement('Disk')
+        disk.setAttribute('ovf:capacity', '4096')
+        self.assertEqual(Ovf.getDiskCapacity(disk), 4096)
+        disk.setAttribute('ovf:capacity', '8')
+        disk.setAttribute('ovf:capacityAllocationUnits', 'byte * 2^30')
+        self.assertEqual(Ovf.getDiskCapacity(disk), 8 * 2**30)
+        disk.setAttribute('ovf:capacity', '${size}')
+        self.assertRaises(ValueError, Ovf.getDiskCapacity, disk)
+        disk.setAttribute('ovf:capacity', 'inf')
+        self.assertRaises(ValueError, Ovf.getDiskCapacity, disk)
+
+if __name__ == "__main__":
+    TEST = unittest.TestLoader().loadTestsFromTestCase(OvfTestCase)
+    RUNNER = unittest.TextTestRunner(verbosity=2)
+    RUNNER.run(unittest.TestSuite(TEST))
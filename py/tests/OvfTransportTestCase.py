@@ -16,12 +16,15 @@ Test case for functions in OvfTransport.py
 
 import unittest, os
 import hashlib
+import shutil
+import tempfile
 from subprocess import call
 from subprocess import Popen
 from subprocess import PIPE
 from subprocess import STDOUT
 
 from ovf import OvfTransport
+from OvfIsoTestCase import readIso
 
 TEST_FILES_DIR = os.path.join(os.path.dirname(__file__), "test_files/")
 
@@ -111,6 +114,71 @@ class OvfTransportTestCase(unittest.TestCase):
                     self.assertTrue(compareFileMD5s(outfilename, curFile),
                                     'MD5 mismatch')
 
+    def test_makeEnvironmentISO(self):
+        """
+        Test OvfTransport.makeEnvironmentISO
+        """
+        envData = '<Environment/>\n'
+        OvfTransport.makeEnvironmentISO(self.outIsoFile, envData,
+                                        [self.inEnvFile])
+        isoFile = open(self.outIsoFile, 'rb')
+        image = isoFile.read()
+        isoFile.close()
+        os.remove(self.outIsoFile)
+
+        envFile = open(self.inEnvFile)
+        expected = {'ovf-env.xml' : envData,
+                    'test-environment.xml' : envFile.read()}
+        envFile.close()
+        assert readIso(image) == expected, "Rock Ridge files mismatch"
+        assert readIso(image, joliet=True) == expected, \
+               "Joliet files mismatch"
+
+        self.assertRaises(RuntimeError, OvfTransport.makeEnvironmentISO,
+                          self.outIsoFile, envData, [self.path + 'missing'])
+
+    def test_TransportBuilder(self):
+        """
+        Test OvfTransport.TransportBuilder
+        """
+        workDir = tempfile.mkdtemp()
+        try:
+            cacheDir = os.path.join(workDir, 'cache')
+            envFiles = []
+            for (name, data) in (('a.xml', 'a'), ('b.xml', 'b'),
+                                 ('c.xml', 'a')):
+                envFiles.append(os.path.join(workDir, name))
+                envFile = open(envFiles[-1], 'w')
+                envFile.write(data)
+                envFile.close()
+
+            builder = OvfTransport.TransportBuilder(cacheDir, 3)
+            isoFiles = OvfTransport.makeISOTransport(
+                [(None, [envFile]) for envFile in envFiles[:2]], builder)
+            assert isoFiles == [os.path.join(workDir, 'a.iso'),
+                                os.path.join(workDir, 'b.iso')], \
+                   "iso names mismatch"
+            assert (builder.hits, builder.misses) == (0, 2), "not built"
+            assert len(os.listdir(cacheDir)) == 2, "not cached"
+
+            # the same environment under another file name is a hit, in
+            # this process and in a later one
+            builder.makeISOTransport([(None, [envFiles[2]])])
+            assert (builder.hits, builder.misses) == (1, 2), "no hit"
+            builder = OvfTransport.TransportBuilder(cacheDir)
+            builder.makeISOTransport([(None, [envFiles[0]])])
+            assert (builder.hits, builder.misses) == (1, 0), "no later hit"
+            isoFile = open(os.path.join(workDir, 'c.iso'), 'rb')
+            image = isoFile.read()
+            isoFile.close()
+            assert readIso(image) == {'ovf-env.xml' : 'a'}, "wrong image"
+
+            self.assertRaises(RuntimeError, builder.makeISOTransport,
+                              [(None, [envFiles[0]]),
+                               (None, [os.path.join(workDir, 'missing')])])
+        finally:
+            shutil.rmtree(workDir)
+
 
 if __name__ == "__main__":
     TEST = unittest.TestLoader().loadTestsFromTestCase(OvfTransportTestCase)
@@ -22,7 +22,9 @@ import OvfEnvironmentTestCase
 import OvfPropertyTestCase
 import OvfPlatformTestCase
 import OvfTransportTestCase
+import OvfIsoTestCase
 import OvfLibvirtTestCase
+import OvfProvisionTestCase
 
 if __name__ == "__main__":
     test = []
@@ -36,7 +38,9 @@ if __name__ == "__main__":
     test.append(unittest.TestLoader().loadTestsFromModule(OvfPropertyTestCase))
     test.append(unittest.TestLoader().loadTestsFromModule(OvfPlatformTestCase))
     test.append(unittest.TestLoader().loadTestsFromModule(OvfTransportTestCase))
+    test.append(unittest.TestLoader().loadTestsFromModule(OvfIsoTestCase))
     test.append(unittest.TestLoader().loadTestsFromModule(OvfLibvirtTestCase))
+    test.append(unittest.TestLoader().loadTestsFromModule(OvfProvisionTestCase))
     runner = unittest.TextTestRunner(verbosity=2)
 
     testSuite = unittest.TestSuite()
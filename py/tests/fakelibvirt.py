@@ -0,0 +1,75 @@
+# vi: ts=4 expandtab syntax=python
+##############################################################################
+# Copyright (c) 2008 IBM Corporation
+# All rights reserved. This program and the accompanying materials
+# are made available under the terms of the Eclipse Public License v1.0
+# which accompanies this distribution, and is available at
+# http://www.eclipse.org/legal/epl-v10.html
+#
+##############################################################################
+"""
+The part of the libvirt python binding that OvfLibvirt uses, without a
+hypervisor.  Domains are only recorded, and every connection is counted,
+so tests and benchmarks can see how connections are used:
+
+  pool = OvfLibvirt.ConnectionPool(fakelibvirt.open)
+"""
+
+import time
+
+#: seconds open() takes, to model the handshake with libvirtd
+OPEN_DELAY = 0
+
+#: every connection opened, in order
+connections = []
+
+class libvirtError(Exception):
+    """Raised like libvirt.libvirtError."""
+    pass
+
+class virDomain:
+    """A domain that was created on a L{virConnect}."""
+    def __init__(self, conn, xml):
+        self.conn = conn
+        self.xml = xml
+        self.state = 'running'
+
+    def destroy(self):
+        """Powers the domain off."""
+        self.state = 'shutoff'
+
+    def shutdown(self):
+        """Asks the guest to shut down."""
+        self.state = 'shutdown'
+
+class virConnect:
+    """A connection to the hypervisor at uri."""
+    def __init__(self, uri):
+        self.uri = uri
+        self.domains = []
+        self.alive = True
+
+    def createLinux(self, xml, flags):
+        """Creates and starts a domain."""
+        if not self.alive:
+            raise libvirtError("connection to " + self.uri + " is closed")
+        domain = virDomain(self, xml)
+        self.domains.append(domain)
+        return domain
+
+    def isAlive(self):
+        """Returns 1 while the connection is open."""
+        return int(self.alive)
+
+    def close(self):
+        """Closes the connection."""
+        self.alive = False
+        return 0
+
+def open(uri):
+    """Opens a connection to uri."""
+    if OPEN_DELAY:
+        time.sleep(OPEN_DELAY)
+    conn = virConnect(uri)
+    connections.append(conn)
+    return conn